@@ -13,19 +13,40 @@ JW Library Backup Merger
 - Поддержка всех типов данных (заметки, пометки, теги, закладки)
 """
 
+__version__ = "1.0.0"
+
 import argparse
+import array
+import bisect
+import concurrent.futures
+import contextlib
+import cProfile
+import csv
+import functools
 import hashlib
+import heapq
+import io
 import json
 import logging
+import mmap
+import operator
 import os
+import pstats
+import queue
 import shutil
 import sqlite3
+import struct
 import sys
 import tempfile
+import threading
+import time
+import tracemalloc
 import zipfile
+import zlib
+from dataclasses import dataclass, field
 from datetime import datetime
 from pathlib import Path
-from typing import Dict, FrozenSet, List, Optional, Set, Tuple
+from typing import BinaryIO, Callable, Dict, FrozenSet, Iterable, Iterator, List, Optional, Set, TextIO, Tuple, Union
 
 # Try to import tqdm, use dummy class if not available
 try:
@@ -79,85 +100,110 @@ PRIMARY_KEYS: Dict[str, str] = {
     'TagMap': 'TagMapId'
 }
 
+# Количество записей, читаемых из исходной таблицы за один fetchmany
+DEFAULT_BATCH_SIZE = 1000
+
+# Глубина конвейера: порций (по batch_size записей), прочитанных и хэшированных
+# заранее в фоновом потоке; 0 - последовательная обработка без потоков
+PIPELINE_DEPTH = 4
+
+# Внешние ключи: {дочерняя таблица: [(столбец, родительская таблица), ...]}
+FOREIGN_KEYS: Dict[str, List[Tuple[str, str]]] = {
+    'UserMark': [('LocationId', 'Location')],
+    'Note': [('LocationId', 'Location'), ('UserMarkId', 'UserMark')],
+    'TagMap': [('TagId', 'Tag')],
+    'Bookmark': [('LocationId', 'Location'), ('PublicationLocationId', 'Location')],
+    'BlockRange': [('UserMarkId', 'UserMark')],
+}
+
+
+# Поля ключа дедупликации: (столбец, значение по умолчанию для пустых значений)
+RECORD_KEY_FIELDS: Dict[str, Tuple[Tuple[str, object], ...]] = {
+    'Note': (('Content', ''), ('Title', ''), ('LocationId', 0), ('UserMarkId', None),
+             ('BlockType', 0), ('BlockIdentifier', ''), ('Guid', '')),
+    'UserMark': (('LocationId', 0), ('ColorIndex', 0), ('StyleIndex', 0), ('Version', 0)),
+    'Location': (('BookNumber', 0), ('ChapterNumber', 0), ('DocumentId', 0), ('KeySymbol', ''),
+                 ('IssueTagNumber', 0), ('MepsLanguage', 0), ('Title', '')),
+    'Tag': (('Name', ''), ('Type', 0)),
+    'Bookmark': (('LocationId', 0), ('Slot', 0), ('Title', ''), ('Snippet', '')),
+    'BlockRange': (('BlockType', 0), ('Identifier', 0), ('StartToken', 0), ('EndToken', 0), ('UserMarkId', None)),
+    'TagMap': (('Type', 0), ('TypeId', 0), ('TagId', 0), ('Position', 0)),
+}
+
+
+# Столбцы, от которых зависит ключ, в порядке для key_text_from_values
+# (UserMark с GUID идентифицируется только по GUID)
+RECORD_KEY_COLUMNS: Dict[str, Tuple[str, ...]] = {
+    table_name: (('UserMarkGuid',) if table_name == 'UserMark' else ()) + tuple(column for column, _ in key_fields)
+    for table_name, key_fields in RECORD_KEY_FIELDS.items()
+}
+
+# Таблицы, записи которых идентифицируются GUID: правка заметки между бэкапами
+# меняет её хэш, но не GUID, поэтому такие записи объединяются по GUID
+GUID_COLUMNS: Dict[str, str] = {
+    'Note': 'Guid',
+    'UserMark': 'UserMarkGuid',
+}
+
+# Столбцы версии записи в порядке приоритета: побеждает более новая версия
+VERSION_COLUMNS: Tuple[str, ...] = ('LastModified', 'Created')
+
+# Столбцы версии для upsert по GUID: у UserMark нет дат, версия - номер Version
+GUID_VERSION_COLUMNS: Dict[str, Tuple[str, ...]] = {
+    'Note': VERSION_COLUMNS,
+    'UserMark': ('Version',),
+}
+
+# Индекс GUID: {таблица: {guid: (id в целевой БД, версия)}}
+GuidIndex = Dict[str, Dict[str, Tuple[int, Optional[str]]]]
+
+
+def key_text_from_values(table_name, values):
+    """Строка ключа из значений столбцов RECORD_KEY_COLUMNS[table_name] по порядку"""
+    defaults = RECORD_KEY_FIELDS[table_name]
+    if table_name == 'UserMark':
+        if values[0]:
+            return values[0]
+        values = values[1:]
+    return '|'.join([str(value or default) for value, (_, default) in zip(values, defaults)])
+
+
+def record_key_text(table_name, record_data):
+    """Строка, из которой вычисляется хэш записи (см. generate_record_hash)"""
+    if table_name not in RECORD_KEY_FIELDS:
+        return '|'.join(str(v) for v in record_data.values() if v is not None)
+    return key_text_from_values(table_name, [record_data.get(column) for column in RECORD_KEY_COLUMNS[table_name]])
+
 
 def generate_record_hash(table_name, record_data):
     """Создание уникального хэша для записи"""
-    if table_name == 'Note':
-        content = record_data.get('Content') or ''
-        title = record_data.get('Title') or ''
-        location_id = record_data.get('LocationId') or 0
-        user_mark_id = record_data.get('UserMarkId') or None
-        block_type = record_data.get('BlockType') or 0
-        block_identifier = record_data.get('BlockIdentifier') or ''
-        guid = record_data.get('Guid') or ''
-        
-        fields = f"{content}|{title}|{location_id}|{user_mark_id}|{block_type}|{block_identifier}|{guid}"
-        return hashlib.sha256(fields.encode('utf-8')).hexdigest()
-
-    elif table_name == 'UserMark':
-        guid = record_data.get('UserMarkGuid')
-        if guid:
-            return hashlib.sha256(guid.encode('utf-8')).hexdigest()
-        else:
-            location_id = record_data.get('LocationId') or 0
-            color_index = record_data.get('ColorIndex') or 0
-            style_index = record_data.get('StyleIndex') or 0
-            version = record_data.get('Version') or 0
-            return hashlib.sha256(f"{location_id}|{color_index}|{style_index}|{version}".encode('utf-8')).hexdigest()
-
-    elif table_name == 'Location':
-        book_number = record_data.get('BookNumber') or 0
-        chapter_number = record_data.get('ChapterNumber') or 0
-        document_id = record_data.get('DocumentId') or 0
-        key_symbol = record_data.get('KeySymbol') or ''
-        issue_tag_number = record_data.get('IssueTagNumber') or 0
-        meps_language = record_data.get('MepsLanguage') or 0
-        title = record_data.get('Title') or ''
-        return hashlib.sha256(f"{book_number}|{chapter_number}|{document_id}|{key_symbol}|{issue_tag_number}|{meps_language}|{title}".encode('utf-8')).hexdigest()
-
-    elif table_name == 'Tag':
-        name = record_data.get('Name') or ''
-        tag_type = record_data.get('Type') or 0
-        return hashlib.sha256(f"{name}|{tag_type}".encode('utf-8')).hexdigest()
-
-    elif table_name == 'Bookmark':
-        location_id = record_data.get('LocationId') or 0
-        slot = record_data.get('Slot') or 0
-        title = record_data.get('Title') or ''
-        snippet = record_data.get('Snippet') or ''
-        return hashlib.sha256(f"{location_id}|{slot}|{title}|{snippet}".encode('utf-8')).hexdigest()
-
-    elif table_name == 'BlockRange':
-        block_type = record_data.get('BlockType') or 0
-        identifier = record_data.get('Identifier') or 0
-        start_token = record_data.get('StartToken') or 0
-        end_token = record_data.get('EndToken') or 0
-        user_mark_id = record_data.get('UserMarkId') or None
-        return hashlib.sha256(f"{block_type}|{identifier}|{start_token}|{end_token}|{user_mark_id}".encode('utf-8')).hexdigest()
-
-    elif table_name == 'TagMap':
-        tag_type = record_data.get('Type') or 0
-        type_id = record_data.get('TypeId') or 0
-        tag_id = record_data.get('TagId') or 0
-        position = record_data.get('Position') or 0
-        return hashlib.sha256(f"{tag_type}|{type_id}|{tag_id}|{position}".encode('utf-8')).hexdigest()
+    return hashlib.sha256(record_key_text(table_name, record_data).encode('utf-8')).hexdigest()
 
-    else:
-        fields_str = '|'.join(str(v) for v in record_data.values() if v is not None)
-        return hashlib.sha256(fields_str.encode('utf-8')).hexdigest()
+
+# Имена файла базы данных внутри архива .jwlibrary
+DB_MEMBER_NAMES: Tuple[str, ...] = ('userData.db', 'user_data.db')
+
+
+def _is_media_name(name: str) -> bool:
+    """Медиафайл ли член архива: всё, кроме базы, манифеста и директорий"""
+    return not name.endswith('/') and name != 'manifest.json' and name not in DB_MEMBER_NAMES
 
 
 def extract_from_archive(archive_path, extract_dir):
-    """Извлечение архива JW Library"""
-    with zipfile.ZipFile(archive_path, 'r') as zip_ref:
-        zip_ref.extractall(extract_dir)
+    """Извлечение базы данных и манифеста из архива JW Library
 
+    Медиафайлы не распаковываются: в выходной архив они переносятся
+    сжатыми (см. plan_media, copy_raw_member).
+    """
+    with zipfile.ZipFile(archive_path, 'r') as zip_ref:
+        names = set(zip_ref.namelist())
         # Проверяем оба возможных имени файла БД
-        db_path = Path(extract_dir) / 'userData.db'
-        if not db_path.exists():
-            db_path = Path(extract_dir) / 'user_data.db'
+        db_member = next((name for name in DB_MEMBER_NAMES if name in names), DB_MEMBER_NAMES[0])
+        for member in (db_member, 'manifest.json'):
+            if member in names:
+                zip_ref.extract(member, extract_dir)
 
-        return db_path, Path(extract_dir) / 'manifest.json'
+        return Path(extract_dir) / db_member, Path(extract_dir) / 'manifest.json'
 
 
 def validate_database_schema(db_path):
@@ -196,315 +242,3878 @@ def validate_database_schema(db_path):
         return False, [], f"Ошибка при проверке схемы: {e}"
 
 
+def iter_fetchmany(cursor: sqlite3.Cursor, batch_size: int = DEFAULT_BATCH_SIZE) -> Iterator[Tuple]:
+    """Построчная итерация по результату запроса порциями fetchmany
+
+    В памяти одновременно находится не больше batch_size записей.
+    """
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield from rows
+
+
+# Плотный маппинг ID: old_id индексирует массив, пока он не длиннее
+# IDMAP_DENSE_SLACK * (число ID) + IDMAP_DENSE_MIN элементов
+IDMAP_DENSE_MIN = 1024
+IDMAP_DENSE_SLACK = 4
+
+
+class IdMap:
+    """Маппинг old_id → new_id одной таблицы одного архива
+
+    ID JW Library - плотные небольшие целые, поэтому новые ID хранятся в
+    array('q'), индексированном старым ID (0 - нет маппинга): 8 байт на ID
+    вместо ~100 байт на элемент dict с объектами int. ID, для которых
+    массив оказался бы слишком разреженным (или не положительные целые),
+    хранятся в dict. Маппинг строится заново для каждого архива: старые ID
+    имеют смысл только внутри своего архива.
+    """
+
+    __slots__ = ('_dense', '_sparse', '_count')
+
+    def __init__(self, items: Optional[Dict[int, int]] = None):
+        self._dense = array.array('q')
+        self._sparse: Dict[object, int] = {}
+        self._count = 0
+        for old_id, new_id in (items or {}).items():
+            self[old_id] = new_id
+
+    def __setitem__(self, old_id: object, new_id: int) -> None:
+        dense = type(old_id) is int and old_id > 0
+        if dense and old_id >= len(self._dense):
+            dense = old_id < IDMAP_DENSE_SLACK * (self._count + 1) + IDMAP_DENSE_MIN
+            if dense:
+                # Рост с запасом: амортизированно O(1) на добавленный ID
+                size = len(self._dense)
+                grow = max(old_id + 1, 2 * size) - size
+                self._dense.frombytes(bytes(grow * self._dense.itemsize))
+        if dense and new_id > 0:
+            if not self._dense[old_id] and self._sparse.pop(old_id, None) is None:
+                self._count += 1
+            self._dense[old_id] = new_id
+            return
+        if old_id not in self:
+            self._count += 1
+        if dense:
+            self._dense[old_id] = 0
+        self._sparse[old_id] = new_id
+
+    def get(self, old_id: object, default: Optional[int] = None) -> Optional[int]:
+        if type(old_id) is int and 0 < old_id < len(self._dense):
+            new_id = self._dense[old_id]
+            if new_id:
+                return new_id
+        return self._sparse.get(old_id, default)
+
+    def __getitem__(self, old_id: object) -> int:
+        new_id = self.get(old_id)
+        if new_id is None:
+            raise KeyError(old_id)
+        return new_id
+
+    def __contains__(self, old_id: object) -> bool:
+        return self.get(old_id) is not None
+
+    def __len__(self) -> int:
+        return self._count
+
+    def items(self) -> Iterator[Tuple[object, int]]:
+        for old_id, new_id in enumerate(self._dense):
+            if new_id:
+                yield old_id, new_id
+        yield from self._sparse.items()
+
+    def remap_column(self, values: Iterable) -> List:
+        """Маппинг столбца внешнего ключа порции записей: ненулевые известные ID заменяются"""
+        dense, size, get = self._dense, len(self._dense), self._sparse.get
+        if not self._sparse:
+            return [(dense[v] or v) if type(v) is int and 0 < v < size else v for v in values]
+        return [(dense[v] or get(v, v)) if type(v) is int and 0 < v < size else (get(v, v) if v else v)
+                for v in values]
+
+
+# Служебные таблицы схемы, которые не сливаются как пользовательские данные
+SERVICE_TABLES: FrozenSet[str] = frozenset(['LastModified', 'android_metadata', 'grdb_migrations'])
+
+
+@dataclass(frozen=True)
+class TableInfo:
+    """Описание таблицы по схеме базы (см. schema_registry)
+
+    primary_key - столбец INTEGER PRIMARY KEY (псевдоним rowid), для
+    которого строится маппинг ID; foreign_keys - (столбец, родительская
+    таблица) для ссылок на первичный ключ родителя; natural_key - столбцы
+    UNIQUE-индекса (явное ограничение предпочтительнее составного первичного
+    ключа), а без него - все столбцы, кроме первичного ключа.
+    """
+    name: str
+    columns: Tuple[str, ...]
+    primary_key: Optional[str]
+    foreign_keys: Tuple[Tuple[str, str], ...]
+    natural_key: Tuple[str, ...]
+
+
+@dataclass(frozen=True)
+class SchemaRegistry:
+    """Таблицы пользовательских данных базы в порядке слияния (родители раньше детей)"""
+    fingerprint: str
+    tables: Dict[str, TableInfo]
+    order: Tuple[str, ...]
+
+
+# Реестры по отпечатку схемы: архивы одной версии JW Library разбираются один раз
+_SCHEMA_REGISTRIES: Dict[str, SchemaRegistry] = {}
+
+
+def _unique_keys(conn: sqlite3.Connection, table_name: str) -> List[Tuple[str, ...]]:
+    """Столбцы UNIQUE-индексов таблицы (без частичных индексов и выражений), первичный ключ - последним"""
+    indexes = conn.execute(
+        'SELECT name, origin FROM pragma_index_list(?) WHERE "unique" AND NOT partial', (table_name,)
+    ).fetchall()
+    keys = []
+    for index_name, _ in sorted(indexes, key=lambda index: (index[1] == 'pk', index[0])):
+        columns = tuple(row[0] for row in conn.execute(
+            'SELECT name FROM pragma_index_info(?) ORDER BY seqno', (index_name,)
+        ))
+        if columns and None not in columns:
+            keys.append(columns)
+    return keys
+
+
+def _natural_key(conn: sqlite3.Connection, table_name: str) -> Optional[Tuple[str, ...]]:
+    """Столбцы первого UNIQUE-индекса таблицы"""
+    keys = _unique_keys(conn, table_name)
+    return keys[0] if keys else None
+
+
+def _unique_row_lookup(
+    conn: sqlite3.Connection,
+    table_name: str,
+    columns: List[str],
+    pk_column: str
+) -> Optional[Callable[[Tuple], Optional[int]]]:
+    """Поиск строки conn, уже занявшей UNIQUE-ключ записи: запись → первичный ключ или None
+
+    Ключи проверяются в порядке _unique_keys, первым - естественный ключ
+    реестра схемы (TableInfo.natural_key). Без UNIQUE-индексов возвращает None.
+    """
+    queries = []
+    for key_columns in _unique_keys(conn, table_name):
+        if pk_column in key_columns or not set(key_columns) <= set(columns):
+            continue
+        condition = ' AND '.join(f'"{column}" = ?' for column in key_columns)
+        positions = [columns.index(column) for column in key_columns]
+        queries.append((f'SELECT "{pk_column}" FROM "{table_name}" WHERE {condition}', positions))
+    if not queries:
+        return None
+
+    def lookup(record: Tuple) -> Optional[int]:
+        for sql, positions in queries:
+            values = tuple(record[position] for position in positions)
+            # NULL не нарушает UNIQUE: по такому ключу конфликта не было
+            if None in values:
+                continue
+            row = conn.execute(sql, values).fetchone()
+            if row is not None:
+                return row[0]
+        return None
+
+    return lookup
+
+
+def _topological_order(tables: Dict[str, TableInfo]) -> Tuple[str, ...]:
+    """Порядок таблиц: родительские раньше дочерних, при равенстве - как в TABLE_ORDER, затем по имени"""
+    def priority(name: str) -> Tuple[int, str]:
+        return (TABLE_ORDER.index(name) if name in TABLE_ORDER else len(TABLE_ORDER), name)
+
+    parents = {
+        name: {parent for _, parent in info.foreign_keys if parent != name and parent in tables}
+        for name, info in tables.items()
+    }
+    ready = [priority(name) for name, pending in parents.items() if not pending]
+    heapq.heapify(ready)
+    order: List[str] = []
+    while ready:
+        _, name = heapq.heappop(ready)
+        order.append(name)
+        for child, pending in parents.items():
+            if name in pending:
+                pending.discard(name)
+                if not pending:
+                    heapq.heappush(ready, priority(child))
+    # Циклические ссылки: оставшиеся таблицы в порядке приоритета
+    order.extend(sorted((name for name in tables if name not in order), key=priority))
+    return tuple(order)
+
+
+def schema_registry(conn: sqlite3.Connection) -> SchemaRegistry:
+    """Реестр таблиц пользовательских данных по sqlite_master и PRAGMA foreign_key_list/index_list
+
+    Кроме семи основных таблиц, в него попадают все таблицы схемы (InputField,
+    PlaylistItem, IndependentMedia, таблицы связей), поэтому они сливаются из
+    всех архивов, а не только переносятся из первого. Реестр кэшируется по
+    отпечатку схемы (schema_fingerprint).
+    """
+    fingerprint = schema_fingerprint(conn)
+    registry = _SCHEMA_REGISTRIES.get(fingerprint)
+    if registry is not None:
+        return registry
+
+    names = [
+        row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+        )
+        if row[0] not in SERVICE_TABLES
+    ]
+    primary_keys: Dict[str, Optional[str]] = {}
+    columns: Dict[str, Tuple[str, ...]] = {}
+    for name in names:
+        info = conn.execute('SELECT name, type, pk FROM pragma_table_info(?) ORDER BY cid', (name,)).fetchall()
+        columns[name] = tuple(row[0] for row in info)
+        pk_columns = [row for row in info if row[2]]
+        integer_pk = len(pk_columns) == 1 and pk_columns[0][1].upper() == 'INTEGER'
+        primary_keys[name] = pk_columns[0][0] if integer_pk else None
+
+    tables: Dict[str, TableInfo] = {}
+    for name in names:
+        foreign_keys = [(column, parent) for column, parent in FOREIGN_KEYS.get(name, ()) if column in columns[name]]
+        declared = conn.execute(
+            'SELECT id, COUNT(*), "table", "from", "to" FROM pragma_foreign_key_list(?) GROUP BY id', (name,)
+        ).fetchall()
+        for _, size, parent, column, target in declared:
+            # Составные ключи и ссылки не на первичный ключ не маппятся
+            if size != 1 or parent not in primary_keys or target not in (None, primary_keys[parent]):
+                continue
+            if (column, parent) not in foreign_keys:
+                foreign_keys.append((column, parent))
+        pk_column = primary_keys[name]
+        natural_key = _natural_key(conn, name) or tuple(column for column in columns[name] if column != pk_column)
+        tables[name] = TableInfo(name, columns[name], pk_column, tuple(foreign_keys), natural_key)
+
+    registry = SchemaRegistry(fingerprint, tables, _topological_order(tables))
+    _SCHEMA_REGISTRIES[fingerprint] = registry
+    logger.debug(f"Реестр таблиц схемы {fingerprint[:12]}: {', '.join(registry.order)}")
+    return registry
+
+
+def _tuple_getter(positions: List[int]) -> Callable[[Tuple], Tuple]:
+    """operator.itemgetter, всегда возвращающий кортеж (и для одной позиции)"""
+    if len(positions) == 1:
+        position = positions[0]
+        return lambda record: (record[position],)
+    if not positions:
+        return lambda record: ()
+    return operator.itemgetter(*positions)
+
+
+@dataclass(frozen=True)
+class RowPlan:
+    """План обработки записей таблицы для конкретной схемы источника
+
+    Позиции столбцов ключа, внешних ключей и первичного ключа вычисляются
+    один раз (см. _compile_row_plan), поэтому на каждую запись приходится
+    только индексирование кортежа и одно вычисление ключа - без dict и
+    без поиска столбцов по имени.
+    """
+    table: str
+    columns: Tuple[str, ...]
+    key_values: Callable[[Tuple], Tuple]
+    key_defaults: Tuple[object, ...]
+    guid_key: bool
+    padded: bool
+    foreign_keys: Tuple[Tuple[int, str], ...]
+    pk_index: Optional[int]
+    without_pk: Callable[[Tuple], Tuple]
+
+    def key_text(self, record: Tuple) -> str:
+        """Строка ключа записи, та же, что у key_text_from_values"""
+        values = self.key_values(record + (None,) if self.padded else record)
+        if self.guid_key:
+            # UserMark с GUID идентифицируется только по GUID
+            if values[0]:
+                return values[0]
+            values = values[1:]
+        return '|'.join([str(value or default) for value, default in zip(values, self.key_defaults)])
+
+    def key_hash(self, record: Tuple) -> str:
+        return hashlib.sha256(self.key_text(record).encode('utf-8')).hexdigest()
+
+    def fk_mappings(self, id_mapping: Optional[Dict[str, IdMap]]) -> Tuple[Tuple[int, IdMap], ...]:
+        """Позиции внешних ключей с маппингом их родительских таблиц для текущего источника"""
+        if not id_mapping:
+            return ()
+        return tuple(
+            (position, _as_id_map(id_mapping[parent]))
+            for position, parent in self.foreign_keys if id_mapping.get(parent)
+        )
+
+
+def _as_id_map(mapping: Union[IdMap, Dict[int, int]]) -> IdMap:
+    return mapping if isinstance(mapping, IdMap) else IdMap(mapping)
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_row_plan(table_name: str, columns: Tuple[str, ...], table_info: Optional[TableInfo] = None) -> RowPlan:
+    """План обработки записей таблицы; кэшируется по схеме (имени таблицы, столбцам и TableInfo)
+
+    Для основных таблиц ключ - RECORD_KEY_FIELDS, для остальных -
+    естественный ключ из реестра схемы (table_info.natural_key).
+    """
+    if table_name in RECORD_KEY_FIELDS:
+        key_columns = RECORD_KEY_COLUMNS[table_name]
+        key_defaults = tuple(default for _, default in RECORD_KEY_FIELDS[table_name])
+        pk_column = PRIMARY_KEYS.get(table_name)
+    else:
+        key_columns = table_info.natural_key
+        key_defaults = ('',) * len(key_columns)
+        pk_column = table_info.primary_key
+    foreign_keys = list(FOREIGN_KEYS.get(table_name, ()))
+    if table_info is not None:
+        foreign_keys += [fk for fk in table_info.foreign_keys if fk not in foreign_keys]
+    # Отсутствующие в схеме столбцы ключа читаются из None, добавленного в конец записи
+    positions = [columns.index(column) if column in columns else len(columns) for column in key_columns]
+    pk_index = columns.index(pk_column) if pk_column in columns else None
+    return RowPlan(
+        table=table_name,
+        columns=columns,
+        key_values=_tuple_getter(positions),
+        key_defaults=key_defaults,
+        guid_key=table_name == 'UserMark',
+        padded=len(columns) in positions,
+        foreign_keys=tuple((columns.index(column), parent) for column, parent in foreign_keys if column in columns),
+        pk_index=pk_index,
+        without_pk=_tuple_getter([i for i in range(len(columns)) if i != pk_index]),
+    )
+
+
+def _iter_keyed_records(records: Iterable[Tuple], plan: RowPlan) -> Iterator[Tuple[Tuple, str]]:
+    """Стадия конвейера: запись → (запись, хэш записи)"""
+    key_hash = plan.key_hash
+    for record in records:
+        yield record, key_hash(record)
+
+
+def _iter_keyed_batches(
+    cursor: sqlite3.Cursor,
+    plan: RowPlan,
+    id_mapping: Optional[Dict[str, IdMap]],
+    batch_size: int = DEFAULT_BATCH_SIZE
+) -> Iterator[List[Tuple[Tuple, Tuple, str]]]:
+    """Стадия конвейера: порция fetchmany → [(исходная запись, запись с новыми внешними ключами, хэш), ...]
+
+    Хэш считается после маппинга внешних ключей, то есть в пространстве ID
+    объединённой базы: одинаковые записи архивов с разной нумерацией
+    родительских записей распознаются как дубликаты, а результат слияния
+    не зависит от того, сливаются архивы напрямую или через промежуточные базы.
+    Маппинг родительских таблиц к этому моменту уже заполнен: таблицы
+    обрабатываются по очереди в порядке TABLE_ORDER.
+    """
+    fk_mappings = plan.fk_mappings(id_mapping)
+    key_hash = plan.key_hash
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        records = _remap_rows(rows, fk_mappings)
+        yield list(zip(rows, records, map(key_hash, records)))
+
+
+_PIPELINE_DONE = object()
+
+
+def _iter_in_thread(items: Iterable, maxsize: int) -> Iterator:
+    """Выполнение итератора в фоновом потоке с ограниченной очередью
+
+    Поток-производитель опережает потребителя не больше чем на maxsize
+    элементов (backpressure), поэтому память ограничена. Исключение
+    производителя повторно выбрасывается у потребителя; при досрочном
+    закрытии генератора производитель останавливается.
+    """
+    buffer: queue.Queue = queue.Queue(maxsize)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce() -> None:
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+        except BaseException as e:
+            put((_PIPELINE_DONE, e))
+            return
+        put((_PIPELINE_DONE, None))
+
+    producer = threading.Thread(target=produce, name='jwl-merge-pipeline', daemon=True)
+    producer.start()
+    try:
+        while True:
+            item, error = buffer.get()
+            if item is _PIPELINE_DONE:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
+
+def _remap_rows(rows: List[Tuple], fk_mappings: Tuple[Tuple[int, IdMap], ...]) -> List[Tuple]:
+    """Маппинг внешних ключей порции записей по столбцам
+
+    Порция транспонируется, каждый столбец внешнего ключа заменяется
+    целиком (IdMap.remap_column), затем записи собираются обратно. Без
+    маппинга записи проходят без копирования.
+    """
+    if not fk_mappings or not rows:
+        return rows
+    columns = list(zip(*rows))
+    for position, mapping in fk_mappings:
+        columns[position] = mapping.remap_column(columns[position])
+    return list(zip(*columns))
+
+
+@dataclass
+class TableMergeStats:
+    """Счётчики слияния одной таблицы
+
+    base - записи первого архива, скопированные вместе с его базой;
+    inserted - добавленные записи; updated - записи, обновлённые до более
+    новой версии по GUID; duplicates - отброшенные дубликаты; removed -
+    записи-сироты, удалённые при проверке (verify_merged_db).
+    """
+    base: int = 0
+    inserted: int = 0
+    updated: int = 0
+    duplicates: int = 0
+    removed: int = 0
+
+    @property
+    def total(self) -> int:
+        """Количество записей таблицы в объединённой базе"""
+        return self.base + self.inserted - self.removed
+
+    @property
+    def processed(self) -> int:
+        """Количество прочитанных записей источников, включая дубликаты"""
+        return self.base + self.inserted + self.updated + self.duplicates
+
+
+@dataclass
+class MergeResult:
+    """Результат create_merged_db
+
+    Счётчики собираются во время слияния, поэтому вызывающему коду не
+    нужно заново открывать объединённую базу для подсчёта записей или хэша.
+    """
+    path: Optional[Path] = None
+    archives: int = 0
+    table_stats: Dict[str, TableMergeStats] = field(default_factory=dict)
+    timings: Dict[str, float] = field(default_factory=dict)
+    archive_timings: Dict[str, float] = field(default_factory=dict)
+    db_bytes: int = 0
+    db_hash: str = ''
+    duration: float = 0.0
+    verify: Optional['VerifyReport'] = None
+
+    @property
+    def tables(self) -> Dict[str, int]:
+        """Количество записей по таблицам в объединённой базе"""
+        return {table: stats.total for table, stats in self.table_stats.items()}
+
+    @property
+    def inserted(self) -> Dict[str, int]:
+        return {table: stats.inserted for table, stats in self.table_stats.items()}
+
+    @property
+    def duplicates(self) -> Dict[str, int]:
+        return {table: stats.duplicates for table, stats in self.table_stats.items()}
+
+    @property
+    def total_records(self) -> int:
+        return sum(self.tables.values())
+
+
+def _version_column(columns: List[str]) -> Optional[str]:
+    """Первый из VERSION_COLUMNS, присутствующий в таблице"""
+    return next((column for column in VERSION_COLUMNS if column in columns), None)
+
+
+def _guid_version_column(table_name: str, columns: List[str]) -> Optional[str]:
+    """Первый из GUID_VERSION_COLUMNS[table_name], присутствующий в таблице"""
+    return next((column for column in GUID_VERSION_COLUMNS[table_name] if column in columns), None)
+
+
+def _is_newer(version: Optional[object], existing_version: Optional[object]) -> bool:
+    """Новее ли версия записи уже сохранённой (ISO 8601 сравнивается как строка, Version - как число)"""
+    return version is not None and (existing_version is None or version > existing_version)
+
+
+def _load_guid_index(conn: sqlite3.Connection, table_name: str) -> Dict[str, Tuple[int, Optional[str]]]:
+    """Индекс GUID → (первичный ключ, версия) по записям таблицы
+
+    Строится один раз на таблицу целевой БД и затем поддерживается
+    copy_unique_records при вставке и обновлении, без повторного чтения.
+    """
+    guid_column = GUID_COLUMNS[table_name]
+    pk_column = PRIMARY_KEYS[table_name]
+    try:
+        columns = [row[1] for row in conn.execute(f'PRAGMA table_info("{table_name}")')]
+    except sqlite3.Error:
+        return {}
+    if guid_column not in columns or pk_column not in columns:
+        return {}
+
+    version_column = _guid_version_column(table_name, columns)
+    version_sql = f'"{version_column}"' if version_column else 'NULL'
+    cursor = conn.execute(
+        f'SELECT "{guid_column}", "{pk_column}", {version_sql} FROM "{table_name}" '
+        f'WHERE "{guid_column}" IS NOT NULL AND "{guid_column}" != \'\''
+    )
+    return {guid: (row_id, version) for guid, row_id, version in cursor}
+
+
+def _table_foreign_keys(table_name: str, registry: Optional[SchemaRegistry] = None) -> Tuple[Tuple[str, str], ...]:
+    """Внешние ключи таблицы (столбец, родитель): из реестра схемы, без него - из FOREIGN_KEYS"""
+    if registry is not None and table_name in registry.tables:
+        return registry.tables[table_name].foreign_keys
+    return tuple(FOREIGN_KEYS.get(table_name, ()))
+
+
+@dataclass
+class MergeFilter:
+    """Фильтр слияния: подмножество таблиц и диапазон дат изменения записей
+
+    Условия переносятся в SELECT источника, поэтому отфильтрованные записи
+    не читаются и не хэшируются. Родительские таблицы (внешние ключи
+    реестра схемы, см. schema_registry) добавляются автоматически, но из них выбираются только записи, на
+    которые ссылаются выбранные дочерние записи. Даты (YYYY-MM-DD или ISO
+    8601) сравниваются со столбцом версии (LastModified/Created) как
+    строки; until включает весь указанный день. Таблицы без столбца
+    версии фильтром дат не ограничиваются.
+    """
+    tables: Optional[FrozenSet[str]] = None
+    since: Optional[str] = None
+    until: Optional[str] = None
+
+    def __post_init__(self):
+        if self.tables is not None:
+            unknown = set(self.tables) - ALLOWED_TABLES
+            if unknown:
+                raise ValueError(f"Недопустимые имена таблиц: {', '.join(sorted(unknown))}")
+            self.tables = frozenset(self.tables)
+
+    @property
+    def active(self) -> bool:
+        return self.tables is not None or self.dated
+
+    @property
+    def dated(self) -> bool:
+        return bool(self.since or self.until)
+
+    @property
+    def requested_tables(self) -> FrozenSet[str]:
+        return self.tables if self.tables is not None else ALLOWED_TABLES
+
+    def selected_tables(self, registry: Optional[SchemaRegistry] = None) -> List[str]:
+        """Запрошенные таблицы и их родительские таблицы
+
+        С registry родители берутся из внешних ключей схемы (включая
+        объявленные в базе, например TagMap.NoteId), порядок - registry.order;
+        без него - FOREIGN_KEYS и порядок TABLE_ORDER.
+        """
+        selected = set(self.requested_tables)
+        pending = list(selected)
+        while pending:
+            for _, parent in _table_foreign_keys(pending.pop(), registry):
+                if parent not in selected:
+                    selected.add(parent)
+                    pending.append(parent)
+        order = list(registry.order) if registry is not None else []
+        order += [table for table in TABLE_ORDER if table not in order]
+        return [table for table in order if table in selected]
+
+    def params(self) -> Dict[str, object]:
+        """Именованные параметры для условий из where_clauses"""
+        return {'since': self.since, 'until': self.until, 'until_len': len(self.until or '')}
+
+    def _date_condition(self, column: str) -> str:
+        conditions = []
+        if self.since:
+            conditions.append(f'"{column}" >= :since')
+        if self.until:
+            conditions.append(f'substr("{column}", 1, :until_len) <= :until')
+        return ' AND '.join(conditions)
+
+    def where_clauses(self, conn: sqlite3.Connection) -> Dict[str, Optional[str]]:
+        """Условия выборки по таблицам базы-источника
+
+        Returns:
+            {таблица: условие WHERE или None для всех записей}; таблицы,
+            которых нет в источнике, не включаются
+        """
+        requested = self.requested_tables
+        registry = schema_registry(conn)
+        selected = self.selected_tables(registry)
+        columns = {table: _table_columns(conn, table) for table in selected}
+        clauses: Dict[str, Optional[str]] = {}
+        # Дочерние таблицы раньше родительских: условие родителя строится по выборке детей
+        for table in reversed(selected):
+            if not columns[table]:
+                continue
+            parts = []
+            if table in requested:
+                version_column = _version_column(columns[table]) if self.dated else None
+                if version_column is None:
+                    clauses[table] = None
+                    continue
+                parts.append(self._date_condition(version_column))
+            table_info = registry.tables.get(table)
+            pk_column = (table_info.primary_key if table_info is not None else None) or PRIMARY_KEYS.get(table, 'rowid')
+            for child in list(clauses):
+                for column, parent in _table_foreign_keys(child, registry):
+                    if parent == table and column in columns[child]:
+                        child_where = f' WHERE {clauses[child]}' if clauses[child] else ''
+                        parts.append(f'"{pk_column}" IN (SELECT "{column}" FROM "{child}"{child_where})')
+            clauses[table] = ' OR '.join(f'({part})' for part in parts) if parts else '0'
+        return clauses
+
+    def only_dated(self, conn: sqlite3.Connection) -> bool:
+        """Все запрошенные таблицы ограничены датой (по схеме базы conn)"""
+        return self.dated and all(
+            _version_column(_table_columns(conn, table)) for table in self.requested_tables
+        )
+
+    def skips_archive(self, modified: Optional[str]) -> bool:
+        """Архив, изменённый раньше since, не содержит подходящих записей"""
+        return bool(self.since and modified and modified < self.since)
+
+    def describe(self) -> Dict[str, object]:
+        return {
+            'tables': sorted(self.tables) if self.tables is not None else None,
+            'since': self.since,
+            'until': self.until,
+        }
+
+
 def copy_unique_records(
     src_conn: sqlite3.Connection,
     dst_conn: sqlite3.Connection,
     table_name: str,
     seen_hashes: Set[str],
-    id_mapping: Optional[Dict[str, Dict[int, int]]] = None
+    id_mapping: Optional[Dict[str, IdMap]] = None,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    guid_index: Optional[GuidIndex] = None,
+    stats: Optional[TableMergeStats] = None,
+    where: Optional[str] = None,
+    where_params: Optional[Dict[str, object]] = None,
+    pipeline_depth: int = 0,
+    seen_ids: Optional[Dict[str, int]] = None,
+    table_info: Optional[TableInfo] = None
 ) -> Set[str]:
     """Копирование уникальных записей с маппингом ID для связанных таблиц
 
+    Записи проходят потоковый конвейер генераторов (чтение порциями
+    fetchmany → маппинг внешних ключей → хэш → фильтр дубликатов →
+    вставка), поэтому пиковое потребление памяти ограничено batch_size
+    записями, а не размером таблицы. С pipeline_depth > 0 чтение и
+    хэширование идут в фоновом потоке и перекрываются со вставкой
+    (src_conn должен быть открыт с check_same_thread=False).
+
+    Для таблиц из GUID_COLUMNS запись с уже известным GUID не вставляется
+    повторно: если её версия (GUID_VERSION_COLUMNS: LastModified/Created,
+    у UserMark - Version) новее, существующая строка обновляется на месте,
+    иначе запись отбрасывается. GUID проверяется раньше хэша: у UserMark
+    хэш - это сам GUID, и правленая копия иначе отбрасывалась бы как
+    дубликат. В обоих случаях старый ID сопоставляется с ID существующей строки. Так же
+    сопоставляется ID дубликата, если передан seen_ids, - дочерние
+    записи дубликата ссылаются на уже скопированную запись.
+
     Args:
         src_conn: Подключение к исходной БД
         dst_conn: Подключение к целевой БД
         table_name: Имя таблицы для копирования
         seen_hashes: Множество хэшей уже обработанных записей
         id_mapping: dict для маппинга ID (например, {'Tag': {old_id: new_id, ...}})
+        batch_size: Количество записей, читаемых из исходной БД за раз
+        guid_index: Индекс GUID целевой БД, общий для всех архивов (см. GuidIndex);
+            если не передан, строится заново для этого вызова
+        stats: Счётчики таблицы, увеличиваемые по результатам копирования
+        where: Условие выборки записей источника (см. MergeFilter.where_clauses)
+        where_params: Именованные параметры условия where
+        pipeline_depth: Порций, читаемых заранее в фоновом потоке (0 - без потока)
+        seen_ids: {хэш: ID записи в целевой БД}, дополняется вставленными записями
+        table_info: Описание таблицы из реестра схемы целевой БД (schema_registry);
+            обязательно для таблиц вне ALLOWED_TABLES
 
     Returns:
         Обновлённое множество seen_hashes
     """
-    # Проверка имени таблицы (защита от SQL injection)
-    if table_name not in ALLOWED_TABLES:
+    # Проверка имени таблицы (защита от SQL injection): основные таблицы
+    # или таблицы, найденные в схеме целевой БД
+    if table_name not in ALLOWED_TABLES and (table_info is None or table_info.name != table_name):
         raise ValueError(f"Недопустимое имя таблицы: {table_name}")
 
     src_cursor = src_conn.cursor()
     dst_cursor = dst_conn.cursor()
 
     try:
-        src_cursor.execute(f'SELECT * FROM "{table_name}"')
+        if where:
+            src_cursor.execute(f'SELECT * FROM "{table_name}" WHERE {where}', where_params or {})
+        else:
+            src_cursor.execute(f'SELECT * FROM "{table_name}"')
         columns = [description[0] for description in src_cursor.description]
-        records = src_cursor.fetchall()
     except sqlite3.OperationalError:
         logger.debug(f"  {table_name}: таблица не найдена в исходной базе")
         return seen_hashes
 
     unique_records_added = 0
-    local_id_mapping: Dict[int, int] = {}  # old_id -> new_id для текущей таблицы
+    local_id_mapping = IdMap()  # old_id -> new_id для текущей таблицы
+    plan = _compile_row_plan(table_name, tuple(columns), table_info)
 
-    # Определяем первичный ключ для таблицы
-    pk_column = PRIMARY_KEYS.get(table_name)
+    # Исключаем первичный ключ из вставки, чтобы SQLite назначал новые ID
+    # Это предотвращает конфликты при INSERT OR IGNORE когда PK уже существует
+    pk_index = plan.pk_index
+    pk_column = columns[pk_index] if pk_index is not None else None
+    without_pk = plan.without_pk
+    insert_columns = [col for i, col in enumerate(columns) if i != pk_index]
 
-    for record in records:
-        record_dict = dict(zip(columns, record))
-        record_hash = generate_record_hash(table_name, record_dict)
-
-        if record_hash not in seen_hashes:
-            seen_hashes.add(record_hash)
-
-            # Создаём mutable копию записи
-            record_list = list(record)
-
-            # Для TagMap нужно обновить TagId согласно маппингу
-            if table_name == 'TagMap' and id_mapping and 'Tag' in id_mapping:
-                tag_id_idx = columns.index('TagId') if 'TagId' in columns else -1
-                if tag_id_idx >= 0:
-                    old_tag_id = record_list[tag_id_idx]
-                    if old_tag_id and old_tag_id in id_mapping['Tag']:
-                        record_list[tag_id_idx] = id_mapping['Tag'][old_tag_id]
-
-            # Для BlockRange нужно обновить UserMarkId согласно маппингу
-            if table_name == 'BlockRange' and id_mapping and 'UserMark' in id_mapping:
-                user_mark_id_idx = columns.index('UserMarkId') if 'UserMarkId' in columns else -1
-                if user_mark_id_idx >= 0:
-                    old_user_mark_id = record_list[user_mark_id_idx]
-                    if old_user_mark_id and old_user_mark_id in id_mapping['UserMark']:
-                        record_list[user_mark_id_idx] = id_mapping['UserMark'][old_user_mark_id]
-
-            # Для Note нужно обновить LocationId и UserMarkId согласно маппингу
-            if table_name == 'Note':
-                if id_mapping and 'Location' in id_mapping:
-                    loc_idx = columns.index('LocationId') if 'LocationId' in columns else -1
-                    if loc_idx >= 0:
-                        old_loc_id = record_list[loc_idx]
-                        if old_loc_id and old_loc_id in id_mapping['Location']:
-                            record_list[loc_idx] = id_mapping['Location'][old_loc_id]
-                if id_mapping and 'UserMark' in id_mapping:
-                    um_idx = columns.index('UserMarkId') if 'UserMarkId' in columns else -1
-                    if um_idx >= 0 and record_list[um_idx] is not None:
-                        old_um_id = record_list[um_idx]
-                        if old_um_id and old_um_id in id_mapping['UserMark']:
-                            record_list[um_idx] = id_mapping['UserMark'][old_um_id]
-
-            # Для Bookmark нужно обновить LocationId
-            if table_name == 'Bookmark' and id_mapping and 'Location' in id_mapping:
-                loc_idx = columns.index('LocationId') if 'LocationId' in columns else -1
-                if loc_idx >= 0:
-                    old_loc_id = record_list[loc_idx]
-                    if old_loc_id and old_loc_id in id_mapping['Location']:
-                        record_list[loc_idx] = id_mapping['Location'][old_loc_id]
-
-            record = tuple(record_list)
-
-            # Исключаем первичный ключ из вставки, чтобы SQLite назначал новые ID
-            # Это предотвращает конфликты при INSERT OR IGNORE когда PK уже существует
-            if pk_column and pk_column in columns:
-                pk_index = columns.index(pk_column)
-                insert_columns = [col for col in columns if col != pk_column]
-                insert_record = record[:pk_index] + record[pk_index + 1:]
-            else:
-                insert_columns = columns
-                insert_record = record
+    placeholders = ', '.join(['?' for _ in insert_columns])
+    column_names = ', '.join([f'"{col}"' for col in insert_columns])
+    sql = f'INSERT OR IGNORE INTO "{table_name}" ({column_names}) VALUES ({placeholders})'
+    # Запись, отброшенная INSERT OR IGNORE, сопоставляется со строкой с тем же UNIQUE-ключом
+    unique_lookup = _unique_row_lookup(dst_conn, table_name, columns, pk_column) if pk_column else None
 
-            placeholders = ', '.join(['?' for _ in insert_columns])
-            column_names = ', '.join([f'"{col}"' for col in insert_columns])
-            sql = f'INSERT OR IGNORE INTO "{table_name}" ({column_names}) VALUES ({placeholders})'
+    # Upsert по GUID: индекс в памяти вместо поиска по таблице на каждую запись
+    guid_column = GUID_COLUMNS.get(table_name)
+    guid_index_position = None
+    if guid_column in columns and pk_index is not None:
+        guid_index_position = columns.index(guid_column)
+        version_column = _guid_version_column(table_name, columns)
+        version_index = columns.index(version_column) if version_column else None
+        if guid_index is None:
+            guid_index = {}
+        if table_name not in guid_index:
+            guid_index[table_name] = _load_guid_index(dst_conn, table_name)
+        table_guids = guid_index[table_name]
+        assignments = ', '.join(f'"{col}" = ?' for col in insert_columns)
+        update_sql = f'UPDATE "{table_name}" SET {assignments} WHERE "{pk_column}" = ?'
+    records_updated = 0
+    records_skipped = 0
+    records_ignored = 0
 
-            try:
-                dst_cursor.execute(sql, insert_record)
-
-                # Получаем ID вставленной записи (или существующей)
-                if pk_column:
-                    old_id = record_dict.get(pk_column)
-                    # Пытаемся получить lastrowid
-                    new_id = dst_cursor.lastrowid
-
-                    # Если lastrowid None, значит запись уже существовала - ищем её
-                    if new_id is None and old_id is not None:
-                        # Находим существующую запись по уникальным полям (хэшу)
-                        dst_cursor.execute(
-                            f'SELECT "{pk_column}" FROM "{table_name}" WHERE rowid = last_insert_rowid()'
-                        )
-                        row = dst_cursor.fetchone()
-                        if row:
-                            new_id = row[0]
-
-                    if old_id and new_id and old_id != new_id:
-                        local_id_mapping[old_id] = new_id
-
-                unique_records_added += 1
-
-            except sqlite3.Error as e:
-                # Игнорируем ошибки, связанные с несовместимыми столбцами
-                if "has no column" in str(e):
-                    continue
+    if pipeline_depth > 0:
+        batches = _iter_in_thread(_iter_keyed_batches(src_cursor, plan, id_mapping, batch_size), pipeline_depth)
+        keyed_records = (keyed for batch in batches for keyed in batch)
+    else:
+        keyed_records = (
+            keyed for batch in _iter_keyed_batches(src_cursor, plan, id_mapping, batch_size) for keyed in batch
+        )
+    for source_record, record, record_hash in keyed_records:
+        guid = record[guid_index_position] if guid_index_position is not None else None
+        existing = table_guids.get(guid) if guid else None
+        if existing is None and record_hash in seen_hashes:
+            if stats is not None:
+                stats.duplicates += 1
+            if seen_ids is not None and pk_index is not None:
+                old_id = source_record[pk_index]
+                existing_id = seen_ids.get(record_hash)
+                if old_id and existing_id and old_id != existing_id:
+                    local_id_mapping[old_id] = existing_id
+            continue
+        seen_hashes.add(record_hash)
+
+        insert_record = without_pk(record)
+
+        try:
+            if guid:
+                version = record[version_index] if version_index is not None else None
+            if existing is not None:
+                existing_id, existing_version = existing
+                if _is_newer(version, existing_version):
+                    dst_cursor.execute(update_sql, insert_record + (existing_id,))
+                    table_guids[guid] = (existing_id, version)
+                    records_updated += 1
                 else:
-                    logger.warning(f"Ошибка при вставке в {table_name}: {e}")
-                    logger.debug(f"Значения: {insert_record}")
+                    records_skipped += 1
+                old_id = source_record[pk_index]
+                if old_id and old_id != existing_id:
+                    local_id_mapping[old_id] = existing_id
+                if seen_ids is not None:
+                    seen_ids[record_hash] = existing_id
+                continue
+
+            dst_cursor.execute(sql, insert_record)
+            if dst_cursor.rowcount == 0:
+                # INSERT OR IGNORE не вставил запись (ограничение уникальности): старый ID
+                # сопоставляется с уже занявшей ключ строкой, иначе дочерние записи
+                # ссылались бы на несуществующий ID
+                records_ignored += 1
+                new_id = None
+                mapped_id = unique_lookup(record) if unique_lookup else None
+            else:
+                new_id = mapped_id = dst_cursor.lastrowid
+
+            # Сопоставляем старый ID с ID вставленной (или совпавшей по ключу) записи
+            if pk_column:
+                old_id = source_record[pk_index] if pk_index is not None else None
+                if old_id and mapped_id and old_id != mapped_id:
+                    local_id_mapping[old_id] = mapped_id
+                if guid and new_id:
+                    table_guids[guid] = (new_id, version)
+                if seen_ids is not None and mapped_id:
+                    seen_ids[record_hash] = mapped_id
+
+            unique_records_added += 1
+
+        except sqlite3.Error as e:
+            # Игнорируем ошибки, связанные с несовместимыми столбцами
+            if "has no column" in str(e):
+                continue
+            else:
+                logger.warning(f"Ошибка при вставке в {table_name}: {e}")
+                logger.debug(f"Значения: {insert_record}")
 
     logger.debug(f"  {table_name}: добавлено {unique_records_added} уникальных записей")
+    if records_updated:
+        logger.debug(f"  {table_name}: обновлено {records_updated} записей до более новой версии")
+
+    if stats is not None:
+        stats.inserted += unique_records_added - records_ignored
+        stats.updated += records_updated
+        stats.duplicates += records_skipped + records_ignored
 
-    # Сохраняем маппинг в общий dict
-    if id_mapping is not None and local_id_mapping:
+    # Сохраняем маппинг в общий dict (маппинг относится к текущему источнику)
+    if id_mapping is not None:
         id_mapping[table_name] = local_id_mapping
 
     return seen_hashes
 
 
-def create_merged_db(archive_paths: List[Path], output_path: Path, verbose: bool = False) -> Path:
-    """Создание объединённой базы данных с транзакциями и откатом при ошибках
+def _seed_seen_hashes(
+    src_conn: sqlite3.Connection,
+    table_name: str,
+    seen_hashes: Set[str],
+    stats: TableMergeStats,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    seen_ids: Optional[Dict[str, int]] = None,
+    table_info: Optional[TableInfo] = None
+) -> None:
+    """Учёт записей базы, уже скопированной в объединённую целиком
 
-    Args:
-        archive_paths: Список путей к архивам .jwlibrary
-        output_path: Путь для выходной базы данных
-        verbose: Включить подробный вывод
+    Записи только добавляются в seen_hashes (и seen_ids - с их же ID):
+    их повторное копирование продублировало бы каждую запись первого архива.
+    """
+    src_cursor = src_conn.cursor()
+    try:
+        src_cursor.execute(f'SELECT * FROM "{table_name}"')
+    except sqlite3.OperationalError:
+        return
+    plan = _compile_row_plan(table_name, tuple(description[0] for description in src_cursor.description), table_info)
+    pk_index = plan.pk_index
+    for record, record_hash in _iter_keyed_records(iter_fetchmany(src_cursor, batch_size), plan):
+        seen_hashes.add(record_hash)
+        if seen_ids is not None and pk_index is not None:
+            seen_ids.setdefault(record_hash, record[pk_index])
+        stats.base += 1
 
-    Returns:
-        Путь к созданной базе данных
 
-    Raises:
-        RuntimeError: При критической ошибке во время слияния
-    """
-    # Используем структуру из первого архива
-    first_archive = archive_paths[0]
-    with tempfile.TemporaryDirectory() as temp_dir:
-        first_db_path, _ = extract_from_archive(first_archive, temp_dir)
-        shutil.copyfile(first_db_path, output_path)
+def _file_digest(path: Path) -> Tuple[str, int]:
+    """SHA-256 (hex) и размер файла, чтение порциями"""
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
 
-    # Открываем объединённую базу данных
-    merged_conn = sqlite3.connect(str(output_path))
 
-    # Отключаем внешние ключи на время импорта (включаем только в конце)
-    merged_conn.execute("PRAGMA foreign_keys = OFF")
+def _extract_to_temp(archive_path: Path) -> Tuple[tempfile.TemporaryDirectory, Path]:
+    """Извлечение архива в новую временную директорию (удаляет вызывающий код)"""
+    temp_dir = tempfile.TemporaryDirectory()
+    try:
+        db_path, _ = extract_from_archive(archive_path, temp_dir.name)
+    except BaseException:
+        temp_dir.cleanup()
+        raise
+    return temp_dir, db_path
 
-    # Множества для отслеживания уникальных хэшей
-    seen_hashes: Dict[str, Set[str]] = {
-        'Note': set(),
-        'UserMark': set(),
-        'Location': set(),
-        'Tag': set(),
-        'TagMap': set(),
-        'Bookmark': set(),
-        'BlockRange': set()
-    }
 
-    # Маппинг ID для связанных таблиц
-    id_mapping: Dict[str, Dict[int, int]] = {}
+def _iter_archive_dbs(archive_paths: List[Path], prefetch: bool = False) -> Iterator[Tuple[str, sqlite3.Connection]]:
+    """Поочерёдное извлечение архивов во временные директории
 
-    try:
-        # Обрабатываем каждый архив
-        archive_iterator = tqdm(archive_paths, desc="Архивы", disable=not verbose)
-        for i, archive_path in enumerate(archive_iterator):
-            logger.debug(f"Обработка архива {i+1}/{len(archive_paths)}: {archive_path.name}")
+    С prefetch следующий архив распаковывается в фоновом потоке, пока
+    обрабатывается текущий (zlib отпускает GIL); на диске одновременно
+    не больше двух распакованных баз.
 
+    Yields:
+        (имя архива, подключение к его userData.db); подключение
+        закрывается, а временная директория удаляется после перехода
+        к следующему архиву
+    """
+    if not prefetch:
+        for archive_path in archive_paths:
             with tempfile.TemporaryDirectory() as temp_dir:
                 db_path, _ = extract_from_archive(archive_path, temp_dir)
                 src_conn = sqlite3.connect(str(db_path))
+                try:
+                    yield archive_path.name, src_conn
+                finally:
+                    src_conn.close()
+        return
 
-                # Копируем уникальные записи из каждой таблицы в правильном порядке
-                table_iterator = tqdm(TABLE_ORDER, desc=f"Таблицы ({archive_path.name[:30]})", disable=not verbose, leave=False)
-                for table_name in table_iterator:
-                    seen_hashes[table_name] = copy_unique_records(
-                        src_conn, merged_conn, table_name, seen_hashes[table_name], id_mapping
-                    )
-                    if verbose:
-                        table_iterator.set_postfix(**{table_name: len(seen_hashes[table_name])})
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='jwl-unzip') as executor:
+        pending = executor.submit(_extract_to_temp, archive_paths[0]) if archive_paths else None
+        try:
+            for i, archive_path in enumerate(archive_paths):
+                temp_dir, db_path = pending.result()
+                pending = executor.submit(_extract_to_temp, archive_paths[i + 1]) if i + 1 < len(archive_paths) else None
+                try:
+                    src_conn = sqlite3.connect(str(db_path), check_same_thread=False)
+                    try:
+                        yield archive_path.name, src_conn
+                    finally:
+                        src_conn.close()
+                finally:
+                    temp_dir.cleanup()
+        finally:
+            if pending is not None and pending.exception() is None:
+                pending.result()[0].cleanup()
 
-                src_conn.close()
 
-        # Обновляем LastModified
+# Минимальный интервал между промежуточными событиями прогресса, секунды
+PROGRESS_MIN_INTERVAL = 0.5
+
+
+class JsonlProgress:
+    """Поток событий прогресса в формате JSON lines для внешних оркестраторов
+
+    Каждое событие - одна строка JSON с полями event, elapsed, archives_done,
+    archives_total, rows, rows_per_sec, bytes и eta (секунды, null пока
+    неизвестно). События по таблицам прореживаются до одного в
+    min_interval секунд; start, archive и done пишутся всегда. Счётчики
+    обновляются только между таблицами, поэтому горячий цикл копирования
+    записей не затрагивается.
+    """
+
+    def __init__(self, stream: TextIO, min_interval: float = PROGRESS_MIN_INTERVAL):
+        self.stream: Optional[TextIO] = stream
+        self.min_interval = min_interval
+        self.started = time.monotonic()
+        self._last_emit = float('-inf')
+        self.archives_total = 0
+        self.archives_done = 0
+        self.tables_total = len(TABLE_ORDER)
+        self.tables_done = 0
+        self.rows = 0
+        self.bytes = 0
+
+    @classmethod
+    def from_fd(cls, fd: int, min_interval: float = PROGRESS_MIN_INTERVAL) -> 'JsonlProgress':
+        """Поток событий в открытый файловый дескриптор (дескриптор не закрывается)"""
+        return cls(os.fdopen(fd, 'w', buffering=1, encoding='utf-8', closefd=False), min_interval)
+
+    def start(self, archives_total: int, tables_total: int = len(TABLE_ORDER)) -> None:
+        self.started = time.monotonic()
+        self.archives_total = archives_total
+        self.tables_total = tables_total
+        self._emit('start', force=True)
+
+    def table(self, archive: str, table: str, rows: int) -> None:
+        self.tables_done += 1
+        self.rows += rows
+        self._emit('table', archive=archive, table=table, table_rows=rows)
+
+    def archive(self, archive: str, db_bytes: int) -> None:
+        self.archives_done += 1
+        self.tables_done = 0
+        self.bytes += db_bytes
+        self._emit('archive', force=True, archive=archive)
+
+    def finish(self) -> None:
+        self._emit('done', force=True)
+
+    def cache(self, hit: bool, digest: str) -> None:
+        """Результат поиска в кэше результатов"""
+        self._emit('cache', force=True, hit=hit, digest=digest)
+
+    def _emit(self, event: str, force: bool = False, **fields) -> None:
+        now = time.monotonic()
+        if not force and now - self._last_emit < self.min_interval:
+            return
+        if self.stream is None:
+            return
+        self._last_emit = now
+
+        elapsed = now - self.started
+        fraction = 0.0
+        if self.archives_total:
+            fraction = (self.archives_done + self.tables_done / self.tables_total) / self.archives_total
+        eta = elapsed * (1 - fraction) / fraction if fraction > 0 else None
+        record = {
+            'event': event,
+            'elapsed': round(elapsed, 3),
+            'archives_done': self.archives_done,
+            'archives_total': self.archives_total,
+            'rows': self.rows,
+            'rows_per_sec': round(self.rows / elapsed, 1) if elapsed > 0 else None,
+            'bytes': self.bytes,
+            'eta': round(eta, 3) if eta is not None else None,
+            **fields
+        }
         try:
-            merged_conn.execute("UPDATE LastModified SET value = ?", (datetime.now().isoformat().split('.')[0] + "+00:00",))
-        except sqlite3.OperationalError:
-            # Если таблица LastModified не существует, пропускаем
-            pass
+            self.stream.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self.stream.flush()
+        except (OSError, ValueError) as e:
+            # Читатель закрыл канал - слияние продолжается без событий
+            logger.warning(f"Поток прогресса недоступен, события отключены: {e}")
+            self.stream = None
 
-        # Включаем внешние ключи и проверяем целостность
-        merged_conn.execute("PRAGMA foreign_keys = ON")
-        merged_conn.commit()
-        logger.info(f"Объединённая база данных создана: {output_path}")
-        return output_path
 
-    except Exception as e:
-        # Откат при ошибке
-        merged_conn.rollback()
-        merged_conn.close()
-        raise RuntimeError(f"Ошибка при создании объединённой базы: {e}")
+def _db_size(conn: sqlite3.Connection) -> int:
+    """Размер базы данных в байтах по числу и размеру страниц"""
+    page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    return page_count * page_size
 
-    finally:
-        merged_conn.close()
 
+def _merge_sources(
+    merged_conn: sqlite3.Connection,
+    sources: Iterable[Tuple[str, sqlite3.Connection]],
+    total: int,
+    verbose: bool = False,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    progress: Optional[JsonlProgress] = None,
+    base_included: bool = False,
+    merge_filter: Optional[MergeFilter] = None,
+    skip_tables: Optional[Dict[str, FrozenSet[str]]] = None,
+    pipeline_depth: int = PIPELINE_DEPTH
+) -> MergeResult:
+    """Слияние записей из подключений-источников в объединённую базу
 
-def create_manifest_from_archives(archive_paths, output_db_path):
-    """Создание нового манифеста на основе объединённой базы данных"""
-    # Используем первый манифест как шаблон
-    with tempfile.TemporaryDirectory() as temp_dir:
-        _, manifest_path = extract_from_archive(archive_paths[0], temp_dir)
-        with open(manifest_path, 'r', encoding='utf-8') as f:
-            manifest = json.load(f)
-    
-    # Обновляем информацию в манифесте
-    with open(output_db_path, 'rb') as f:
-        db_hash = hashlib.sha256(f.read()).hexdigest()
-    
-    # Подсчитываем количество пометок
-    conn = sqlite3.connect(output_db_path)
-    cursor = conn.cursor()
+    Транзакцией управляет вызывающий код: при исключении нужно
+    выполнить rollback на merged_conn.
+
+    Args:
+        merged_conn: Подключение к объединённой базе
+        sources: Пары (имя архива, подключение к его базе)
+        total: Количество источников (для лога и прогресс-бара)
+        verbose: Включить подробный вывод
+        batch_size: Количество записей, читаемых из источника за раз
+        progress: Поток событий прогресса (по архивам и таблицам)
+        base_included: merged_conn - копия базы первого источника; его записи
+            только учитываются, а не копируются повторно
+        merge_filter: Копировать только выбранные таблицы и записи
+        skip_tables: {имя архива: таблицы без новых записей} (см. plan_subsumed)
+        pipeline_depth: Порций записей, читаемых и хэшируемых заранее в фоновом
+            потоке (0 - последовательно); подключения-источники должны быть
+            открыты с check_same_thread=False
+
+    Returns:
+        MergeResult со счётчиками по таблицам и временем обработки архивов
+    """
+    # Таблицы схемы объединённой базы, включая не входящие в TABLE_ORDER
+    registry = schema_registry(merged_conn)
+    all_tables = TABLE_ORDER + [table_name for table_name in registry.order if table_name not in TABLE_ORDER]
+    result = MergeResult(archives=total, table_stats={table: TableMergeStats() for table in all_tables})
+
+    # Отключаем внешние ключи на время импорта (включаем только в конце)
+    merged_conn.execute("PRAGMA foreign_keys = OFF")
+
+    # Множества для отслеживания уникальных хэшей
+    seen_hashes: Dict[str, Set[str]] = {table_name: set() for table_name in all_tables}
+
+    # ID записей объединённой базы по хэшу: дубликаты сопоставляются с ними
+    seen_ids: Dict[str, Dict[str, int]] = {table_name: {} for table_name in all_tables}
+
+    # Индекс GUID объединённой базы (Note, UserMark), общий для всех архивов
+    guid_index: GuidIndex = {}
+
+    tables = merge_filter.selected_tables(registry) if merge_filter else list(registry.order)
+    where_params = merge_filter.params() if merge_filter else None
+
+    if progress:
+        progress.start(total, len(tables))
+
+    # Обрабатываем каждый архив
+    archive_iterator = tqdm(sources, desc="Архивы", total=total, disable=not verbose)
+    for i, (name, src_conn) in enumerate(archive_iterator):
+        logger.debug(f"Обработка архива {i+1}/{total}: {name}")
+        archive_start = time.perf_counter()
+        where_clauses = merge_filter.where_clauses(src_conn) if merge_filter else {}
+        # Маппинг ID для связанных таблиц: свой для каждого архива
+        id_mapping: Dict[str, IdMap] = {}
+
+        # Копируем уникальные записи из каждой таблицы в правильном порядке
+        table_iterator = tqdm(tables, desc=f"Таблицы ({name[:30]})", disable=not verbose, leave=False)
+        archive_skip = skip_tables.get(name, frozenset()) if skip_tables else frozenset()
+        for table_name in table_iterator:
+            table_stats = result.table_stats[table_name]
+            processed_before = table_stats.processed
+            table_info = registry.tables.get(table_name)
+            if table_name in archive_skip and not (i == 0 and base_included):
+                logger.debug(f"  {table_name}: нет новых записей по индексу ключей, пропущена")
+            elif i == 0 and base_included:
+                _seed_seen_hashes(
+                    src_conn, table_name, seen_hashes[table_name], table_stats, batch_size, seen_ids[table_name],
+                    table_info
+                )
+            else:
+                seen_hashes[table_name] = copy_unique_records(
+                    src_conn, merged_conn, table_name, seen_hashes[table_name], id_mapping, batch_size,
+                    guid_index, table_stats, where_clauses.get(table_name), where_params, pipeline_depth,
+                    seen_ids[table_name], table_info
+                )
+            if verbose:
+                table_iterator.set_postfix(**{table_name: len(seen_hashes[table_name])})
+            if progress:
+                # Прочитанные записи, а не новые: на архиве из одних дубликатов счётчик тоже растёт
+                progress.table(name, table_name, table_stats.processed - processed_before)
+        if progress:
+            progress.archive(name, _db_size(src_conn))
+        result.archive_timings[name] = time.perf_counter() - archive_start
+
+    # Обновляем LastModified
     try:
-        cursor.execute("SELECT COUNT(*) FROM UserMark")
-        user_mark_count = cursor.fetchone()[0]
+        merged_conn.execute("UPDATE LastModified SET value = ?", (datetime.now().isoformat().split('.')[0] + "+00:00",))
     except sqlite3.OperationalError:
-        user_mark_count = 0
-    conn.close()
-    
-    # Обновляем манифест
+        # Если таблица LastModified не существует, пропускаем
+        pass
+
+    # Включаем внешние ключи и проверяем целостность
+    merged_conn.execute("PRAGMA foreign_keys = ON")
+    merged_conn.commit()
+
+    if progress:
+        progress.finish()
+
+    return result
+
+
+@dataclass
+class VerifyReport:
+    """Результат проверки объединённой базы (verify_merged_db)
+
+    integrity - строки PRAGMA quick_check (['ok'] для целой базы);
+    orphans - оставшиеся нарушения внешних ключей {(таблица, столбец): записей};
+    repaired - исправленные записи {(таблица, столбец): записей};
+    count_mismatches - {таблица: (по счётчикам слияния, в базе)}.
+    """
+    integrity: List[str] = field(default_factory=list)
+    orphans: Dict[Tuple[str, str], int] = field(default_factory=dict)
+    repaired: Dict[Tuple[str, str], int] = field(default_factory=dict)
+    count_mismatches: Dict[str, Tuple[int, int]] = field(default_factory=dict)
+    duration: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return self.integrity == ['ok'] and not self.orphans and not self.count_mismatches
+
+
+def _fk_violations(conn: sqlite3.Connection) -> Dict[Tuple[str, int], int]:
+    """Нарушения внешних ключей одним проходом: {(таблица, id ключа): записей}"""
+    return {
+        (table_name, fk_id): count
+        for table_name, fk_id, count in conn.execute(
+            'SELECT "table", fkid, COUNT(*) FROM pragma_foreign_key_check GROUP BY 1, 2'
+        )
+    }
+
+
+def _fk_column(conn: sqlite3.Connection, table_name: str, fk_id: int) -> Tuple[str, bool]:
+    """Столбец внешнего ключа и допускает ли он NULL"""
+    column = conn.execute(
+        'SELECT "from" FROM pragma_foreign_key_list(?) WHERE id = ? ORDER BY seq', (table_name, fk_id)
+    ).fetchone()[0]
+    notnull = conn.execute(
+        'SELECT "notnull" FROM pragma_table_info(?) WHERE name = ?', (table_name, column)
+    ).fetchone()[0]
+    return column, not notnull
+
+
+def verify_merged_db(
+    conn: sqlite3.Connection,
+    result: Optional[MergeResult] = None,
+    repair: bool = False
+) -> VerifyReport:
+    """Проверка объединённой базы после слияния
+
+    Проверки выполняются целиком в SQLite, без построчного обхода в Python:
+    PRAGMA foreign_key_check (одним запросом по всем таблицам), PRAGMA
+    quick_check и сверка COUNT(*) по таблицам со счётчиками result.
+
+    С repair записи-сироты исправляются множественными запросами: ссылка,
+    допускающая NULL (Note.UserMarkId), обнуляется, остальные записи
+    удаляются. Удаление может оставить сиротами дочерние записи
+    (UserMark → BlockRange), поэтому проходы повторяются до чистой базы.
+    Удалённые записи учитываются в result.table_stats (removed).
+
+    Args:
+        conn: Подключение к объединённой базе
+        result: Счётчики слияния для сверки; отчёт сохраняется в result.verify
+        repair: Исправить записи-сироты
+
+    Returns:
+        VerifyReport
+    """
+    start = time.perf_counter()
+    report = VerifyReport()
+
+    if result is not None:
+        for table_name, expected in result.tables.items():
+            if not _table_columns(conn, table_name):
+                continue
+            actual = conn.execute(f'SELECT COUNT(*) FROM "{table_name}"').fetchone()[0]
+            if actual != expected:
+                report.count_mismatches[table_name] = (expected, actual)
+
+    violations = _fk_violations(conn)
+    if repair and violations:
+        # Внешние ключи отключаются вне транзакции, иначе PRAGMA не действует
+        conn.commit()
+        conn.execute("PRAGMA foreign_keys = OFF")
+        tables_count = conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table'").fetchone()[0]
+        for _ in range(tables_count + 1):
+            if not violations:
+                break
+            for (table_name, fk_id), count in violations.items():
+                column, nullable = _fk_column(conn, table_name, fk_id)
+                orphans = 'rowid IN (SELECT rowid FROM pragma_foreign_key_check(?) WHERE fkid = ?)'
+                if nullable:
+                    conn.execute(f'UPDATE "{table_name}" SET "{column}" = NULL WHERE {orphans}', (table_name, fk_id))
+                else:
+                    deleted = conn.execute(f'DELETE FROM "{table_name}" WHERE {orphans}', (table_name, fk_id)).rowcount
+                    if result is not None and table_name in result.table_stats:
+                        result.table_stats[table_name].removed += deleted
+                key = (table_name, column)
+                report.repaired[key] = report.repaired.get(key, 0) + count
+            violations = _fk_violations(conn)
+        conn.commit()
+        conn.execute("PRAGMA foreign_keys = ON")
+    for (table_name, fk_id), count in violations.items():
+        report.orphans[(table_name, _fk_column(conn, table_name, fk_id)[0])] = count
+
+    report.integrity = [row[0] for row in conn.execute("PRAGMA quick_check")]
+    report.duration = time.perf_counter() - start
+    if result is not None:
+        result.verify = report
+
+    for (table_name, column), count in report.repaired.items():
+        logger.info(f"Исправлено записей-сирот {table_name}.{column}: {count}")
+    for (table_name, column), count in report.orphans.items():
+        logger.warning(f"⚠ {table_name}.{column}: {count} ссылок на несуществующие записи "
+                       f"(исправить: --repair-orphans)")
+    for table_name, (expected, actual) in report.count_mismatches.items():
+        logger.warning(f"⚠ {table_name}: по счётчикам слияния {expected} записей, в базе {actual}")
+    if report.integrity != ['ok']:
+        logger.error(f"❌ quick_check: {'; '.join(report.integrity[:5])}")
+    logger.debug(f"Проверка объединённой базы: {report.duration:.3f} с")
+    return report
+
+
+def create_merged_db(
+    archive_paths: List[Path],
+    output_path: Path,
+    verbose: bool = False,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    progress: Optional[JsonlProgress] = None,
+    merge_filter: Optional[MergeFilter] = None,
+    skip_subsumed: bool = False,
+    index_dir: Optional[Path] = None,
+    pipeline_depth: int = PIPELINE_DEPTH,
+    workers: int = 1,
+    verify: bool = True,
+    repair_orphans: bool = False,
+    digest: bool = True,
+    skip_tables: Optional[Dict[str, FrozenSet[str]]] = None
+) -> MergeResult:
+    """Создание объединённой базы данных с транзакциями и откатом при ошибках
+
+    Обработка идёт конвейером из трёх стадий: распаковка следующего архива,
+    чтение и хэширование записей (фоновые потоки с ограниченными очередями)
+    и вставка в объединённую базу (текущий поток). pipeline_depth=0
+    отключает потоки. С workers > 1 слияние идёт деревом в процессах
+    (см. tree_merge).
+
+    С активным merge_filter база первого архива служит только схемой:
+    все таблицы реестра схемы очищаются, и все архивы (включая первый) копируются
+    через фильтр. Если все запрошенные таблицы ограничены датой, архивы,
+    изменённые по манифесту раньше since, пропускаются без распаковки.
+
+    С skip_subsumed таблицы и целые архивы, все ключи которых уже есть в
+    других архивах, пропускаются по индексам ключей (см. plan_subsumed);
+    при слиянии деревом план передаётся процессам групп.
+
+    После слияния база проверяется (verify_merged_db): внешние ключи,
+    quick_check и сверка счётчиков; отчёт - в result.verify.
+
+    Args:
+        archive_paths: Список путей к архивам .jwlibrary
+        output_path: Путь для выходной базы данных
+        verbose: Включить подробный вывод
+        batch_size: Количество записей, читаемых из исходной таблицы за раз
+        progress: Поток событий прогресса (по архивам и таблицам)
+        merge_filter: Фильтр таблиц и дат (см. MergeFilter)
+        skip_subsumed: Пропускать таблицы и архивы без новых записей
+        index_dir: Директория файлов индекса ключей (по умолчанию рядом с архивами)
+        pipeline_depth: Порций записей в очереди между чтением и вставкой
+        workers: Количество процессов для слияния деревом (1 - последовательно)
+        verify: Проверить объединённую базу после слияния
+        repair_orphans: Исправить записи-сироты, найденные проверкой
+        digest: Посчитать SHA-256 базы; без него db_hash пуст, и хэш считает
+            create_backup_archive при упаковке (база читается один раз)
+        skip_tables: Готовый план пропуска {имя архива: таблицы без новых
+            записей}; его передаёт группам tree_merge, с skip_subsumed план
+            строится заново
+
+    Returns:
+        MergeResult: путь, счётчики по таблицам, время этапов и SHA-256 базы
+
+    Raises:
+        RuntimeError: При критической ошибке во время слияния или если
+            объединённая база не прошла quick_check
+    """
+    start = time.perf_counter()
+
+    if merge_filter is not None and not merge_filter.active:
+        merge_filter = None
+    if skip_subsumed and merge_filter is not None:
+        logger.warning("--skip-subsumed не применяется вместе с фильтром слияния: индекс ключей не учитывает фильтр")
+    if skip_subsumed and merge_filter is None:
+        plan = plan_subsumed(archive_paths, index_dir)
+        kept = [archive for archive in archive_paths if not plan.drops(archive)]
+        for archive in archive_paths:
+            if archive not in kept:
+                logger.info(f"Архив {archive.name} не содержит новых записей, пропущен")
+        archive_paths = kept or archive_paths[-1:]
+        skip_tables = {archive.name: plan[archive] for archive in archive_paths}
+
+    if workers > 1 and len(archive_paths) > 1:
+        result = tree_merge(
+            archive_paths, output_path, workers, verbose, batch_size, progress, merge_filter, pipeline_depth, digest,
+            skip_tables
+        )
+        if verify:
+            verify_start = time.perf_counter()
+            merged_conn = sqlite3.connect(str(output_path))
+            try:
+                report = verify_merged_db(merged_conn, result, repair_orphans)
+            finally:
+                merged_conn.close()
+            if report.integrity != ['ok']:
+                raise RuntimeError(f"Объединённая база повреждена: {report.integrity[0]}")
+            if report.repaired and digest:
+                result.db_hash, result.db_bytes = _file_digest(output_path)
+            result.timings['verify'] = time.perf_counter() - verify_start
+        return result
+
+    # Используем структуру из первого архива
+    first_archive = archive_paths[0]
+    with tempfile.TemporaryDirectory() as temp_dir:
+        first_db_path, _ = extract_from_archive(first_archive, temp_dir)
+        shutil.copyfile(first_db_path, output_path)
+    copied = time.perf_counter()
+
+    # Открываем объединённую базу данных
+    merged_conn = sqlite3.connect(str(output_path))
+
+    try:
+        if merge_filter is not None:
+            if merge_filter.only_dated(merged_conn):
+                kept = []
+                for archive_path in archive_paths:
+                    if merge_filter.skips_archive(peek_archive(archive_path).created):
+                        logger.info(f"Архив {archive_path.name} изменён раньше {merge_filter.since}, пропущен")
+                    else:
+                        kept.append(archive_path)
+                archive_paths = kept
+            # Очищаются все таблицы реестра, а не только TABLE_ORDER: иначе записи первого
+            # архива в InputField, PlaylistItem и т.п. ссылались бы на удалённые записи
+            for table_name in schema_registry(merged_conn).order:
+                merged_conn.execute(f'DELETE FROM "{table_name}"')
+            merged_conn.commit()
+        result = _merge_sources(
+            merged_conn, _iter_archive_dbs(archive_paths, prefetch=pipeline_depth > 0), len(archive_paths),
+            verbose, batch_size, progress, base_included=merge_filter is None, merge_filter=merge_filter,
+            skip_tables=skip_tables, pipeline_depth=pipeline_depth
+        )
+        if merge_filter is not None:
+            # Освобождаем страницы очищенных таблиц первого архива
+            merged_conn.execute("VACUUM")
+        merged = time.perf_counter()
+        if verify:
+            report = verify_merged_db(merged_conn, result, repair_orphans)
+            if report.integrity != ['ok']:
+                raise RuntimeError(f"Объединённая база повреждена: {report.integrity[0]}")
+    except Exception as e:
+        # Откат при ошибке
+        merged_conn.rollback()
+        raise RuntimeError(f"Ошибка при создании объединённой базы: {e}")
+    finally:
+        merged_conn.close()
+    verified = time.perf_counter()
+
+    result.path = output_path
+    if digest:
+        result.db_hash, result.db_bytes = _file_digest(output_path)
+    else:
+        result.db_bytes = output_path.stat().st_size
+    finished = time.perf_counter()
+    result.timings = {'copy': copied - start, 'merge': merged - copied, 'verify': verified - merged}
+    if digest:
+        result.timings['digest'] = finished - verified
+    result.duration = finished - start
+
+    logger.info(f"Объединённая база данных создана: {output_path}")
+    return result
+
+
+def merge_databases(
+    db_paths: List[Path],
+    output_path: Path,
+    verbose: bool = False,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    pipeline_depth: int = PIPELINE_DEPTH,
+    digest: bool = True
+) -> MergeResult:
+    """Слияние уже распакованных баз, например промежуточных результатов tree_merge
+
+    Первая база копируется в output_path целиком и служит основой, остальные
+    сливаются в неё по тем же правилам, что и архивы в create_merged_db.
+    Без digest SHA-256 результата не считается (промежуточные базы).
+
+    Raises:
+        RuntimeError: При критической ошибке во время слияния
+    """
+    start = time.perf_counter()
+    shutil.copyfile(db_paths[0], output_path)
+
+    def sources() -> Iterator[Tuple[str, sqlite3.Connection]]:
+        for db_path in db_paths:
+            src_conn = sqlite3.connect(str(db_path), check_same_thread=False)
+            try:
+                yield Path(db_path).name, src_conn
+            finally:
+                src_conn.close()
+
+    merged_conn = sqlite3.connect(str(output_path))
+    try:
+        result = _merge_sources(
+            merged_conn, sources(), len(db_paths), verbose, batch_size, base_included=True,
+            pipeline_depth=pipeline_depth
+        )
+    except Exception as e:
+        merged_conn.rollback()
+        raise RuntimeError(f"Ошибка при слиянии баз данных: {e}")
+    finally:
+        merged_conn.close()
+
+    result.path = output_path
+    if digest:
+        result.db_hash, result.db_bytes = _file_digest(output_path)
+    else:
+        result.db_bytes = output_path.stat().st_size
+    result.duration = time.perf_counter() - start
+    return result
+
+
+def _tree_merge_leaf(
+    archive_paths: List[Path],
+    output_path: Path,
+    batch_size: int,
+    merge_filter: Optional[MergeFilter],
+    pipeline_depth: int,
+    skip_tables: Optional[Dict[str, FrozenSet[str]]] = None
+) -> MergeResult:
+    """Задание процесса: слияние группы архивов в промежуточную базу (проверяется только итоговая)"""
+    return create_merged_db(
+        archive_paths, output_path, batch_size=batch_size, merge_filter=merge_filter, pipeline_depth=pipeline_depth,
+        verify=False, digest=False, skip_tables=skip_tables
+    )
+
+
+def _tree_merge_node(db_paths: List[Path], output_path: Path, batch_size: int, pipeline_depth: int) -> MergeResult:
+    """Задание процесса: слияние пары промежуточных баз"""
+    result = merge_databases(
+        db_paths, output_path, batch_size=batch_size, pipeline_depth=pipeline_depth, digest=False
+    )
+    for db_path in db_paths:
+        os.unlink(db_path)
+    return result
+
+
+def _split_groups(items: List, count: int) -> List[List]:
+    """Разбиение списка на count непрерывных групп, размеры отличаются не больше чем на 1"""
+    size, extra = divmod(len(items), count)
+    groups, start = [], 0
+    for i in range(count):
+        end = start + size + (1 if i < extra else 0)
+        groups.append(items[start:end])
+        start = end
+    return groups
+
+
+def tree_merge(
+    archive_paths: List[Path],
+    output_path: Path,
+    workers: int,
+    verbose: bool = False,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    progress: Optional[JsonlProgress] = None,
+    merge_filter: Optional[MergeFilter] = None,
+    pipeline_depth: int = PIPELINE_DEPTH,
+    digest: bool = True,
+    skip_tables: Optional[Dict[str, FrozenSet[str]]] = None
+) -> MergeResult:
+    """Слияние деревом: группы архивов параллельно, затем попарно до одной базы
+
+    Архивы делятся на workers непрерывных групп, каждая сливается в
+    отдельном процессе в промежуточную базу (create_merged_db) с планом
+    пропуска skip_tables (см. plan_subsumed): покрытые таблицы архива
+    покрыты и в итоговой базе, в какой бы группе ни лежал покрывающий. Затем
+    соседние промежуточные базы сливаются попарно (merge_databases), пока
+    не останется одна. Порядок архивов сохраняется: левая база всегда
+    основа. Хэши записей считаются в пространстве ID объединённой базы,
+    поэтому набор ключей результата совпадает с последовательным слиянием.
+
+    Returns:
+        MergeResult итоговой базы; duplicates и updated просуммированы по
+        всем уровням дерева, archive_timings - время групп
+    """
+    start = time.perf_counter()
+    output_path = Path(output_path)
+    groups = _split_groups(list(archive_paths), min(workers, len(archive_paths)))
+    leaves: List[MergeResult] = []
+    nodes: List[MergeResult] = []
+
+    if progress:
+        progress.start(len(archive_paths))
+    with tempfile.TemporaryDirectory(dir=output_path.parent, prefix='.tree-merge-') as work_dir, \
+            concurrent.futures.ProcessPoolExecutor(max_workers=len(groups)) as executor:
+        work_path = Path(work_dir)
+        futures = {
+            executor.submit(
+                _tree_merge_leaf, group, work_path / f'0-{i}.db', batch_size, merge_filter, pipeline_depth,
+                skip_tables
+            ): group
+            for i, group in enumerate(groups)
+        }
+        for future in concurrent.futures.as_completed(futures):
+            leaf = future.result()
+            leaves.append(leaf)
+            logger.debug(f"Группа из {len(futures[future])} архивов слита за {leaf.duration:.2f} с")
+            if progress:
+                for archive in futures[future]:
+                    progress.archive(Path(archive).name, leaf.db_bytes // len(futures[future]))
+        leaves_done = time.perf_counter()
+
+        level_paths = [work_path / f'0-{i}.db' for i in range(len(groups))]
+        level = 0
+        while len(level_paths) > 1:
+            level += 1
+            pairs = [level_paths[i:i + 2] for i in range(0, len(level_paths), 2)]
+            next_paths = [work_path / f'{level}-{i}.db' if len(pair) == 2 else pair[0] for i, pair in enumerate(pairs)]
+            node_futures = [
+                executor.submit(_tree_merge_node, pair, next_path, batch_size, pipeline_depth)
+                for pair, next_path in zip(pairs, next_paths) if len(pair) == 2
+            ]
+            for future in node_futures:
+                nodes.append(future.result())
+            level_paths = next_paths
+        os.replace(level_paths[0], output_path)
+
+    # Последний узел - корень дерева: его base + inserted и есть итоговые счётчики
+    result = nodes[-1]
+    result.archive_timings = {}
+    for merge in leaves + nodes[:-1]:
+        for table_name, stats in merge.table_stats.items():
+            result.table_stats[table_name].duplicates += stats.duplicates
+            result.table_stats[table_name].updated += stats.updated
+    for leaf in leaves:
+        result.archive_timings.update(leaf.archive_timings)
+    if progress:
+        progress.finish()
+
+    if digest:
+        result.db_hash, result.db_bytes = _file_digest(output_path)
+    finished = time.perf_counter()
+    result.path = output_path
+    result.archives = len(archive_paths)
+    result.timings = {'leaves': leaves_done - start, 'reduce': finished - leaves_done}
+    result.duration = finished - start
+    logger.info(f"Объединённая база данных создана деревом ({len(groups)} групп, {level} уровней): {output_path}")
+    return result
+
+
+def build_manifest(template: Dict, db_hash: str, user_mark_count: int) -> Dict:
+    """Заполнение манифеста-шаблона данными объединённой базы
+
+    Args:
+        template: Манифест одного из исходных архивов (изменяется на месте)
+        db_hash: SHA-256 (hex) файла объединённой базы
+        user_mark_count: Количество записей UserMark в объединённой базе
+
+    Returns:
+        Обновлённый манифест
+    """
+    manifest = template
     manifest['name'] = f"CombinedUserDataBackup_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}"
     manifest['creationDate'] = datetime.now().strftime('%Y-%m-%d')
     manifest['userDataBackup']['hash'] = db_hash
     manifest['userDataBackup']['lastModifiedDate'] = datetime.now().isoformat().split('.')[0] + "+00:00"
     manifest['userDataBackup']['userMarkCount'] = user_mark_count
-    
     return manifest
 
 
-def create_backup_archive(db_path, manifest_data, output_archive_path):
-    """Создание архива бэкапа с базой данных и манифестом"""
-    with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False) as manifest_file:
-        json.dump(manifest_data, manifest_file, indent=2, ensure_ascii=False)
-        manifest_path = manifest_file.name
-    
+def create_manifest_from_archives(archive_paths, output_db_path, merge_result: Optional[MergeResult] = None):
+    """Создание нового манифеста на основе объединённой базы данных
+
+    Если передан merge_result, хэш базы и число UserMark берутся из него,
+    без повторного чтения объединённой базы.
+    """
+    # Используем первый манифест как шаблон
+    with zipfile.ZipFile(archive_paths[0], 'r') as zf:
+        manifest = json.loads(zf.read('manifest.json'))
+
+    if merge_result is not None:
+        return build_manifest(manifest, merge_result.db_hash, merge_result.tables.get('UserMark', 0))
+    
+    # Обновляем информацию в манифесте
+    with open(output_db_path, 'rb') as f:
+        db_hash = hashlib.sha256(f.read()).hexdigest()
+    
+    # Подсчитываем количество пометок
+    conn = sqlite3.connect(output_db_path)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT COUNT(*) FROM UserMark")
+        user_mark_count = cursor.fetchone()[0]
+    except sqlite3.OperationalError:
+        user_mark_count = 0
+    conn.close()
+    
+    return build_manifest(manifest, db_hash, user_mark_count)
+
+
+# Медиафайлы бэкапа: все члены архива, кроме базы и манифеста
+
+# Локальный заголовок члена zip: сигнатура и поля до длин имени и extra (30 байт)
+_ZIP_LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+_ZIP_LOCAL_SIGNATURE = b'PK\x03\x04'
+_ZIP_FLAG_ENCRYPTED = 0x01
+_ZIP_FLAG_DATA_DESCRIPTOR = 0x08
+
+# Версии Python, в которых copy_raw_member пишет в обход API zipfile
+# (ZipFile._writecheck, _didModify, start_dir, fp); в других - копирование
+# с распаковкой через ZipFile.open
+_ZIP_RAW_COPY_VERSIONS = ((3, 8), (3, 13))
+
+# Размер порции при чтении и копировании членов архива
+ARCHIVE_COPY_CHUNK = 1024 * 1024
+
+
+@dataclass
+class MediaMember:
+    """Медиафайл входного архива, который попадёт в выходной архив"""
+    archive: Path
+    info: zipfile.ZipInfo
+
+
+def _member_sha256(member: MediaMember) -> str:
+    """SHA-256 распакованного содержимого члена архива"""
+    digest = hashlib.sha256()
+    with zipfile.ZipFile(member.archive, 'r') as zf, zf.open(member.info) as f:
+        for chunk in iter(lambda: f.read(ARCHIVE_COPY_CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _same_media(kept: MediaMember, other: MediaMember) -> bool:
+    """Одинаковое ли содержимое у членов с одним именем
+
+    CRC и размер берутся из центрального каталога без чтения данных. Если
+    они совпадают и сжатая форма та же (метод и сжатый размер), член
+    считается дубликатом; иначе совпадение CRC подтверждается SHA-256.
+    """
+    a, b = kept.info, other.info
+    if (a.CRC, a.file_size) != (b.CRC, b.file_size):
+        return False
+    if (a.compress_type, a.compress_size) == (b.compress_type, b.compress_size):
+        return True
+    return _member_sha256(kept) == _member_sha256(other)
+
+
+def plan_media(archive_paths: List[Path]) -> List[MediaMember]:
+    """Медиафайлы для выходного архива без дубликатов
+
+    Архивы просматриваются по порядку; член с уже встреченным именем
+    отбрасывается, если его содержимое совпадает (см. _same_media). При
+    разном содержимом остаётся первый, как и запись IndependentMedia с
+    тем же FilePath при слиянии базы.
+    """
+    kept: Dict[str, MediaMember] = {}
+    duplicates = 0
+    for archive in archive_paths:
+        with zipfile.ZipFile(archive, 'r') as zf:
+            infos = zf.infolist()
+        for info in infos:
+            if info.is_dir() or not _is_media_name(info.filename):
+                continue
+            if info.flag_bits & _ZIP_FLAG_ENCRYPTED:
+                logger.warning(f"Медиафайл {info.filename} в {Path(archive).name} зашифрован, пропущен")
+                continue
+            member = MediaMember(Path(archive), info)
+            existing = kept.get(info.filename)
+            if existing is None:
+                kept[info.filename] = member
+            elif _same_media(existing, member):
+                duplicates += 1
+            else:
+                logger.warning(f"Медиафайл {info.filename} в {Path(archive).name} отличается от файла "
+                               f"в {existing.archive.name}, оставлен первый")
+    if kept or duplicates:
+        size = sum(member.info.compress_size for member in kept.values())
+        logger.info(f"Медиафайлы: {len(kept)} ({size / 1024 / 1024:.1f} МБ), дубликатов {duplicates}")
+    return list(kept.values())
+
+
+def _can_copy_raw(dst: zipfile.ZipFile) -> bool:
+    """Доступны ли внутренности ZipFile, на которые опирается копирование сжатых байтов"""
+    low, high = _ZIP_RAW_COPY_VERSIONS
+    return (
+        low <= sys.version_info[:2] <= high
+        and callable(getattr(dst, '_writecheck', None))
+        and all(hasattr(dst, name) for name in ('_didModify', 'start_dir', 'fp'))
+        and dst.fp is not None and dst.fp.seekable()
+    )
+
+
+def copy_raw_member(member: MediaMember, dst: zipfile.ZipFile) -> None:
+    """Копирование сжатых байтов члена архива в dst без распаковки и повторного сжатия
+
+    У zipfile нет публичного API для копирования сжатых данных, поэтому
+    запись повторяет ZipFile._open_to_write: локальный заголовок с уже
+    известными CRC и размерами, данные порциями и регистрация в
+    центральном каталоге. Если версия Python не из _ZIP_RAW_COPY_VERSIONS
+    или внутренностей ZipFile нет, член распаковывается и сжимается заново
+    тем же методом через ZipFile.open.
+    """
+    src = member.info
+    info = zipfile.ZipInfo(src.filename, src.date_time)
+    info.compress_type = src.compress_type
+    info.create_system = src.create_system
+    info.external_attr = src.external_attr
+
+    if not _can_copy_raw(dst):
+        # Размер заранее: по нему ZipFile.open решает, нужен ли ZIP64
+        info.file_size = src.file_size
+        with zipfile.ZipFile(member.archive) as src_zip, src_zip.open(src) as f, dst.open(info, 'w') as out:
+            shutil.copyfileobj(f, out, ARCHIVE_COPY_CHUNK)
+        return
+
+    # Размеры известны заранее: дескриптор данных после содержимого не нужен
+    info.flag_bits = src.flag_bits & ~_ZIP_FLAG_DATA_DESCRIPTOR
+    info.CRC = src.CRC
+    info.file_size = src.file_size
+    info.compress_size = src.compress_size
+
+    with open(member.archive, 'rb') as f:
+        f.seek(src.header_offset)
+        header = _ZIP_LOCAL_HEADER.unpack(f.read(_ZIP_LOCAL_HEADER.size))
+        if header[0] != _ZIP_LOCAL_SIGNATURE:
+            raise zipfile.BadZipFile(f"Неверный локальный заголовок {src.filename} в {member.archive.name}")
+        name_length, extra_length = header[-2:]
+        f.seek(name_length + extra_length, os.SEEK_CUR)
+
+        dst.fp.seek(dst.start_dir)
+        info.header_offset = dst.fp.tell()
+        dst._writecheck(info)
+        dst._didModify = True
+        dst.fp.write(info.FileHeader())
+        remaining = src.compress_size
+        while remaining:
+            chunk = f.read(min(ARCHIVE_COPY_CHUNK, remaining))
+            if not chunk:
+                raise zipfile.BadZipFile(f"Обрезанные данные {src.filename} в {member.archive.name}")
+            dst.fp.write(chunk)
+            remaining -= len(chunk)
+
+    dst.start_dir = dst.fp.tell()
+    dst.filelist.append(info)
+    dst.NameToInfo[info.filename] = info
+
+
+def create_backup_archive(
+    db_path,
+    manifest_data,
+    output_archive_path,
+    media: Optional[List[MediaMember]] = None
+) -> str:
+    """Создание архива бэкапа с базой данных, медиафайлами (см. plan_media) и манифестом
+
+    База читается один раз: SHA-256 считается по тем же порциям, что
+    сжимаются в архив. manifest.json пишется последним членом, когда хэш
+    известен, и userDataBackup.hash в manifest_data заполняется им.
+
+    Returns:
+        SHA-256 (hex) базы данных
+    """
+    digest = hashlib.sha256()
+    with zipfile.ZipFile(output_archive_path, 'w', compression=zipfile.ZIP_DEFLATED) as zipf:
+        db_info = zipfile.ZipInfo.from_file(db_path, 'userData.db')
+        db_info.compress_type = zipfile.ZIP_DEFLATED
+        with open(db_path, 'rb') as src, zipf.open(db_info, 'w') as dst:
+            for chunk in iter(lambda: src.read(ARCHIVE_COPY_CHUNK), b''):
+                digest.update(chunk)
+                dst.write(chunk)
+        for member in media or ():
+            copy_raw_member(member, zipf)
+        manifest_data.setdefault('userDataBackup', {})['hash'] = digest.hexdigest()
+        zipf.writestr('manifest.json', json.dumps(manifest_data, indent=2, ensure_ascii=False))
+
+    logger.info(f"Архив бэкапа создан: {output_archive_path}")
+    return digest.hexdigest()
+
+
+# Профилирование: cProfile (cpu) или tracemalloc (memory) по этапам слияния
+
+PROFILE_MODES: Tuple[str, ...] = ('cpu', 'memory')
+
+# Количество мест выделения памяти в отчёте на этап
+PROFILE_TOP_SITES = 10
+
+
+def default_profile_path(mode: str, directory: Union[str, Path] = '.') -> Path:
+    """Путь отчёта профилирования по умолчанию"""
+    name = 'jwl_backup_merger.prof' if mode == 'cpu' else 'jwl_backup_merger.memory.json'
+    return Path(directory) / name
+
+
+class RunProfiler:
+    """Профилирование этапов слияния для отправки отчёта вместо бэкапов
+
+    mode='cpu': один cProfile.Profile включается только внутри этапов,
+    save() пишет файл pstats (``python -m pstats <файл>``). cProfile видит
+    только свой поток, поэтому под ним слияние идёт без фоновых потоков
+    конвейера (см. pipeline_depth).
+    mode='memory': tracemalloc фиксирует пик памяти и места выделения
+    с наибольшим приростом для каждого этапа, save() пишет JSON.
+    В обоих режимах сохраняется длительность этапов.
+
+    Пример::
+
+        profiler = RunProfiler('memory', 'report.json')
+        with profiler.phase('merge'):
+            create_merged_db(archives, db_path)
+        profiler.save()
+    """
+
+    def __init__(self, mode: str, output: Union[str, Path]):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Неизвестный режим профилирования: {mode}")
+        self.mode = mode
+        self.output = Path(output)
+        self.phases: Dict[str, Dict] = {}
+        self._profile = cProfile.Profile() if mode == 'cpu' else None
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Профилирование одного этапа (этапы не вкладываются)"""
+        report: Dict = {}
+        started_tracing = False
+        if self.mode == 'memory':
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started_tracing = True
+            tracemalloc.reset_peak()
+            before = tracemalloc.take_snapshot()
+        else:
+            self._profile.enable()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            report['duration'] = time.perf_counter() - start
+            if self.mode == 'memory':
+                current, peak = tracemalloc.get_traced_memory()
+                after = tracemalloc.take_snapshot()
+                if started_tracing:
+                    tracemalloc.stop()
+                report['current_bytes'] = current
+                report['peak_bytes'] = peak
+                report['top_sites'] = [
+                    {'site': str(stat.traceback[0]), 'size_diff': stat.size_diff, 'count_diff': stat.count_diff}
+                    for stat in after.compare_to(before, 'lineno')[:PROFILE_TOP_SITES]
+                ]
+            else:
+                self._profile.disable()
+            self.phases[name] = report
+            logger.debug(f"Профилирование: этап {name} - {report['duration']:.3f} с")
+
+    def pipeline_depth(self, depth: int = PIPELINE_DEPTH) -> int:
+        """Глубина конвейера слияния под профилировщиком
+
+        В режиме cpu чтение, маппинг и хэширование записей остаются в
+        основном потоке (0), иначе горячий путь не попал бы в отчёт;
+        tracemalloc следит за всеми потоками, и depth не меняется.
+        """
+        return 0 if self.mode == 'cpu' else depth
+
+    def save(self) -> Path:
+        """Запись отчёта в self.output"""
+        self.output.parent.mkdir(parents=True, exist_ok=True)
+        if self.mode == 'cpu':
+            stats = pstats.Stats(self._profile)
+            stats.dump_stats(str(self.output))
+            # Длительность этапов рядом с файлом pstats
+            phases_path = self.output.with_name(self.output.name + '.phases.json')
+            phases_path.write_text(json.dumps(self.phases, indent=2), encoding='utf-8')
+        else:
+            report = {'mode': self.mode, 'phases': self.phases}
+            self.output.write_text(json.dumps(report, indent=2, ensure_ascii=False), encoding='utf-8')
+        logger.info(f"Отчёт профилирования сохранён: {self.output}")
+        return self.output
+
+
+def _profile_phase(profiler: Optional[RunProfiler], name: str):
+    """Этап профилирования или пустой контекст без профилировщика"""
+    return profiler.phase(name) if profiler is not None else contextlib.nullcontext()
+
+
+# Библиотечный API: слияние без обязательной записи на диск
+
+# Источник архива: путь, содержимое в памяти или бинарный file-like объект
+ArchiveSource = Union[str, Path, bytes, bytearray, memoryview, BinaryIO]
+
+
+def read_archive(source: ArchiveSource) -> Tuple[bytes, Dict]:
+    """Чтение базы данных и манифеста из архива .jwlibrary
+
+    Args:
+        source: Путь к архиву, его содержимое (bytes) или бинарный file-like объект
+
+    Returns:
+        (содержимое userData.db, манифест)
+
+    Raises:
+        ValueError: Если в архиве нет файла базы данных
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    elif hasattr(source, 'seek'):
+        source.seek(0)
+
+    with zipfile.ZipFile(source, 'r') as zf:
+        names = set(zf.namelist())
+        db_member = next((name for name in DB_MEMBER_NAMES if name in names), None)
+        if db_member is None:
+            raise ValueError("В архиве нет файла базы данных userData.db")
+        db_data = zf.read(db_member)
+        manifest = json.loads(zf.read('manifest.json')) if 'manifest.json' in names else {}
+    return db_data, manifest
+
+
+@dataclass
+class ArchiveInfo:
+    """Сведения об архиве из каталога zip и manifest.json, без распаковки базы"""
+    path: Path
+    size: int
+    db_size: Optional[int] = None
+    created: Optional[str] = None
+    device: Optional[str] = None
+    user_mark_count: Optional[int] = None
+    error: Optional[str] = None
+
+
+def peek_archive(path: Union[str, Path]) -> ArchiveInfo:
+    """Быстрый просмотр архива: читается только каталог zip и manifest.json
+
+    Ошибки чтения не выбрасываются, а сохраняются в ArchiveInfo.error,
+    чтобы один повреждённый файл не прерывал просмотр директории.
+    """
+    path = Path(path)
+    info = ArchiveInfo(path=path, size=path.stat().st_size)
+    try:
+        with zipfile.ZipFile(path, 'r') as zf:
+            names = set(zf.namelist())
+            db_member = next((name for name in DB_MEMBER_NAMES if name in names), None)
+            if db_member is None:
+                info.error = "нет файла базы данных"
+            else:
+                info.db_size = zf.getinfo(db_member).file_size
+            if 'manifest.json' in names:
+                manifest = json.loads(zf.read('manifest.json'))
+                backup = manifest.get('userDataBackup', {})
+                info.created = backup.get('lastModifiedDate') or manifest.get('creationDate')
+                info.device = backup.get('deviceName')
+                info.user_mark_count = backup.get('userMarkCount')
+    except (zipfile.BadZipFile, json.JSONDecodeError, OSError, AttributeError) as e:
+        info.error = str(e) or type(e).__name__
+    return info
+
+
+def _archive_media_count(source: ArchiveSource) -> int:
+    """Количество медиафайлов в архиве (по каталогу zip, без чтения содержимого)"""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    elif hasattr(source, 'seek'):
+        source.seek(0)
+    with zipfile.ZipFile(source, 'r') as zf:
+        return sum(1 for name in zf.namelist() if _is_media_name(name))
+
+
+def _open_db_bytes(data: bytes, spool_path: Optional[Path] = None, name: str = 'userData.db') -> sqlite3.Connection:
+    """Открытие базы данных из содержимого в памяти
+
+    Без spool_path база загружается через ``Connection.deserialize``
+    (Python 3.11+); иначе содержимое записывается в spool_path / name.
+    """
+    if spool_path is not None:
+        db_path = spool_path / name
+        db_path.write_bytes(data)
+        return sqlite3.connect(str(db_path), check_same_thread=False)
+
+    conn = sqlite3.connect(':memory:', check_same_thread=False)
+    conn.deserialize(_writable_db_bytes(data))
+    return conn
+
+
+def _writable_db_bytes(data: bytes) -> bytes:
+    """Подготовка содержимого базы к загрузке через ``Connection.deserialize``"""
+    # В памяти WAL недоступен: байты 18-19 заголовка переключаем на rollback journal
+    if data[18:20] == b'\x02\x02':
+        data = bytearray(data)
+        data[18:20] = b'\x01\x01'
+    return data
+
+
+def _count_tables(conn: sqlite3.Connection) -> Dict[str, int]:
+    """Подсчёт записей по таблицам в открытой базе
+
+    Таблицы - те же, что сливаются (TABLE_ORDER и остальные таблицы реестра
+    схемы), поэтому подсчёт совпадает по составу с MergeResult.tables.
+    """
+    registry = schema_registry(conn)
+    results = {}
+    for table in TABLE_ORDER + [table_name for table_name in registry.order if table_name not in TABLE_ORDER]:
+        try:
+            results[table] = conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0]
+        except sqlite3.OperationalError:
+            logger.warning(f"  ⚠ Таблица {table} не существует")
+            results[table] = 0
+    return results
+
+
+def write_backup_archive(output: Union[str, Path, BinaryIO], db_data: bytes, manifest_data: Dict) -> None:
+    """Запись архива .jwlibrary из содержимого базы в памяти
+
+    Args:
+        output: Путь к файлу или бинарный поток для записи
+        db_data: Содержимое userData.db
+        manifest_data: Манифест архива
+    """
+    with zipfile.ZipFile(output, 'w', compression=zipfile.ZIP_DEFLATED) as zipf:
+        zipf.writestr('userData.db', db_data)
+        zipf.writestr('manifest.json', json.dumps(manifest_data, indent=2, ensure_ascii=False))
+
+
+@dataclass
+class MergeStats:
+    """Статистика слияния, возвращаемая Merger.merge()"""
+    archives: int = 0
+    tables: Dict[str, int] = field(default_factory=dict)
+    db_bytes: int = 0
+    db_hash: str = ''
+    duration: float = 0.0
+
+    @property
+    def total_records(self) -> int:
+        return sum(self.tables.values())
+
+
+class Merger:
+    """Слияние бэкапов JW Library из памяти или потоков
+
+    Входные архивы задаются путями, содержимым (bytes) или бинарными
+    file-like объектами; результат пишется в любой бинарный поток.
+    Файловая система используется, только если передан ``spool_dir``
+    (или Python старше 3.11 без ``Connection.deserialize``).
+    Ничего не печатает: сообщения идут только в ``logger``.
+
+    Пример::
+
+        merger = Merger()
+        merger.add(uploaded_bytes, name='phone.jwlibrary')
+        merger.add(open('tablet.jwlibrary', 'rb'))
+        output = io.BytesIO()
+        stats = merger.merge(output)
+    """
+
+    def __init__(
+        self,
+        verbose: bool = False,
+        spool_dir: Optional[Union[str, Path]] = None,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        profiler: Optional[RunProfiler] = None
+    ):
+        self.verbose = verbose
+        self.batch_size = batch_size
+        self.profiler = profiler
+        self.spool_dir = Path(spool_dir) if spool_dir is not None else None
+        self.sources: List[Tuple[str, ArchiveSource]] = []
+        self._template_manifest: Dict = {}
+
+    def add(self, source: ArchiveSource, name: Optional[str] = None) -> 'Merger':
+        """Добавление входного архива (порядок добавления = порядок слияния)"""
+        if name is None:
+            name = Path(source).name if isinstance(source, (str, Path)) else f"archive_{len(self.sources) + 1}"
+        self.sources.append((name, source))
+        return self
+
+    def _iter_sources(self, first_db: bytes, spool_path: Optional[Path]) -> Iterator[Tuple[str, sqlite3.Connection]]:
+        for i, (name, source) in enumerate(self.sources):
+            db_data = first_db if i == 0 else read_archive(source)[0]
+            src_conn = _open_db_bytes(db_data, spool_path, f"source_{i}.db")
+            del db_data
+            try:
+                yield name, src_conn
+            finally:
+                src_conn.close()
+                if spool_path is not None:
+                    (spool_path / f"source_{i}.db").unlink()
+
+    def merge(self, output: Union[str, Path, BinaryIO]) -> MergeStats:
+        """Слияние всех добавленных архивов с записью результата в output
+
+        В архив пишутся только база и манифест: медиафайлы входных архивов
+        не переносятся (об этом выводится предупреждение). Для переноса
+        медиафайлов - run_merge.
+
+        Args:
+            output: Бинарный поток (или путь) для архива .jwlibrary
+
+        Returns:
+            Статистика слияния
+
+        Raises:
+            ValueError: Если не добавлено ни одного архива
+            RuntimeError: При критической ошибке во время слияния
+        """
+        with _profile_phase(self.profiler, 'merge'):
+            db_data, stats = self.merge_db()
+        with _profile_phase(self.profiler, 'manifest'):
+            manifest = build_manifest(self._template_manifest, stats.db_hash, stats.tables.get('UserMark', 0))
+        with _profile_phase(self.profiler, 'archive'):
+            write_backup_archive(output, db_data, manifest)
+        media = sum(_archive_media_count(source) for _, source in self.sources)
+        if media:
+            logger.warning(f"Медиафайлы входных архивов ({media}) не перенесены: Merger пишет только базу и манифест")
+        logger.info(f"Архив бэкапа создан: {stats.archives} архивов, {stats.total_records} записей")
+        return stats
+
+    def merge_db(self) -> Tuple[bytes, MergeStats]:
+        """Слияние всех добавленных архивов без упаковки в архив
+
+        Returns:
+            (содержимое объединённой userData.db, статистика)
+        """
+        if not self.sources:
+            raise ValueError("Не добавлено ни одного архива")
+
+        start = time.perf_counter()
+        use_spool = self.spool_dir is not None or not hasattr(sqlite3.Connection, 'deserialize')
+        with contextlib.ExitStack() as stack:
+            spool_path = None
+            if use_spool:
+                spool_path = Path(stack.enter_context(tempfile.TemporaryDirectory(dir=self.spool_dir)))
+
+            # Используем структуру из первого архива
+            first_db, self._template_manifest = read_archive(self.sources[0][1])
+            merged_conn = _open_db_bytes(first_db, spool_path, 'merged.db')
+            try:
+                result = _merge_sources(
+                    merged_conn, self._iter_sources(first_db, spool_path), len(self.sources),
+                    self.verbose, self.batch_size, base_included=True,
+                    pipeline_depth=self.profiler.pipeline_depth() if self.profiler is not None else PIPELINE_DEPTH
+                )
+                if verify_merged_db(merged_conn, result).integrity != ['ok']:
+                    raise RuntimeError("quick_check не пройден")
+                if spool_path is None:
+                    db_data = merged_conn.serialize()
+            except Exception as e:
+                merged_conn.rollback()
+                raise RuntimeError(f"Ошибка при создании объединённой базы: {e}")
+            finally:
+                merged_conn.close()
+
+            if spool_path is not None:
+                db_data = (spool_path / 'merged.db').read_bytes()
+
+        stats = MergeStats(
+            archives=len(self.sources),
+            tables=result.tables,
+            db_bytes=len(db_data),
+            db_hash=hashlib.sha256(db_data).hexdigest(),
+            duration=time.perf_counter() - start
+        )
+        return db_data, stats
+
+
+# Разница между двумя бэкапами
+
+@dataclass
+class BackupDiff:
+    """Результат diff_backups: добавленные и удалённые записи по таблицам"""
+    added: Dict[str, int] = field(default_factory=dict)
+    removed: Dict[str, int] = field(default_factory=dict)
+    delta_records: int = 0
+    duration: float = 0.0
+
+
+def _table_columns(conn: sqlite3.Connection, table_name: str, schema: str = 'main') -> List[str]:
+    """Список столбцов таблицы (пустой, если таблицы нет)"""
+    return [row[1] for row in conn.execute(f'PRAGMA "{schema}".table_info("{table_name}")')]
+
+
+def _keep_only_rows(conn: sqlite3.Connection, table_name: str, keep_ids: Set[int]) -> None:
+    """Удаление из таблицы всех записей, чей rowid (он же INTEGER PRIMARY KEY) не входит в keep_ids"""
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS keep_ids (id INTEGER PRIMARY KEY)")
+    conn.execute("DELETE FROM keep_ids")
+    conn.executemany("INSERT INTO keep_ids VALUES (?)", ((i,) for i in keep_ids))
+    conn.execute(f'DELETE FROM "{table_name}" WHERE rowid NOT IN (SELECT id FROM keep_ids)')
+
+
+def _diff_table(
+    conn: sqlite3.Connection,
+    table_name: str,
+    table_info: Optional[TableInfo] = None
+) -> Tuple[Set[int], int, int]:
+    """Сравнение одной таблицы баз main (новая) и old (старая)
+
+    Ключ записи - функция значений RECORD_KEY_COLUMNS (для таблиц вне
+    TABLE_ORDER - естественного ключа table_info.natural_key), поэтому
+    записи с побайтно совпадающими значениями этих столбцов имеют одинаковый ключ.
+    Такие записи отсекаются в SQL (DISTINCT/EXCEPT по кортежу столбцов),
+    и строка ключа вычисляется в Python только для несовпавших кортежей.
+    Ключи, к которым приводятся и несовпавшие, и общие кортежи (NULL и 0,
+    '' и NULL), уточняются по общим кортежам, отобранным по одному
+    столбцу-пробнику.
+
+    Returns:
+        (rowid добавленных записей, число добавленных ключей,
+        число удалённых ключей)
+    """
+    key_columns = RECORD_KEY_COLUMNS[table_name] if table_name in RECORD_KEY_COLUMNS else table_info.natural_key
+    # План по кортежу столбцов ключа: key_text совпадает с key_text_from_values
+    key_plan = _compile_row_plan(table_name, key_columns, table_info)
+    key_text = key_plan.key_text
+    old_columns = _table_columns(conn, table_name, 'old')
+    new_columns = _table_columns(conn, table_name)
+    if not old_columns and not new_columns:
+        return set(), 0, 0
+
+    def exprs(columns: List[str], prefix: str = '') -> List[str]:
+        return [f'{prefix}"{c}"' if c in columns else 'NULL' for c in key_columns]
+
+    def select(columns: List[str], prefix: str = '') -> str:
+        return ', '.join(exprs(columns, prefix))
+
+    def raw_table(name: str, schema: str, columns: List[str]) -> None:
+        # CREATE TABLE AS сохраняет affinity столбцов - иначе IS-сравнение не использует индекс
+        aliased = ', '.join(f'{expr} AS k{i}' for i, expr in enumerate(exprs(columns)))
+        source = f'FROM {schema}."{table_name}"' if columns else 'WHERE 0'
+        conn.execute(f"DROP TABLE IF EXISTS temp.{name}")
+        conn.execute(f"CREATE TEMP TABLE {name} AS SELECT {aliased} {source}")
+
+    names = ', '.join(f'k{i}' for i in range(len(key_columns)))
+    raw_table('old_raw', 'old', old_columns)
+    raw_table('new_raw', 'main', new_columns)
+    conn.execute(f"CREATE INDEX temp.old_raw_all ON old_raw ({names})")
+    conn.execute(f"CREATE INDEX temp.new_raw_all ON new_raw ({names})")
+
+    def in_raw(raw: str, alias: str) -> str:
+        match = ' AND '.join(f'r.k{i} IS {alias}.k{i}' for i in range(len(key_columns)))
+        return f'EXISTS (SELECT 1 FROM {raw} AS r WHERE {match})'
+
+    # Записи нового бэкапа, кортежа которых нет в старом
+    added_rows: List[Tuple] = []
+    if new_columns:
+        match = ' AND '.join(f'o.k{i} IS {expr}' for i, expr in enumerate(exprs(new_columns, 'n.')))
+        added_rows = conn.execute(
+            f'SELECT n.rowid, {select(new_columns, "n.")} FROM main."{table_name}" AS n '
+            f'WHERE NOT EXISTS (SELECT 1 FROM old_raw AS o WHERE {match})'
+        ).fetchall()
+    # Кортежи старого бэкапа, которых нет в новом
+    removed_rows = conn.execute(f"SELECT {names} FROM old_raw AS o WHERE NOT {in_raw('new_raw', 'o')}").fetchall()
+
+    added_keys: Dict[str, Optional[int]] = {}
+    for pk, *values in added_rows:
+        key = key_text(tuple(values))
+        if key not in added_keys or (pk is not None and (added_keys[key] is None or pk < added_keys[key])):
+            added_keys[key] = pk
+    removed_keys = {key_text(tuple(values)) for values in removed_rows}
+
+    # Общие кортежи, чей ключ может совпасть с ключом несовпавших
+    candidates = [tuple(values) for _, *values in added_rows] + removed_rows
+    shared_keys: Set[str] = set()
+    if candidates:
+        defaults = [''] * (len(key_columns) - len(key_plan.key_defaults)) + list(key_plan.key_defaults)
+        probes = [{str(values[i] or defaults[i]) for values in candidates} for i in range(len(key_columns))]
+        probe = max(range(len(key_columns)), key=lambda i: len(probes[i]))
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS probe_values (v TEXT PRIMARY KEY) WITHOUT ROWID")
+        conn.execute("DELETE FROM temp.probe_values")
+        conn.executemany("INSERT INTO temp.probe_values VALUES (?)", ((v,) for v in probes[probe]))
+        probe_match = f"CAST(k{probe} AS TEXT) IN (SELECT v FROM temp.probe_values)"
+        if str(defaults[probe]) in probes[probe]:
+            probe_match += f" OR k{probe} IS NULL OR k{probe} = 0 OR k{probe} = ''"
+        shared = conn.execute(
+            f"SELECT {names} FROM new_raw AS n WHERE ({probe_match}) AND {in_raw('old_raw', 'n')}"
+        ).fetchall()
+        shared_keys = {key_text(tuple(values)) for values in shared}
+
+    added = {key: pk for key, pk in added_keys.items() if key not in removed_keys and key not in shared_keys}
+    removed = removed_keys - set(added_keys) - shared_keys
+    return {pk for pk in added.values() if pk is not None}, len(added), len(removed)
+
+
+def diff_backups(
+    old_source: ArchiveSource,
+    new_source: ArchiveSource,
+    delta_output: Optional[Union[str, Path, BinaryIO]] = None
+) -> BackupDiff:
+    """Сравнение двух бэкапов по ключам generate_record_hash
+
+    Запись считается добавленной, если её ключа нет в старом бэкапе,
+    и удалённой, если её ключа нет в новом. Старая база подключается к
+    новой через ATTACH, и неизменившиеся записи отсекаются в SQLite
+    (см. _diff_table), поэтому время почти не зависит от размера бэкапов.
+
+    Сравниваются все таблицы реестра схемы нового бэкапа (см.
+    schema_registry), включая InputField, PlaylistItem и IndependentMedia.
+    При указании delta_output записывается архив .jwlibrary только с
+    добавленными записями и родительскими записями, на которые они
+    ссылаются (внешние ключи реестра), поэтому все внешние ключи дельты
+    разрешаются внутри неё самой; идентификаторы берутся из нового бэкапа.
+    Медиафайлы в дельту не переносятся (выводится предупреждение).
+
+    Args:
+        old_source: Старый бэкап (путь, bytes или file-like)
+        new_source: Новый бэкап (путь, bytes или file-like)
+        delta_output: Путь или поток для архива-дельты (необязательно)
+
+    Returns:
+        Количество добавленных и удалённых записей по таблицам
+    """
+    start = time.perf_counter()
+    result = BackupDiff()
+    added_ids: Dict[str, Set[int]] = {}
+
+    with contextlib.ExitStack() as stack:
+        spool_path = None
+        if not hasattr(sqlite3.Connection, 'deserialize'):
+            spool_path = Path(stack.enter_context(tempfile.TemporaryDirectory()))
+
+        old_db, _ = read_archive(old_source)
+        new_db, new_manifest = read_archive(new_source)
+        conn = _open_db_bytes(new_db, spool_path, 'new.db')
+        stack.callback(conn.close)
+        conn.execute("PRAGMA temp_store = MEMORY")
+        del new_db
+        registry = schema_registry(conn)
+        tables = list(registry.order) + [table_name for table_name in TABLE_ORDER if table_name not in registry.tables]
+        if spool_path is None:
+            conn.execute("ATTACH ':memory:' AS old")
+            conn.deserialize(_writable_db_bytes(old_db), name='old')
+        else:
+            (spool_path / 'old.db').write_bytes(old_db)
+            conn.execute("ATTACH ? AS old", (str(spool_path / 'old.db'),))
+        del old_db
+
+        for table_name in tables:
+            added_ids[table_name], result.added[table_name], result.removed[table_name] = \
+                _diff_table(conn, table_name, registry.tables.get(table_name))
+
+        for temp_table in ('old_raw', 'new_raw', 'probe_values'):
+            conn.execute(f"DROP TABLE IF EXISTS temp.{temp_table}")
+        conn.commit()
+        conn.execute("DETACH old")
+
+        if delta_output is not None:
+            result.delta_records = _write_delta(conn, new_manifest, added_ids, delta_output, spool_path, registry)
+            media = _archive_media_count(new_source)
+            if media:
+                logger.warning(f"Медиафайлы нового бэкапа ({media}) в дельту не перенесены: только база и манифест")
+
+    result.duration = time.perf_counter() - start
+    return result
+
+
+def _write_delta(
+    new_conn: sqlite3.Connection,
+    new_manifest: Dict,
+    added_ids: Dict[str, Set[int]],
+    delta_output: Union[str, Path, BinaryIO],
+    spool_path: Optional[Path] = None,
+    registry: Optional[SchemaRegistry] = None
+) -> int:
+    """Запись архива-дельты на основе нового бэкапа
+
+    Returns:
+        Количество записей в дельте по всем таблицам реестра
+    """
+    if registry is None:
+        registry = schema_registry(new_conn)
+    # Дочерние таблицы идут после родительских: обход в обратном порядке
+    # добавляет к дельте родителей, на которых ссылаются записи дельты
+    keep_ids = {table_name: set(ids) for table_name, ids in added_ids.items()}
+    for table_name in reversed(registry.order):
+        ids = keep_ids.get(table_name)
+        if not ids:
+            continue
+        for fk_column, parent in registry.tables[table_name].foreign_keys:
+            for rowid, parent_id in new_conn.execute(f'SELECT rowid, "{fk_column}" FROM "{table_name}"'):
+                if rowid in ids and parent_id is not None:
+                    keep_ids.setdefault(parent, set()).add(parent_id)
+
+    for table_name in keep_ids:
+        try:
+            _keep_only_rows(new_conn, table_name, keep_ids[table_name])
+        except sqlite3.OperationalError:
+            continue
+    new_conn.execute("DROP TABLE IF EXISTS temp.keep_ids")
+    new_conn.commit()
+    new_conn.execute("VACUUM")
+
+    delta_records = sum(
+        new_conn.execute(f'SELECT COUNT(*) FROM "{table_name}"').fetchone()[0] for table_name in registry.order
+    )
+    tables = _count_tables(new_conn)
+    if spool_path is None:
+        db_data = new_conn.serialize()
+    else:
+        new_conn.commit()
+        db_data = (spool_path / 'new.db').read_bytes()
+    manifest = build_manifest(new_manifest, hashlib.sha256(db_data).hexdigest(), tables['UserMark'])
+    manifest['name'] = f"DeltaUserDataBackup_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}"
+    write_backup_archive(delta_output, db_data, manifest)
+    return delta_records
+
+
+# Индексы ключей: отсортированные массивы ключей дедупликации на диске
+
+# Формат файла индекса (little-endian):
+#   заголовок: magic, размер архива, mtime_ns архива, число таблиц, ширина ключа
+#   каталог: для каждой таблицы имя, смещение записей, число записей,
+#            XOR и сумма (по модулю 2^64) первых 8 байт ключей
+#   записи таблицы: ключ (KEY_INDEX_WIDTH байт) + rowid (int64), по возрастанию ключа
+KEY_INDEX_MAGIC = b'JWLKIDX5'
+KEY_INDEX_SUFFIX = '.keyidx'
+KEY_INDEX_WIDTH = 16
+# Родительские таблицы хранятся 64-битной маской позиций
+KEY_INDEX_MAX_TABLES = 64
+_KEY_INDEX_HEADER = struct.Struct('<8sQqII')
+_KEY_INDEX_TABLE = struct.Struct('<64sQQQQQ')
+_KEY_INDEX_ROWID = struct.Struct('<q')
+_KEY_PREFIX_MASK = (1 << 64) - 1
+
+
+def _key_aggregates(keys: Iterable[bytes]) -> Tuple[int, int]:
+    """Не зависящие от порядка XOR и сумма 64-битных префиксов ключей"""
+    xor = total = 0
+    for key in keys:
+        prefix = int.from_bytes(key[:8], 'little')
+        xor ^= prefix
+        total = (total + prefix) & _KEY_PREFIX_MASK
+    return xor, total
+
+
+def record_key_digest(table_name, record_data):
+    """Бинарный ключ записи фиксированной ширины: первые байты generate_record_hash
+
+    Совпадает с ключом индекса для таблиц без внешних ключей в ключе записи
+    и вне GUID_COLUMNS (в индексе внешние ключи заменены ключами родительских
+    записей, а к ключам Note и UserMark добавлена версия).
+    """
+    return hashlib.sha256(record_key_text(table_name, record_data).encode('utf-8')).digest()[:KEY_INDEX_WIDTH]
+
+
+def _table_key_digests(
+    conn: sqlite3.Connection,
+    table_name: str,
+    table_info: Optional[TableInfo] = None,
+    parent_keys: Optional[Dict[str, Dict[int, str]]] = None,
+    row_keys: Optional[Dict[int, str]] = None
+) -> List[Tuple[bytes, int]]:
+    """Отсортированные уникальные пары (бинарный ключ, rowid) таблицы
+
+    ID архива локальны, поэтому внешний ключ в ключе записи заменяется ключом
+    родительской записи из parent_keys ({таблица: {ID: ключ (hex)}}): записи
+    двух архивов с разной нумерацией родителей совпадают, только если
+    совпадают сами родители - как при слиянии, где хэш считается после
+    маппинга ID. У таблиц из GUID_COLUMNS к ключу добавляется версия записи
+    (GUID_VERSION_COLUMNS): копия с другой версией не считается покрытой, и
+    выбор новой версии остаётся за upsert по GUID при слиянии, независимо от
+    порядка архивов. Ключи записей по первичному ключу добавляются в row_keys.
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f'SELECT rowid, * FROM "{table_name}" ORDER BY rowid')
+    except sqlite3.OperationalError:
+        return []
+    columns = [d[0] for d in cursor.description[1:]]
+    plan = _compile_row_plan(table_name, tuple(columns), table_info)
+    version_column = _guid_version_column(table_name, columns) if table_name in GUID_COLUMNS else None
+    version_index = columns.index(version_column) if version_column else None
+    fk_keys = [
+        (position, parent_keys[parent]) for position, parent in plan.foreign_keys if parent in (parent_keys or {})
+    ]
+    pk_index = plan.pk_index
+    sha256 = hashlib.sha256
+    entries: Dict[bytes, int] = {}
+    for row in iter_fetchmany(cursor):
+        rowid, record = row[0], row[1:]
+        if fk_keys:
+            values = list(record)
+            for position, keys in fk_keys:
+                values[position] = keys.get(values[position], values[position])
+            record = tuple(values)
+        key_text = plan.key_text(record)
+        if version_index is not None:
+            key_text += f'|{record[version_index]}'
+        key = sha256(key_text.encode('utf-8')).digest()[:KEY_INDEX_WIDTH]
+        # При повторе ключа оставляем первую (с меньшим rowid) запись
+        entries.setdefault(key, rowid)
+        if row_keys is not None and pk_index is not None:
+            row_keys[record[pk_index]] = key.hex()
+    return sorted(entries.items())
+
+
+def default_key_index_path(archive_path: Path, index_dir: Optional[Path] = None) -> Path:
+    """Путь к файлу индекса архива: рядом с архивом или в index_dir"""
+    archive_path = Path(archive_path)
+    return Path(index_dir or archive_path.parent) / (archive_path.name + KEY_INDEX_SUFFIX)
+
+
+def build_key_index(archive_path: Path, index_path: Optional[Path] = None) -> Path:
+    """Построение файла индекса ключей для архива
+
+    Args:
+        archive_path: Путь к архиву .jwlibrary
+        index_path: Путь к файлу индекса (по умолчанию рядом с архивом)
+
+    Returns:
+        Путь к записанному файлу индекса
+    """
+    archive_path = Path(archive_path)
+    index_path = Path(index_path) if index_path else default_key_index_path(archive_path)
+    stat = archive_path.stat()
+
+    with contextlib.ExitStack() as stack:
+        spool_path = None
+        if not hasattr(sqlite3.Connection, 'deserialize'):
+            spool_path = Path(stack.enter_context(tempfile.TemporaryDirectory()))
+        db_data, _ = read_archive(archive_path)
+        conn = _open_db_bytes(db_data, spool_path)
+        stack.callback(conn.close)
+        del db_data
+        registry = schema_registry(conn)
+        # Все таблицы реестра (родители раньше детей) и пустые записи для отсутствующих основных
+        names = list(registry.order) + [table_name for table_name in TABLE_ORDER if table_name not in registry.tables]
+        if len(names) > KEY_INDEX_MAX_TABLES:
+            raise ValueError(f"Слишком много таблиц для индекса ключей: {len(names)}")
+        parents = {parent for info in registry.tables.values() for _, parent in info.foreign_keys}
+        parent_keys: Dict[str, Dict[int, str]] = {}
+        tables = []
+        for table_name in names:
+            row_keys = parent_keys.setdefault(table_name, {}) if table_name in parents else None
+            table_info = registry.tables.get(table_name)
+            # Маска позиций родительских таблиц в списке names
+            parent_mask = 0
+            for _, parent in (table_info.foreign_keys if table_info else ()):
+                if parent != table_name and parent in names:
+                    parent_mask |= 1 << names.index(parent)
+            tables.append((table_name, parent_mask, _table_key_digests(
+                conn, table_name, table_info, parent_keys, row_keys
+            )))
+
+    # Запись во временный файл и атомарная замена: читатели не видят недописанный индекс
+    offset = _KEY_INDEX_HEADER.size + _KEY_INDEX_TABLE.size * len(tables)
+    tmp_path = index_path.with_name(index_path.name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(_KEY_INDEX_HEADER.pack(KEY_INDEX_MAGIC, stat.st_size, stat.st_mtime_ns, len(tables), KEY_INDEX_WIDTH))
+        for table_name, parent_mask, entries in tables:
+            xor, total = _key_aggregates(key for key, _ in entries)
+            f.write(_KEY_INDEX_TABLE.pack(table_name.encode('utf-8'), offset, len(entries), xor, total, parent_mask))
+            offset += len(entries) * (KEY_INDEX_WIDTH + _KEY_INDEX_ROWID.size)
+        for _, _, entries in tables:
+            f.write(b''.join(key + _KEY_INDEX_ROWID.pack(rowid) for key, rowid in entries))
+    os.replace(tmp_path, index_path)
+    return index_path
+
+
+class TableKeys:
+    """Отсортированные ключи одной таблицы в отображённом в память индексе
+
+    Ведёт себя как последовательность бинарных ключей: ``len()``,
+    индексирование, итерация по возрастанию и ``key in table_keys``
+    (двоичный поиск). Записи не десериализуются целиком - каждое
+    обращение читает только нужные байты из mmap.
+    """
+
+    def __init__(self, buffer: mmap.mmap, offset: int, count: int, xor: int = 0, total: int = 0):
+        self._buffer = buffer
+        self._offset = offset
+        self._count = count
+        self._stride = KEY_INDEX_WIDTH + _KEY_INDEX_ROWID.size
+        # (число ключей, XOR, сумма префиксов): совпадение означает тот же набор ключей
+        self.signature = (count, xor, total)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, i: int) -> bytes:
+        if not 0 <= i < self._count:
+            raise IndexError(i)
+        start = self._offset + i * self._stride
+        return self._buffer[start:start + KEY_INDEX_WIDTH]
+
+    def __iter__(self) -> Iterator[bytes]:
+        for i in range(self._count):
+            yield self[i]
+
+    def __contains__(self, key: bytes) -> bool:
+        i = bisect.bisect_left(self, key)
+        return i < self._count and self[i] == key
+
+    def rowid(self, key: bytes) -> Optional[int]:
+        """rowid записи с данным ключом или None"""
+        i = bisect.bisect_left(self, key)
+        if i < self._count and self[i] == key:
+            return _KEY_INDEX_ROWID.unpack_from(self._buffer, self._offset + i * self._stride + KEY_INDEX_WIDTH)[0]
+        return None
+
+    def items(self) -> Iterator[Tuple[bytes, int]]:
+        """Пары (ключ, rowid) по возрастанию ключа"""
+        for i in range(self._count):
+            start = self._offset + i * self._stride
+            yield (self._buffer[start:start + KEY_INDEX_WIDTH],
+                   _KEY_INDEX_ROWID.unpack_from(self._buffer, start + KEY_INDEX_WIDTH)[0])
+
+
+class KeyIndex:
+    """Файл индекса ключей архива, открытый через mmap
+
+    Пример::
+
+        with KeyIndex(build_key_index(archive)) as index:
+            tags = index['Tag']
+            print(len(tags), record_key_digest('Tag', row) in tags)
+    """
+
+    def __init__(self, index_path: Path):
+        self.path = Path(index_path)
+        with open(self.path, 'rb') as f:
+            self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.archive_size, self.archive_mtime_ns, table_count, width = \
+            _KEY_INDEX_HEADER.unpack_from(self._buffer, 0)
+        if magic != KEY_INDEX_MAGIC or width != KEY_INDEX_WIDTH:
+            self._buffer.close()
+            raise ValueError(f"Неподдерживаемый формат индекса: {self.path}")
+
+        # Таблицы в порядке слияния (родители раньше детей) и их родительские таблицы
+        self.tables: Dict[str, TableKeys] = {}
+        self.parents: Dict[str, Tuple[str, ...]] = {}
+        masks: Dict[str, int] = {}
+        for i in range(table_count):
+            name, offset, count, xor, total, parent_mask = _KEY_INDEX_TABLE.unpack_from(
+                self._buffer, _KEY_INDEX_HEADER.size + i * _KEY_INDEX_TABLE.size
+            )
+            table_name = name.rstrip(b'\0').decode('utf-8')
+            self.tables[table_name] = TableKeys(self._buffer, offset, count, xor, total)
+            masks[table_name] = parent_mask
+        names = list(self.tables)
+        for table_name, parent_mask in masks.items():
+            self.parents[table_name] = tuple(parent for j, parent in enumerate(names) if parent_mask >> j & 1)
+
+    def __getitem__(self, table_name: str) -> TableKeys:
+        return self.tables[table_name]
+
+    def children(self, table_name: str) -> List[str]:
+        """Таблицы индекса, ссылающиеся на table_name"""
+        return [child for child, parents in self.parents.items() if table_name in parents]
+
+    def is_fresh(self, archive_path: Path) -> bool:
+        """Соответствует ли индекс текущему состоянию архива (размер и mtime)"""
+        stat = Path(archive_path).stat()
+        return stat.st_size == self.archive_size and stat.st_mtime_ns == self.archive_mtime_ns
+
+    def close(self) -> None:
+        self.tables = {}
+        self._buffer.close()
+
+    def __enter__(self) -> 'KeyIndex':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def open_key_index(archive_path: Path, index_dir: Optional[Path] = None) -> KeyIndex:
+    """Открытие индекса архива с перестроением, если он отсутствует или устарел"""
+    index_path = default_key_index_path(archive_path, index_dir)
+    if index_path.exists():
+        try:
+            index = KeyIndex(index_path)
+        except (ValueError, struct.error):
+            index = None
+        if index is not None and index.is_fresh(archive_path):
+            return index
+        if index is not None:
+            index.close()
+    logger.debug(f"Построение индекса ключей: {index_path}")
+    return KeyIndex(build_key_index(archive_path, index_path))
+
+
+def count_overlap(a: TableKeys, b: TableKeys) -> int:
+    """Количество общих ключей двух таблиц (слияние отсортированных массивов)"""
+    if len(a) > len(b):
+        a, b = b, a
+    # Маленький массив против большого: двоичный поиск дешевле полного прохода
+    if len(a) * 16 < len(b):
+        return sum(1 for key in a if key in b)
+
+    count = 0
+    it_a, it_b = iter(a), iter(b)
+    key_a, key_b = next(it_a, None), next(it_b, None)
+    while key_a is not None and key_b is not None:
+        if key_a == key_b:
+            count += 1
+            key_a, key_b = next(it_a, None), next(it_b, None)
+        elif key_a < key_b:
+            key_a = next(it_a, None)
+        else:
+            key_b = next(it_b, None)
+    return count
+
+
+def iter_new_keys(table_keys: TableKeys, others: Iterable[TableKeys]) -> Iterator[Tuple[bytes, int]]:
+    """Ключи таблицы, которых нет ни в одном из других индексов
+
+    Другие индексы объединяются k-way слиянием (heapq.merge) в один
+    отсортированный поток, который проходится синхронно с table_keys.
+
+    Yields:
+        (ключ, rowid) новых записей по возрастанию ключа
+    """
+    merged = heapq.merge(*others)
+    other_key = next(merged, None)
+    for key, rowid in table_keys.items():
+        while other_key is not None and other_key < key:
+            other_key = next(merged, None)
+        if other_key != key:
+            yield key, rowid
+
+
+def _is_subsumed(table_keys: TableKeys, others: List[TableKeys]) -> bool:
+    """Все ключи таблицы уже есть в других индексах
+
+    Дешёвые проверки идут первыми: пустая таблица, сумма размеров, совпадение
+    сигнатуры (число ключей, XOR и сумма префиксов) с одной из таблиц, затем
+    вложение в одну таблицу и только потом проход по объединению всех.
+    """
+    if len(table_keys) == 0:
+        return True
+    if len(table_keys) > sum(len(other) for other in others):
+        return False
+    candidates = sorted(others, key=len, reverse=True)
+    for other in candidates:
+        if other.signature == table_keys.signature:
+            return True
+        if len(other) >= len(table_keys) and count_overlap(table_keys, other) == len(table_keys):
+            return True
+    return len(candidates) > 1 and next(iter_new_keys(table_keys, candidates), None) is None
+
+
+@dataclass
+class SubsumedPlan:
+    """Результат plan_subsumed: таблицы без новых записей по архивам
+
+    tables - все таблицы индексов; таблица, которой нет в архиве, тоже
+    считается пропускаемой, поэтому архив не нужно распаковывать (drops),
+    только если пропускаются все таблицы.
+    """
+    tables: FrozenSet[str]
+    skipped: Dict[Path, FrozenSet[str]]
+
+    def __getitem__(self, archive: Path) -> FrozenSet[str]:
+        return self.skipped[archive]
+
+    def drops(self, archive: Path) -> bool:
+        return self.skipped[archive] >= self.tables
+
+
+def plan_subsumed(archive_paths: List[Path], index_dir: Optional[Path] = None) -> SubsumedPlan:
+    """Таблицы каждого архива, которые не добавят в слияние новых записей
+
+    Архивы просматриваются от последнего к первому: таблица пропускается,
+    если её ключи покрыты той же таблицей уже учтённых архивов. Ключи Note
+    и UserMark включают версию записи, поэтому результат не зависит от того,
+    в каком по порядку архиве лежит более новая версия. Родительская
+    таблица пропускается, только если пропущены все её дочерние таблицы в
+    этом же архиве, чтобы внешние ключи оставшихся записей сопоставлялись.
+    Учитываются все таблицы реестра схемы (включая InputField, PlaylistItem,
+    IndependentMedia), а не только TABLE_ORDER. Ключи индекса не зависят от
+    нумерации ID архива (внешние ключи заменены ключами родителей, см.
+    _table_key_digests). Используются файлы индекса ключей
+    (open_key_index), строки архивов не читаются и не хэшируются, пока
+    индекс актуален.
+
+    Returns:
+        SubsumedPlan: {архив: таблицы, которые можно пропустить}; архив, у
+        которого пропускаются все таблицы (plan.drops), можно не распаковывать
+    """
+    if index_dir is not None:
+        Path(index_dir).mkdir(parents=True, exist_ok=True)
+    indexes: List[KeyIndex] = []
     try:
-        with zipfile.ZipFile(output_archive_path, 'w', compression=zipfile.ZIP_DEFLATED) as zipf:
-            zipf.write(db_path, 'userData.db')
-            zipf.write(manifest_path, 'manifest.json')
-        
-        print(f"Архив бэкапа создан: {output_archive_path}")
+        for archive in archive_paths:
+            indexes.append(open_key_index(archive, index_dir))
+        tables = frozenset(table_name for index in indexes for table_name in index.tables)
+        included: Dict[str, List[TableKeys]] = {table_name: [] for table_name in tables}
+        skipped_by_archive: Dict[Path, FrozenSet[str]] = {}
+        for archive, index in reversed(list(zip(archive_paths, indexes))):
+            skipped: Set[str] = set()
+            for table_name in reversed(list(index.tables)):
+                table_keys = index[table_name]
+                if (all(child in skipped for child in index.children(table_name))
+                        and _is_subsumed(table_keys, included[table_name])):
+                    skipped.add(table_name)
+                else:
+                    included[table_name].append(table_keys)
+            # Таблиц, которых нет в архиве, он не дополняет
+            skipped_by_archive[archive] = frozenset(skipped | (tables - set(index.tables)))
+        return SubsumedPlan(tables, skipped_by_archive)
     finally:
-        os.unlink(manifest_path)
+        for index in indexes:
+            index.close()
 
 
-def main():
-    parser = argparse.ArgumentParser(description='Объединение нескольких бэкапов JW Library в один')
-    parser.add_argument('input_dir', help='Директория с архивами .jwlibrary')
-    parser.add_argument('-o', '--output', help='Выходной архив (по умолчанию: combined_backup.jwlibrary)',
-                        default='combined_backup.jwlibrary')
-    parser.add_argument('--output-dir', help='Директория для сохранения результатов', default='.')
-    parser.add_argument('-v', '--verbose', action='store_true', help='Включить подробный вывод (debug режим)')
-    parser.add_argument('--dry-run', action='store_true', help='Режим проверки без записи файлов')
-    parser.add_argument('--log-file', help='Путь к файлу лога (по умолчанию: jwl_backup_merger.log)',
-                        default='jwl_backup_merger.log')
+# Экспорт записей в NDJSON/CSV прямо из архивов .jwlibrary
+
+# Виды экспортируемых записей: {вид: (основная таблица, [(таблица, столбец основной, столбец таблицы), ...])}
+# Соединения - LEFT JOIN; пропускаются, если столбца нет в схеме архива
+EXPORT_KINDS: Dict[str, Tuple[str, List[Tuple[str, str, str]]]] = {
+    'note': ('Note', [('Location', 'LocationId', 'LocationId')]),
+    'highlight': ('UserMark', [('BlockRange', 'UserMarkId', 'UserMarkId'), ('Location', 'LocationId', 'LocationId')]),
+    'bookmark': ('Bookmark', [('Location', 'LocationId', 'LocationId')]),
+    'tag': ('TagMap', [('Tag', 'TagId', 'TagId'), ('Location', 'LocationId', 'LocationId'),
+                       ('Note', 'NoteId', 'NoteId')]),
+}
+
+EXPORT_FORMATS: Tuple[str, ...] = ('ndjson', 'csv')
+
+
+def _export_query(conn: sqlite3.Connection, kind: str) -> Optional[Tuple[str, List[str]]]:
+    """SQL выборки записей вида kind и имена полей результата
+
+    Столбцы основной таблицы называются как есть, столбцы соединённых -
+    "Таблица.Столбец". None, если основной таблицы нет в базе.
+    """
+    table_name, joins = EXPORT_KINDS[kind]
+    columns = _table_columns(conn, table_name)
+    if not columns:
+        return None
+    select = [f't0."{column}"' for column in columns]
+    fields = list(columns)
+    from_clause = f'"{table_name}" t0'
+    for i, (join_table, column, join_column) in enumerate(joins, 1):
+        join_columns = _table_columns(conn, join_table)
+        if column not in columns or join_column not in join_columns:
+            continue
+        from_clause += f' LEFT JOIN "{join_table}" t{i} ON t{i}."{join_column}" = t0."{column}"'
+        select += [f't{i}."{c}"' for c in join_columns if c != join_column]
+        fields += [f'{join_table}.{c}' for c in join_columns if c != join_column]
+    order = PRIMARY_KEYS.get(table_name)
+    sql = f'SELECT {", ".join(select)} FROM {from_clause}' + (f' ORDER BY t0."{order}"' if order in columns else '')
+    return sql, fields
+
+
+def iter_export_rows(
+    conn: sqlite3.Connection,
+    kind: str,
+    batch_size: int = DEFAULT_BATCH_SIZE
+) -> Iterator[Dict[str, object]]:
+    """Записи вида kind (см. EXPORT_KINDS) как словари, порциями fetchmany"""
+    query = _export_query(conn, kind)
+    if query is None:
+        logger.debug(f"  {kind}: таблица {EXPORT_KINDS[kind][0]} не найдена")
+        return
+    sql, fields = query
+    for row in iter_fetchmany(conn.execute(sql), batch_size):
+        yield dict(zip(fields, row))
+
+
+def _spool_archive_db(archive_path: Path, directory: Path) -> Path:
+    """Потоковое копирование базы из архива во временный файл (без чтения в память)"""
+    with zipfile.ZipFile(archive_path, 'r') as zf:
+        names = set(zf.namelist())
+        db_member = next((name for name in DB_MEMBER_NAMES if name in names), None)
+        if db_member is None:
+            raise ValueError(f"В архиве {archive_path.name} нет файла базы данных userData.db")
+        db_path = directory / 'userData.db'
+        with zf.open(db_member) as src, open(db_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+    return db_path
+
+
+def export_records(
+    archive_paths: List[Path],
+    kinds: Iterable[str] = tuple(EXPORT_KINDS),
+    batch_size: int = DEFAULT_BATCH_SIZE
+) -> Iterator[Dict[str, object]]:
+    """Поток записей из архивов для экспорта
+
+    Каждая запись дополняется полями "kind" (вид записи) и "source" (имя
+    архива). В памяти одновременно не больше batch_size записей; база
+    архива распаковывается во временный файл, удаляемый после архива.
+    """
+    kinds = list(kinds)
+    for archive_path in archive_paths:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            conn = sqlite3.connect(str(_spool_archive_db(Path(archive_path), Path(temp_dir))))
+            try:
+                for kind in kinds:
+                    for record in iter_export_rows(conn, kind, batch_size):
+                        yield {'kind': kind, 'source': Path(archive_path).name, **record}
+            finally:
+                conn.close()
+
+
+def write_ndjson(records: Iterable[Dict[str, object]], stream: TextIO) -> int:
+    """Запись по одному JSON-объекту на строку; возвращает число записей"""
+    count = 0
+    for record in records:
+        stream.write(json.dumps(record, ensure_ascii=False, default=str))
+        stream.write('\n')
+        count += 1
+    return count
+
+
+def write_csv(records: Iterable[Dict[str, object]], stream: TextIO) -> int:
+    """Запись CSV; заголовок - поля первой записи, лишние поля отбрасываются
+
+    Returns:
+        Число записей
+    """
+    writer = None
+    count = 0
+    for record in records:
+        if writer is None:
+            writer = csv.DictWriter(stream, fieldnames=list(record), extrasaction='ignore', restval='')
+            writer.writeheader()
+        writer.writerow(record)
+        count += 1
+    return count
 
-    args = parser.parse_args()
 
-    # Настройка логирования
-    log_level = logging.DEBUG if args.verbose else logging.INFO
+def setup_logging(verbose: bool, log_file: str, console: bool = True) -> None:
+    """Настройка консольного (stderr) и файлового логирования для CLI"""
+    log_level = logging.DEBUG if verbose else logging.INFO
 
     # Консольный обработчик
-    console_handler = logging.StreamHandler()
-    console_handler.setLevel(log_level)
-    console_formatter = logging.Formatter('%(levelname)s: %(message)s')
-    console_handler.setFormatter(console_formatter)
-    logger.addHandler(console_handler)
+    if console:
+        console_handler = logging.StreamHandler()
+        console_handler.setLevel(log_level)
+        console_formatter = logging.Formatter('%(levelname)s: %(message)s')
+        console_handler.setFormatter(console_formatter)
+        logger.addHandler(console_handler)
 
     # Файловый обработчик - всегда записываем лог
-    file_handler = logging.FileHandler(args.log_file, mode='w', encoding='utf-8')
+    file_handler = logging.FileHandler(log_file, mode='w', encoding='utf-8')
     file_handler.setLevel(logging.DEBUG)
     file_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
     file_handler.setFormatter(file_formatter)
     logger.addHandler(file_handler)
 
-    logger.info(f"Лог записывается в файл: {args.log_file}")
+    logger.info(f"Лог записывается в файл: {log_file}")
+
+
+def count_table_records(db_path: Path) -> Dict[str, int]:
+    """Подсчёт количества записей в каждой таблице объединённой базы"""
+    conn = sqlite3.connect(str(db_path))
+    try:
+        results = _count_tables(conn)
+    finally:
+        conn.close()
+    return results
+
+
+# Предварительная проверка архивов до начала слияния
+
+@dataclass
+class PreflightReport:
+    """Результат проверки одного архива: ошибки исключают архив из слияния"""
+    path: Path
+    errors: List[str] = field(default_factory=list)
+    warnings: List[str] = field(default_factory=list)
+    schema_fingerprint: Optional[str] = None
+    duration: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors
+
+
+class PreflightError(RuntimeError):
+    """Архивы не прошли предварительную проверку, слияние не выполняется"""
+
+
+def schema_fingerprint(conn: sqlite3.Connection) -> str:
+    """SHA-256 описания схемы из sqlite_master (без служебных объектов sqlite_*)"""
+    rows = conn.execute(
+        "SELECT type, name, tbl_name, sql FROM sqlite_master WHERE name NOT LIKE 'sqlite_%' "
+        "ORDER BY type, name"
+    ).fetchall()
+    return hashlib.sha256(json.dumps(rows).encode('utf-8')).hexdigest()
+
+
+def preflight_archive(archive_path: Path) -> PreflightReport:
+    """Проверка архива: CRC членов zip, наличие базы, манифест, схема, quick_check
+
+    Исключения не выбрасываются: все проблемы попадают в отчёт.
+    """
+    start = time.perf_counter()
+    report = PreflightReport(path=archive_path)
+    try:
+        with zipfile.ZipFile(archive_path, 'r') as zf:
+            bad_member = zf.testzip()
+            if bad_member is not None:
+                report.errors.append(f"неверная CRC члена архива {bad_member}")
+                return report
+
+            names = set(zf.namelist())
+            db_member = next((name for name in DB_MEMBER_NAMES if name in names), None)
+            if db_member is None:
+                report.errors.append("нет файла базы данных userData.db")
+                return report
+
+            if 'manifest.json' not in names:
+                report.warnings.append("нет manifest.json")
+            else:
+                try:
+                    json.loads(zf.read('manifest.json'))
+                except ValueError as e:
+                    report.errors.append(f"manifest.json не разбирается: {e}")
+
+            with tempfile.TemporaryDirectory() as temp_dir:
+                db_path = zf.extract(db_member, temp_dir)
+                is_valid, _, message = validate_database_schema(db_path)
+                if not is_valid:
+                    report.errors.append(message)
+                conn = sqlite3.connect(db_path)
+                try:
+                    report.schema_fingerprint = schema_fingerprint(conn)
+                    check = [row[0] for row in conn.execute("PRAGMA quick_check")]
+                    if check != ['ok']:
+                        report.errors.append(f"quick_check: {'; '.join(check[:3])}")
+                except sqlite3.Error as e:
+                    report.errors.append(f"база данных не читается: {e}")
+                finally:
+                    conn.close()
+    except (zipfile.BadZipFile, zlib.error, EOFError, OSError) as e:
+        report.errors.append(f"архив не читается: {e}")
+    finally:
+        report.duration = time.perf_counter() - start
+    return report
+
+
+def run_preflight(archive_files: List[Path], workers: Optional[int] = None) -> List[PreflightReport]:
+    """Параллельная проверка всех архивов в пуле потоков
+
+    Распаковка (zlib) и SQLite отпускают GIL, поэтому потоков достаточно.
+    Схема каждого архива сравнивается со схемой первого (базового):
+    расхождение - предупреждение, так как слияние пропускает
+    несовместимые столбцы.
+
+    Returns:
+        Отчёты в порядке archive_files
+    """
+    workers = workers or min(8, len(archive_files)) or 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        reports = list(executor.map(preflight_archive, archive_files))
+
+    base_fingerprint = reports[0].schema_fingerprint if reports else None
+    for report in reports[1:]:
+        if report.schema_fingerprint and base_fingerprint and report.schema_fingerprint != base_fingerprint:
+            report.warnings.append("схема отличается от схемы базового (первого) архива")
+    return reports
+
+
+def log_preflight_report(reports: List[PreflightReport]) -> bool:
+    """Вывод отчёта предварительной проверки
+
+    Returns:
+        True, если все архивы прошли проверку
+    """
+    failed = [report for report in reports if not report.ok]
+    logger.info(f"Предварительная проверка: {len(reports) - len(failed)} из {len(reports)} архивов в порядке")
+    for report in reports:
+        mark = "✓" if report.ok else "❌"
+        logger.info(f"  {mark} {report.path.name} ({report.duration:.2f} с)")
+        for error in report.errors:
+            logger.error(f"      ошибка: {error}")
+        for warning in report.warnings:
+            logger.warning(f"      предупреждение: {warning}")
+    logger.info(f"  Итог: {'GO' if not failed else 'NO-GO'}")
+    return not failed
+
+
+# Кэш результатов: повторный запуск на неизменённом наборе архивов
+
+def input_set_digest(
+    archive_files: List[Path],
+    merge_filter: Optional[MergeFilter] = None,
+    media: bool = True,
+    verify: bool = True,
+    repair_orphans: bool = False
+) -> str:
+    """Отпечаток набора входных архивов, версии инструмента и опций, влияющих на результат
+
+    Учитываются имя, размер, mtime и CRC файла базы из каталога zip
+    (без распаковки) каждого архива, в порядке сортировки по имени,
+    активный фильтр слияния, отказ от переноса медиафайлов, отказ от
+    проверки и исправление записей-сирот. Опции со значениями по умолчанию
+    в ключ не входят, поэтому прежние записи кэша остаются действительными.
+    """
+    inputs = []
+    for archive in sorted(archive_files, key=lambda path: path.name):
+        stat = archive.stat()
+        db_crc = None
+        try:
+            with zipfile.ZipFile(archive, 'r') as zf:
+                names = set(zf.namelist())
+                db_member = next((name for name in DB_MEMBER_NAMES if name in names), None)
+                if db_member is not None:
+                    db_crc = zf.getinfo(db_member).CRC
+        except zipfile.BadZipFile:
+            # Повреждённый архив отсеет предварительная проверка; в ключе - размер и mtime
+            pass
+        inputs.append([archive.name, stat.st_size, stat.st_mtime_ns, db_crc])
+    key = {'version': __version__, 'inputs': inputs}
+    if merge_filter is not None and merge_filter.active:
+        key['filter'] = merge_filter.describe()
+    if not media:
+        key['media'] = False
+    if not verify:
+        key['verify'] = False
+    elif repair_orphans:
+        key['repair_orphans'] = True
+    payload = json.dumps(key, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """Кэш готовых архивов по отпечатку набора входных архивов
+
+    Запись кэша - директория <digest> с result.jwlibrary и meta.json
+    (количество записей по таблицам, размер и SHA-256 архива). meta.json
+    пишется последним, поэтому недописанная запись не считается попаданием.
+    Счётчики hits и misses доступны для итогов и метрик.
+    """
+
+    RESULT_NAME = 'result.jwlibrary'
+    META_NAME = 'meta.json'
+
+    def __init__(self, directory: Union[str, Path]):
+        self.directory = Path(directory)
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, digest: str) -> Optional[Dict]:
+        """Метаданные действительной записи кэша или None"""
+        entry = self.directory / digest
+        try:
+            meta = json.loads((entry / self.META_NAME).read_text(encoding='utf-8'))
+            cached_hash, cached_size = _file_digest(entry / self.RESULT_NAME)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        if cached_size != meta.get('size') or cached_hash != meta.get('sha256'):
+            logger.warning(f"Запись кэша {digest[:12]} повреждена и будет перезаписана")
+            self.misses += 1
+            return None
+        self.hits += 1
+        return meta
+
+    def restore(self, digest: str, output_path: Path) -> None:
+        """Копирование закэшированного архива в output_path"""
+        shutil.copyfile(self.directory / digest / self.RESULT_NAME, output_path)
+
+    def store(self, digest: str, archive_path: Path, tables: Dict[str, int]) -> None:
+        """Сохранение готового архива в кэш"""
+        entry = self.directory / digest
+        entry.mkdir(parents=True, exist_ok=True)
+        partial = entry / (self.RESULT_NAME + '.part')
+        shutil.copyfile(archive_path, partial)
+        sha256, size = _file_digest(partial)
+        os.replace(partial, entry / self.RESULT_NAME)
+        meta = {
+            'version': __version__,
+            'created': datetime.now().isoformat(),
+            'tables': tables,
+            'size': size,
+            'sha256': sha256,
+        }
+        partial_meta = entry / (self.META_NAME + '.part')
+        partial_meta.write_text(json.dumps(meta, ensure_ascii=False, indent=2), encoding='utf-8')
+        os.replace(partial_meta, entry / self.META_NAME)
+
+
+def run_merge(
+    archive_files: List[Path],
+    output_archive_path: Path,
+    verbose: bool = False,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    progress: Optional[JsonlProgress] = None,
+    profiler: Optional[RunProfiler] = None,
+    cache: Optional[ResultCache] = None,
+    merge_filter: Optional[MergeFilter] = None,
+    skip_subsumed: bool = False,
+    index_dir: Optional[Path] = None,
+    workers: int = 1,
+    verify: bool = True,
+    repair_orphans: bool = False,
+    media: bool = True,
+    preflight: Optional[Callable[[List[Path]], List[Path]]] = None
+) -> Dict[str, int]:
+    """Полный цикл слияния: база данных, подсчёт, манифест и архив
+
+    Args:
+        archive_files: Список путей к архивам .jwlibrary
+        output_archive_path: Путь к выходному архиву
+        verbose: Включить подробный вывод
+        batch_size: Количество записей, читаемых из исходной таблицы за раз
+        progress: Поток событий прогресса (по архивам и таблицам)
+        profiler: Профилировщик этапов merge, count, manifest, archive
+        cache: Кэш результатов; при попадании архив копируется из кэша без слияния
+        merge_filter: Фильтр таблиц и дат (см. MergeFilter)
+        skip_subsumed: Пропускать таблицы и архивы без новых записей (по индексам ключей)
+        index_dir: Директория файлов индекса ключей
+        workers: Количество процессов для слияния деревом (1 - последовательно)
+        verify: Проверить объединённую базу после слияния (см. verify_merged_db)
+        repair_orphans: Исправить записи-сироты, найденные проверкой
+        media: Перенести медиафайлы входных архивов (без повторного сжатия)
+        preflight: Проверка архивов, выполняемая только при промахе кэша;
+            возвращает архивы для слияния
+
+    Returns:
+        Количество записей по таблицам в объединённой базе
+
+    Raises:
+        PreflightError: Если архивы не прошли проверку preflight
+    """
+    if cache is not None:
+        digest = input_set_digest(archive_files, merge_filter, media, verify, repair_orphans)
+        meta = cache.lookup(digest)
+        if progress:
+            progress.cache(meta is not None, digest)
+        if meta is not None:
+            cache.restore(digest, output_archive_path)
+            logger.info(f"Результат взят из кэша ({digest[:12]}): {output_archive_path}")
+            return meta['tables']
+
+    # Проверка архивов нужна только для слияния: попадание в кэш возвращается сразу
+    if preflight is not None:
+        checked_files = preflight(archive_files)
+        if checked_files != archive_files:
+            archive_files = checked_files
+            if cache is not None:
+                digest = input_set_digest(archive_files, merge_filter, media, verify, repair_orphans)
+
+    # Создаём временную директорию для работы
+    with tempfile.TemporaryDirectory() as work_dir:
+        work_path = Path(work_dir)
+        output_db_path = work_path / 'merged_userData.db'
+
+        # Создаём объединённую базу данных
+        logger.info("Шаг 1/4: Создание объединённой базы данных...")
+        pipeline_depth = PIPELINE_DEPTH
+        if profiler is not None:
+            pipeline_depth = profiler.pipeline_depth()
+            if profiler.mode == 'cpu' and workers > 1:
+                logger.warning("Профилирование cpu не видит процессы слияния деревом: используйте --workers 1")
+        with _profile_phase(profiler, 'merge'):
+            merge_result = create_merged_db(
+                archive_files, output_db_path, verbose=verbose, batch_size=batch_size, progress=progress,
+                merge_filter=merge_filter, skip_subsumed=skip_subsumed, index_dir=index_dir,
+                pipeline_depth=pipeline_depth, workers=workers, verify=verify, repair_orphans=repair_orphans,
+                digest=False
+            )
+        logger.info("  ✓ База данных создана")
+        if merge_result.verify is not None:
+            status = '✓' if merge_result.verify.ok else '⚠'
+            logger.info(f"  {status} Проверка целостности: {merge_result.verify.duration:.2f} с")
+
+        # Результаты подсчитаны во время слияния
+        logger.info("Шаг 2/4: Подсчёт результатов...")
+        with _profile_phase(profiler, 'count'):
+            results = merge_result.tables
+            for table, stats in merge_result.table_stats.items():
+                logger.debug(f"  {table}: добавлено {stats.inserted}, обновлено {stats.updated}, "
+                             f"дубликатов {stats.duplicates}")
+        logger.info("  ✓ Результаты подсчитаны")
+
+        # Создаём манифест
+        logger.info("Шаг 3/4: Создание манифеста...")
+        with _profile_phase(profiler, 'manifest'):
+            manifest_data = create_manifest_from_archives(archive_files, output_db_path, merge_result)
+        logger.info("  ✓ Манифест создан")
+
+        # Создаём финальный архив
+        logger.info("Шаг 4/4: Создание финального архива...")
+        with _profile_phase(profiler, 'archive'):
+            media_members = plan_media(archive_files) if media else None
+            # Хэш базы считается при упаковке и записывается в манифест последним
+            merge_result.db_hash = create_backup_archive(
+                output_db_path, manifest_data, output_archive_path, media_members
+            )
+        logger.info(f"  ✓ Архив создан: {output_archive_path}")
+
+    if cache is not None:
+        cache.store(digest, output_archive_path, results)
+
+    return results
+
+
+# Batch-режим: много независимых заданий слияния на одном узле
+
+# Оценочные накладные расходы одного задания (интерпретатор, sqlite кэш)
+BATCH_JOB_BASE_MEMORY = 64 * 1024 * 1024
+
+
+@dataclass
+class BatchJob:
+    """Задание batch-режима: одна входная директория → один выходной архив"""
+    input_dir: Path
+    output: Path
+    archives: List[Path] = field(default_factory=list)
+    compressed_bytes: int = 0
+    db_bytes: int = 0
+    largest_db_bytes: int = 0
+
+    @property
+    def memory_estimate(self) -> int:
+        """Оценка пикового потребления памяти (множества хэшей ~ размер данных)"""
+        return BATCH_JOB_BASE_MEMORY + self.db_bytes
+
+    @property
+    def scratch_estimate(self) -> int:
+        """Оценка временного места на диске: объединённая БД + один распакованный архив + выход"""
+        return self.db_bytes + self.largest_db_bytes + self.compressed_bytes
+
+
+def _parse_size(value: Optional[str]) -> Optional[int]:
+    """Разбор размера вида 512M, 4G, 1024 (байты)"""
+    if value is None:
+        return None
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    value = value.strip().upper().rstrip('B')
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def _scan_batch_job(input_dir: Path, output: Path) -> BatchJob:
+    """Сбор списка архивов задания и оценка его размера по каталогу zip"""
+    job = BatchJob(input_dir=input_dir, output=output)
+    if not input_dir.is_dir():
+        return job
+
+    job.archives = sorted(input_dir.glob('*.jwlibrary'))
+    for archive in job.archives:
+        job.compressed_bytes += archive.stat().st_size
+        try:
+            with zipfile.ZipFile(archive, 'r') as zf:
+                db_size = sum(
+                    info.file_size for info in zf.infolist()
+                    if info.filename in DB_MEMBER_NAMES
+                )
+        except zipfile.BadZipFile:
+            db_size = 0
+        job.db_bytes += db_size
+        job.largest_db_bytes = max(job.largest_db_bytes, db_size)
+    return job
+
+
+def load_batch_jobs(jobs_file: Path) -> List[BatchJob]:
+    """Загрузка списка заданий из CSV или JSON
+
+    CSV: столбцы ``input_dir`` и ``output`` (строка заголовка обязательна).
+    JSON: список объектов ``{"input_dir": ..., "output": ...}``
+    или словарь ``{input_dir: output}``.
+
+    Относительные пути считаются от директории файла заданий.
+
+    Returns:
+        Список заданий, отсортированный от самых больших к самым маленьким
+    """
+    base_dir = Path(jobs_file).parent
+    with open(jobs_file, 'r', encoding='utf-8', newline='') as f:
+        if Path(jobs_file).suffix.lower() == '.json':
+            data = json.load(f)
+            if isinstance(data, dict):
+                pairs = list(data.items())
+            else:
+                pairs = [(item['input_dir'], item['output']) for item in data]
+        else:
+            pairs = [(row['input_dir'], row['output']) for row in csv.DictReader(f)]
+
+    jobs = []
+    for input_dir, output in pairs:
+        jobs.append(_scan_batch_job(base_dir / input_dir, base_dir / output))
+
+    # Самые большие задания первыми (LPT) - лучшая упаковка по воркерам
+    jobs.sort(key=lambda job: job.db_bytes, reverse=True)
+    return jobs
+
+
+def _batch_worker_init(scratch_dir: Optional[str]) -> None:
+    """Инициализация процесса-воркера: временные файлы в scratch-директории
+
+    При fork воркер наследует обработчики логгера родителя, в том числе
+    FileHandler общего лога - записи параллельных заданий перемешались бы
+    в одном файле. Унаследованные обработчики снимаются: каждое задание
+    пишет свой лог (см. ``_run_batch_job``), а итог по заданию выводит
+    родитель по записи результата.
+    """
+    if scratch_dir:
+        tempfile.tempdir = scratch_dir
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+
+
+def _run_batch_job(
+    job: BatchJob,
+    verbose: bool = False,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    cache_dir: Optional[Path] = None
+) -> Dict:
+    """Выполнение одного задания в процессе-воркере
+
+    Лог задания пишется в ``<output>.log`` рядом с результатом.
+
+    Returns:
+        Запись результата (сериализуемая в JSON)
+    """
+    started = datetime.now()
+    log_path = job.output.with_name(job.output.name + '.log')
+    record = {
+        'input_dir': str(job.input_dir),
+        'output': str(job.output),
+        'archives': len(job.archives),
+        'status': 'ok',
+        'started': started.isoformat(),
+        'log': str(log_path),
+    }
+    file_handler = None
+    try:
+        job.output.parent.mkdir(parents=True, exist_ok=True)
+        file_handler = logging.FileHandler(log_path, mode='w', encoding='utf-8')
+        file_handler.setLevel(logging.DEBUG)
+        file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+        logger.addHandler(file_handler)
+        if not job.archives:
+            raise FileNotFoundError(f"Не найдено архивов .jwlibrary в директории {job.input_dir}")
+        cache = ResultCache(cache_dir) if cache_dir is not None else None
+        record['tables'] = run_merge(job.archives, job.output, verbose=verbose, batch_size=batch_size, cache=cache)
+        if cache is not None:
+            record['cache_hit'] = cache.hits > 0
+    except Exception as e:
+        record['status'] = 'error'
+        record['error'] = f"{type(e).__name__}: {e}"
+        logger.error(f"❌ {record['error']}")
+    finally:
+        if file_handler is not None:
+            logger.removeHandler(file_handler)
+            file_handler.close()
+    finished = datetime.now()
+    record['finished'] = finished.isoformat()
+    record['duration'] = (finished - started).total_seconds()
+    return record
+
+
+def run_batch(
+    jobs: List[BatchJob],
+    results_path: Path,
+    workers: Optional[int] = None,
+    max_memory: Optional[int] = None,
+    max_scratch: Optional[int] = None,
+    scratch_dir: Optional[Path] = None,
+    verbose: bool = False,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    cache_dir: Optional[Path] = None
+) -> List[Dict]:
+    """Планирование заданий по пулу процессов с ограничением памяти и диска
+
+    Задания запускаются в порядке убывания размера. Очередное задание
+    отправляется в пул, только если сумма оценок памяти и scratch-места
+    выполняющихся заданий остаётся в пределах лимитов; если ничего не
+    выполняется, задание запускается в любом случае (иначе оно никогда
+    не поместится). Запись результата дописывается в ``results_path``
+    (JSON lines) сразу по завершении каждого задания.
+
+    Returns:
+        Список записей результатов в порядке завершения
+    """
+    workers = workers or os.cpu_count() or 1
+    pending = list(jobs)
+    running: Dict[concurrent.futures.Future, BatchJob] = {}
+    used_memory = 0
+    used_scratch = 0
+    records = []
+
+    def fits(job: BatchJob) -> bool:
+        if not running:
+            return True
+        if max_memory is not None and used_memory + job.memory_estimate > max_memory:
+            return False
+        if max_scratch is not None and used_scratch + job.scratch_estimate > max_scratch:
+            return False
+        return True
+
+    with open(results_path, 'w', encoding='utf-8') as results_file, \
+            concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_batch_worker_init,
+                initargs=(str(scratch_dir) if scratch_dir else None,)
+            ) as executor:
+        while pending or running:
+            # First-fit по списку, отсортированному по убыванию размера
+            for job in list(pending):
+                if len(running) >= workers:
+                    break
+                if fits(job):
+                    pending.remove(job)
+                    future = executor.submit(_run_batch_job, job, verbose, batch_size, cache_dir)
+                    running[future] = job
+                    used_memory += job.memory_estimate
+                    used_scratch += job.scratch_estimate
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                job = running.pop(future)
+                used_memory -= job.memory_estimate
+                used_scratch -= job.scratch_estimate
+                record = future.result()
+                records.append(record)
+                results_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+                results_file.flush()
+
+                if record['status'] == 'ok':
+                    cached = " из кэша" if record.get('cache_hit') else ""
+                    logger.info(f"  ✓ {job.input_dir} → {job.output}{cached} ({record['duration']:.1f} с)")
+                else:
+                    logger.error(f"  ❌ {job.input_dir}: {record['error']}")
+
+    return records
+
+
+def batch_main(argv: List[str]) -> None:
+    """Точка входа подкоманды ``batch``"""
+    parser = argparse.ArgumentParser(
+        prog='jwl_backup_merger.py batch',
+        description='Пакетное объединение: много директорий с архивами по списку заданий'
+    )
+    parser.add_argument('jobs_file', help='Список заданий: CSV (input_dir,output) или JSON')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='Количество процессов (по умолчанию: число ядер)')
+    parser.add_argument('--max-memory', default=None,
+                        help='Лимит суммарной оценки памяти выполняющихся заданий (например, 8G)')
+    parser.add_argument('--max-scratch', default=None,
+                        help='Лимит суммарного временного места на диске (например, 20G)')
+    parser.add_argument('--scratch-dir', default=None, help='Директория для временных файлов')
+    parser.add_argument('--results', default='batch_results.jsonl',
+                        help='Файл результатов, по одной JSON-записи на задание')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help=f'Записей за одно чтение из исходной таблицы (по умолчанию: {DEFAULT_BATCH_SIZE})')
+    parser.add_argument('--cache-dir', default=None,
+                        help='Директория кэша результатов (без неё кэш не используется)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Включить подробный вывод (debug режим)')
+    parser.add_argument('--log-file', help='Путь к файлу лога (по умолчанию: jwl_backup_merger.log)',
+                        default='jwl_backup_merger.log')
+
+    args = parser.parse_args(argv)
+    setup_logging(args.verbose, args.log_file)
+
+    jobs_file = Path(args.jobs_file)
+    if not jobs_file.exists():
+        logger.error(f"❌ ОШИБКА: Файл заданий {jobs_file} не существует")
+        sys.exit(1)
+
+    jobs = load_batch_jobs(jobs_file)
+    logger.info(f"Загружено {len(jobs)} заданий из {jobs_file}")
+
+    start_time = datetime.now()
+    records = run_batch(
+        jobs,
+        Path(args.results),
+        workers=args.workers,
+        max_memory=_parse_size(args.max_memory),
+        max_scratch=_parse_size(args.max_scratch),
+        scratch_dir=Path(args.scratch_dir) if args.scratch_dir else None,
+        verbose=args.verbose,
+        batch_size=args.batch_size,
+        cache_dir=Path(args.cache_dir) if args.cache_dir else None
+    )
+    failed = [r for r in records if r['status'] != 'ok']
+    cached = [r for r in records if r.get('cache_hit')]
+
+    logger.info(f"\n{'='*60}")
+    logger.info("ИТОГИ BATCH")
+    logger.info(f"{'='*60}")
+    logger.info(f"Длительность: {datetime.now() - start_time}")
+    logger.info(f"Заданий: {len(records)}, успешно: {len(records) - len(failed)}, с ошибкой: {len(failed)}")
+    if args.cache_dir:
+        logger.info(f"Из кэша: {len(cached)}")
+    logger.info(f"Результаты: {args.results}")
+    logger.info(f"{'='*60}")
+
+    if failed:
+        sys.exit(1)
+
+
+def diff_main(argv: List[str]) -> None:
+    """Точка входа подкоманды ``diff``"""
+    parser = argparse.ArgumentParser(
+        prog='jwl_backup_merger.py diff',
+        description='Сравнение двух бэкапов: добавленные и удалённые записи по таблицам'
+    )
+    parser.add_argument('old', help='Старый архив .jwlibrary')
+    parser.add_argument('new', help='Новый архив .jwlibrary')
+    parser.add_argument('-o', '--output', default=None,
+                        help='Записать архив-дельту только с новыми записями')
+    parser.add_argument('--json', action='store_true', help='Вывести результат в stdout в формате JSON')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Включить подробный вывод (debug режим)')
+    parser.add_argument('--log-file', help='Путь к файлу лога (по умолчанию: jwl_backup_merger.log)',
+                        default='jwl_backup_merger.log')
+
+    args = parser.parse_args(argv)
+    setup_logging(args.verbose, args.log_file)
+
+    for path in (args.old, args.new):
+        if not Path(path).exists():
+            logger.error(f"❌ ОШИБКА: Файл {path} не существует")
+            sys.exit(1)
+
+    result = diff_backups(Path(args.old), Path(args.new), delta_output=args.output)
+
+    if args.json:
+        json.dump({'added': result.added, 'removed': result.removed, 'delta_records': result.delta_records,
+                   'duration': result.duration}, sys.stdout, ensure_ascii=False)
+        sys.stdout.write("\n")
+        return
+
+    logger.info(f"\n{'='*60}")
+    logger.info(f"DIFF: {args.old} → {args.new}")
+    logger.info(f"{'='*60}")
+    for table_name in TABLE_ORDER:
+        logger.info(f"   {table_name}: +{result.added[table_name]} / -{result.removed[table_name]}")
+    logger.info("   ─────────────────")
+    logger.info(f"   ВСЕГО: +{sum(result.added.values())} / -{sum(result.removed.values())}")
+    if args.output:
+        logger.info(f"\nДельта: {args.output} ({result.delta_records} записей)")
+    logger.info(f"Длительность: {result.duration:.2f} с")
+    logger.info(f"{'='*60}")
+
+
+def index_main(argv: List[str]) -> None:
+    """Точка входа подкоманды ``index``"""
+    parser = argparse.ArgumentParser(
+        prog='jwl_backup_merger.py index',
+        description='Построение индексов ключей и отчёт о новых записях в каждом архиве'
+    )
+    parser.add_argument('input_dir', help='Директория с архивами .jwlibrary')
+    parser.add_argument('--index-dir', default=None,
+                        help='Директория для файлов индекса (по умолчанию: рядом с архивами)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Включить подробный вывод (debug режим)')
+    parser.add_argument('--log-file', help='Путь к файлу лога (по умолчанию: jwl_backup_merger.log)',
+                        default='jwl_backup_merger.log')
+
+    args = parser.parse_args(argv)
+    setup_logging(args.verbose, args.log_file)
+
+    input_dir = Path(args.input_dir)
+    archive_files = sorted(input_dir.glob('*.jwlibrary'))
+    if not archive_files:
+        logger.error(f"❌ ОШИБКА: Не найдено архивов .jwlibrary в директории {input_dir}")
+        sys.exit(1)
+    index_dir = Path(args.index_dir) if args.index_dir else None
+    if index_dir:
+        index_dir.mkdir(parents=True, exist_ok=True)
+
+    # Архивы по порядку имён: для каждого - записи, которых нет в предыдущих
+    indexes: List[KeyIndex] = []
+    try:
+        for archive in archive_files:
+            index = open_key_index(archive, index_dir)
+            new_counts = {
+                table_name: sum(1 for _ in iter_new_keys(
+                    table_keys, [prev.tables[table_name] for prev in indexes if table_name in prev.tables]
+                ))
+                for table_name, table_keys in index.tables.items()
+            }
+            indexes.append(index)
+            total = sum(len(table_keys) for table_keys in index.tables.values())
+            logger.info(f"  {archive.name}: {total} ключей, новых {sum(new_counts.values())} "
+                        f"({', '.join(f'{t}: {n}' for t, n in new_counts.items() if n)})")
+    finally:
+        for index in indexes:
+            index.close()
+
+
+def export_main(argv: List[str]) -> None:
+    """Точка входа подкоманды ``export``"""
+    parser = argparse.ArgumentParser(
+        prog='jwl_backup_merger.py export',
+        description='Потоковый экспорт заметок, выделений, закладок и тегов в NDJSON или CSV'
+    )
+    parser.add_argument('archives', nargs='+', help='Архивы .jwlibrary')
+    parser.add_argument('--kind', default=','.join(EXPORT_KINDS),
+                        help=f'Виды записей через запятую (по умолчанию: {",".join(EXPORT_KINDS)})')
+    parser.add_argument('--format', choices=EXPORT_FORMATS, default='ndjson', help='Формат вывода')
+    parser.add_argument('-o', '--output', default='-', help='Выходной файл (по умолчанию: stdout)')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help=f'Записей за одно чтение из базы (по умолчанию: {DEFAULT_BATCH_SIZE})')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Включить подробный вывод (debug режим)')
+    parser.add_argument('--log-file', help='Путь к файлу лога (по умолчанию: jwl_backup_merger.log)',
+                        default='jwl_backup_merger.log')
+
+    args = parser.parse_args(argv)
+    kinds = [kind.strip() for kind in args.kind.split(',') if kind.strip()]
+    unknown = [kind for kind in kinds if kind not in EXPORT_KINDS]
+    if unknown or not kinds:
+        parser.error(f"неизвестные виды записей: {', '.join(unknown) or 'пустой список'}; "
+                     f"допустимы: {', '.join(EXPORT_KINDS)}")
+    if args.format == 'csv' and len(kinds) > 1:
+        parser.error("для CSV укажите один вид записей в --kind: у видов разные столбцы")
+    setup_logging(args.verbose, args.log_file)
+
+    archive_paths = [Path(path) for path in args.archives]
+    for path in archive_paths:
+        if not path.exists():
+            logger.error(f"❌ ОШИБКА: Файл {path} не существует")
+            sys.exit(1)
+
+    write = write_csv if args.format == 'csv' else write_ndjson
+    records = export_records(archive_paths, kinds, args.batch_size)
+    start = time.perf_counter()
+    if args.output == '-':
+        count = write(records, sys.stdout)
+        sys.stdout.flush()
+    else:
+        with open(args.output, 'w', encoding='utf-8', newline='') as f:
+            count = write(records, f)
+    logger.info(f"Экспортировано записей: {count} ({time.perf_counter() - start:.2f} с)")
+
+
+def _parse_table_list(value: str) -> FrozenSet[str]:
+    """Тип аргумента --tables: имена таблиц через запятую"""
+    tables = frozenset(name.strip() for name in value.split(',') if name.strip())
+    unknown = tables - ALLOWED_TABLES
+    if unknown or not tables:
+        raise argparse.ArgumentTypeError(
+            f"неизвестные таблицы: {', '.join(sorted(unknown)) or 'пустой список'}; допустимы: {', '.join(TABLE_ORDER)}"
+        )
+    return tables
+
+
+def _parse_filter_date(value: str) -> str:
+    """Тип аргументов --since/--until: дата YYYY-MM-DD или дата и время ISO 8601"""
+    try:
+        datetime.strptime(value[:10], '%Y-%m-%d')
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"ожидается дата YYYY-MM-DD: {value!r}")
+    return value
+
+
+# Подкоманды CLI; без подкоманды первый аргумент - директория с архивами
+SUBCOMMANDS = {
+    'batch': batch_main,
+    'diff': diff_main,
+    'index': index_main,
+    'export': export_main,
+}
+
+
+def main(argv: Optional[List[str]] = None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv and argv[0] in SUBCOMMANDS:
+        return SUBCOMMANDS[argv[0]](argv[1:])
+
+    parser = argparse.ArgumentParser(description='Объединение нескольких бэкапов JW Library в один')
+    parser.add_argument('input_dir', help='Директория с архивами .jwlibrary (или подкоманда: batch, diff, index, export)')
+    parser.add_argument('-o', '--output', help='Выходной архив (по умолчанию: combined_backup.jwlibrary)',
+                        default='combined_backup.jwlibrary')
+    parser.add_argument('--output-dir', help='Директория для сохранения результатов', default='.')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Включить подробный вывод (debug режим)')
+    parser.add_argument('--dry-run', action='store_true', help='Режим проверки без записи файлов')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help=f'Записей за одно чтение из исходной таблицы (по умолчанию: {DEFAULT_BATCH_SIZE})')
+    parser.add_argument('--log-file', help='Путь к файлу лога (по умолчанию: jwl_backup_merger.log)',
+                        default='jwl_backup_merger.log')
+    parser.add_argument('--progress', choices=['none', 'jsonl'], default='none',
+                        help='Машиночитаемый прогресс (jsonl: одно JSON-событие на строку)')
+    parser.add_argument('--progress-fd', type=int, default=None,
+                        help='Файловый дескриптор для событий прогресса (обязателен с --progress jsonl); '
+                             'при 2 (stderr) лог в консоль не выводится')
+    parser.add_argument('--profile', choices=['none', *PROFILE_MODES], default='none',
+                        help='Профилирование этапов: cpu (cProfile/pstats) или memory (tracemalloc)')
+    parser.add_argument('--cache-dir', default=None,
+                        help='Директория кэша результатов: неизменённый набор архивов не объединяется повторно')
+    parser.add_argument('--skip-preflight', action='store_true',
+                        help='Не проверять архивы перед слиянием')
+    parser.add_argument('--drop-bad', action='store_true',
+                        help='Исключить архивы, не прошедшие проверку, и продолжить')
+    parser.add_argument('--tables', type=_parse_table_list, default=None,
+                        help='Объединять только эти таблицы (через запятую); родительские добавляются автоматически')
+    parser.add_argument('--since', type=_parse_filter_date, default=None,
+                        help='Только записи, изменённые не раньше этой даты (YYYY-MM-DD)')
+    parser.add_argument('--until', type=_parse_filter_date, default=None,
+                        help='Только записи, изменённые не позже этой даты (YYYY-MM-DD)')
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help='Процессов для слияния деревом (по умолчанию: 1 - последовательно)')
+    parser.add_argument('--no-verify', action='store_true',
+                        help='Не проверять объединённую базу (внешние ключи, quick_check, счётчики)')
+    parser.add_argument('--repair-orphans', action='store_true',
+                        help='Исправить записи со ссылками на несуществующие записи, найденные проверкой')
+    parser.add_argument('--no-media', action='store_true',
+                        help='Не переносить медиафайлы (изображения, видео) из входных архивов')
+    parser.add_argument('--skip-subsumed', action='store_true',
+                        help='Пропускать архивы и таблицы без новых записей (по индексам ключей)')
+    parser.add_argument('--index-dir', default=None,
+                        help='Директория файлов индекса ключей для --skip-subsumed (по умолчанию: рядом с архивами)')
+    parser.add_argument('--profile-output',
+                        help='Файл отчёта профилирования (по умолчанию: jwl_backup_merger.prof '
+                             'или jwl_backup_merger.memory.json в директории вывода)')
+
+    args = parser.parse_args(argv)
+    if args.progress == 'jsonl' and args.progress_fd is None:
+        parser.error('--progress jsonl требует --progress-fd (например, --progress-fd 3 3>progress.jsonl)')
+
+    # Настройка логирования; события прогресса в stderr не смешиваются с консольным логом
+    setup_logging(args.verbose, args.log_file, console=not (args.progress == 'jsonl' and args.progress_fd == 2))
 
     input_dir = Path(args.input_dir)
     output_dir = Path(args.output_dir)
@@ -519,7 +4128,7 @@ def main():
         sys.exit(1)
 
     # Находим все архивы
-    archive_files = list(input_dir.glob('*.jwlibrary'))
+    archive_files = sorted(input_dir.glob('*.jwlibrary'))
     if not archive_files:
         logger.error(f"❌ ОШИБКА: Не найдено архивов .jwlibrary в директории {input_dir}")
         logger.error(f"   Добавьте файлы бэкапов в эту директорию")
@@ -531,7 +4140,30 @@ def main():
     logger.info(f"Найдено {len(archive_files)} архивов для объединения")
     logger.info(f"Архивы: {[a.name for a in archive_files]}")
 
+    def preflight(files: List[Path]) -> List[Path]:
+        reports = run_preflight(files)
+        if log_preflight_report(reports):
+            return files
+        good_files = [report.path for report in reports if report.ok]
+        if not args.drop_bad or not good_files:
+            raise PreflightError("Не все архивы прошли предварительную проверку")
+        logger.warning(f"Исключено архивов: {len(files) - len(good_files)}")
+        return good_files
+
+    def preflight_failed(error: PreflightError) -> None:
+        logger.error(f"❌ ОШИБКА: {error}")
+        logger.error("   Исправьте архивы или запустите с --drop-bad, чтобы исключить их")
+
     if args.dry_run:
+        if not args.skip_preflight:
+            try:
+                archive_files = preflight(archive_files)
+            except PreflightError as e:
+                preflight_failed(e)
+                logger.info(f"\n{'='*60}")
+                logger.info("❌ СТАТУС: ОШИБКА")
+                logger.info(f"{'='*60}")
+                sys.exit(1)
         logger.info("DRY-RUN: Режим проверки без записи")
         for archive in archive_files:
             logger.info(f"  - {archive.name}")
@@ -544,47 +4176,31 @@ def main():
     logger.info(f"Выходной файл: {args.output}")
     logger.info(f"Директория вывода: {output_dir.absolute()}")
 
+    cache = ResultCache(args.cache_dir) if args.cache_dir else None
+    merge_filter = MergeFilter(tables=args.tables, since=args.since, until=args.until)
+    index_dir = Path(args.index_dir) if args.index_dir else None
+    if merge_filter.active:
+        logger.info(f"Фильтр: таблицы {', '.join(merge_filter.selected_tables())}, "
+                    f"даты {args.since or '...'} - {args.until or '...'}")
+    profiler = None
+    if args.profile != 'none':
+        profiler = RunProfiler(args.profile, args.profile_output or default_profile_path(args.profile, output_dir))
+
     error_details = None
-    # Создаём временную директорию для работы
     try:
-        with tempfile.TemporaryDirectory() as work_dir:
-            work_path = Path(work_dir)
-            output_db_path = work_path / 'merged_userData.db'
-
-            # Создаём объединённую базу данных
-            logger.info("Шаг 1/4: Создание объединённой базы данных...")
-            create_merged_db(archive_files, output_db_path, verbose=args.verbose)
-            logger.info("  ✓ База данных создана")
-
-            # Подсчитываем результаты
-            logger.info("Шаг 2/4: Подсчёт результатов...")
-            conn = sqlite3.connect(str(output_db_path))
-            cursor = conn.cursor()
-
-            tables = ['Note', 'UserMark', 'Location', 'Tag', 'TagMap', 'Bookmark', 'BlockRange']
-            results = {}
-            for table in tables:
-                try:
-                    cursor.execute(f'SELECT COUNT(*) FROM "{table}"')
-                    count = cursor.fetchone()[0]
-                    results[table] = count
-                except sqlite3.OperationalError:
-                    logger.warning(f"  ⚠ Таблица {table} не существует")
-                    results[table] = 0
-
-            conn.close()
-            logger.info("  ✓ Результаты подсчитаны")
-
-            # Создаём манифест
-            logger.info("Шаг 3/4: Создание манифеста...")
-            manifest_data = create_manifest_from_archives(archive_files, output_db_path)
-            logger.info("  ✓ Манифест создан")
-
-            # Создаём финальный архив
-            logger.info("Шаг 4/4: Создание финального архива...")
-            output_archive_path = output_dir / args.output
-            create_backup_archive(output_db_path, manifest_data, output_archive_path)
-            logger.info(f"  ✓ Архив создан: {output_archive_path}")
+        output_archive_path = output_dir / args.output
+        progress = JsonlProgress.from_fd(args.progress_fd) if args.progress == 'jsonl' else None
+        results = run_merge(
+            archive_files, output_archive_path,
+            verbose=args.verbose, batch_size=args.batch_size, progress=progress, profiler=profiler, cache=cache,
+            merge_filter=merge_filter, skip_subsumed=args.skip_subsumed, index_dir=index_dir, workers=args.workers,
+            verify=not args.no_verify, repair_orphans=args.repair_orphans, media=not args.no_media,
+            preflight=None if args.skip_preflight else preflight
+        )
+
+    except PreflightError as e:
+        preflight_failed(e)
+        error_details = {'type': type(e).__name__, 'message': str(e)}
 
     except Exception as e:
         error_details = {
@@ -601,6 +4217,9 @@ def main():
         logger.error(f"{'='*60}")
 
     finally:
+        if profiler is not None and profiler.phases:
+            profiler.save()
+
         end_time = datetime.now()
         duration = end_time - start_time
 
@@ -621,6 +4240,8 @@ def main():
             sys.exit(1)
         else:
             logger.info(f"\n✅ СТАТУС: УСПЕШНО")
+            if cache is not None:
+                logger.info(f"Кэш: {'попадание, слияние не выполнялось' if cache.hits else 'промах, результат сохранён'}")
             logger.info(f"\nРезультаты по таблицам:")
             for table, count in results.items():
                 logger.info(f"   {table}: {count} записей")
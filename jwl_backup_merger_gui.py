@@ -5,13 +5,20 @@ JW Library Backup Merger - GUI
 Графический интерфейс для объединения бэкапов JW Library.
 """
 
+import contextlib
+import json
+import multiprocessing
 import os
+import queue
+import shutil
 import sys
+import tempfile
 import threading
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 from pathlib import Path
 import logging
+from collections import deque
 from datetime import datetime
 
 # Импортируем функции из основного модуля
@@ -19,9 +26,151 @@ from jwl_backup_merger import (
     create_merged_db,
     create_manifest_from_archives,
     create_backup_archive,
-    validate_database_schema
+    plan_media,
+    validate_database_schema,
+    peek_archive,
+    ArchiveInfo,
+    JsonlProgress,
+    RunProfiler,
+    PROFILE_MODES,
+    PIPELINE_DEPTH,
+    default_profile_path
 )
 
+# Период опроса очереди событий из рабочих потоков, мс
+UI_POLL_MS = 100
+
+# Максимум событий очереди, применяемых за один тик: поток лога не блокирует Tk
+UI_MAX_EVENTS = 500
+
+# Максимум строк в окне лога (старые строки удаляются)
+LOG_MAX_LINES = 1000
+
+# Дочерний процесс слияния запускается через spawn: fork процесса с потоками
+# Tk копирует состояние их блокировок и обработчик QueueLogHandler
+MERGE_CONTEXT = multiprocessing.get_context('spawn')
+
+
+class QueueLogHandler(logging.Handler):
+    """Перенаправление записей logging в очередь событий GUI"""
+    
+    def __init__(self, gui):
+        super().__init__(level=logging.INFO)
+        self.gui = gui
+    
+    def emit(self, record):
+        self.gui.log(record.getMessage())
+
+
+class PipeLogHandler(logging.Handler):
+    """Передача записей logging из дочернего процесса слияния в канал"""
+    
+    def __init__(self, conn):
+        super().__init__(level=logging.INFO)
+        self.conn = conn
+    
+    def emit(self, record):
+        self.conn.send(('log', record.getMessage()))
+
+
+class PipeProgressStream:
+    """Текстовый поток для JsonlProgress: каждое событие уходит в канал"""
+    
+    def __init__(self, conn):
+        self.conn = conn
+    
+    def write(self, text):
+        for line in text.splitlines():
+            if line:
+                self.conn.send(('merge_progress', json.loads(line)))
+    
+    def flush(self):
+        pass
+
+
+def merge_temp_paths(output_path):
+    """Промежуточные файлы слияния: база данных и недописанный архив
+    
+    Архив пишется во временный файл и переименовывается в output_path
+    только в конце, поэтому отмена не портит существующий файл.
+    """
+    return (
+        output_path.with_name(output_path.name + '.merging.db'),
+        output_path.with_name(output_path.name + '.part')
+    )
+
+
+def merge_process(archive_files, output_path, conn, temp_root, profile_mode=None):
+    """Слияние в дочернем процессе
+    
+    Хэширование записей удерживает GIL, поэтому в отдельном процессе оно
+    не мешает циклу событий Tk. Лог, статус и прогресс отправляются в
+    conn; последнее сообщение - ('done', всего записей) или ('error', текст).
+    Временные каталоги распаковки создаются внутри temp_root: после
+    terminate() их удаляет родительский процесс. С profile_mode ('cpu' или
+    'memory') отчёт профилирования этапов сохраняется рядом с выходным файлом.
+    """
+    tempfile.tempdir = str(temp_root)
+    logging.getLogger('jwl_backup_merger').addHandler(PipeLogHandler(conn))
+    temp_db, partial_archive = merge_temp_paths(output_path)
+    profiler = None
+    if profile_mode:
+        profiler = RunProfiler(profile_mode, default_profile_path(profile_mode, output_path.parent))
+    
+    def phase(name):
+        return profiler.phase(name) if profiler else contextlib.nullcontext()
+    
+    try:
+        conn.send(('log', f"Выходной файл: {output_path}"))
+        conn.send(('status', "⏳ Создание объединённой базы данных..."))
+        conn.send(('progress', 10))
+        
+        # Шаг 1: Создание объединённой БД
+        with phase('merge'):
+            merge_result = create_merged_db(
+                archive_files,
+                temp_db,
+                verbose=False,
+                progress=JsonlProgress(PipeProgressStream(conn)),
+                pipeline_depth=profiler.pipeline_depth() if profiler else PIPELINE_DEPTH,
+                digest=False
+            )
+        conn.send(('progress', 40))
+        conn.send(('log', "✓ База данных создана"))
+        
+        # Шаг 2: Результаты (подсчитаны во время слияния)
+        for table, stats in merge_result.table_stats.items():
+            conn.send(('log', f"  {table}: {stats.total} записей (дубликатов: {stats.duplicates})"))
+        total = merge_result.total_records
+        conn.send(('progress', 60))
+        conn.send(('log', f"✓ Всего записей: {total:,}"))
+        
+        # Шаг 3: Создание манифеста
+        conn.send(('status', "⏳ Создание манифеста..."))
+        with phase('manifest'):
+            manifest_data = create_manifest_from_archives(archive_files, temp_db, merge_result)
+        conn.send(('progress', 80))
+        conn.send(('log', "✓ Манифест создан"))
+        
+        # Шаг 4: Создание финального архива
+        conn.send(('status', "⏳ Создание финального архива..."))
+        with phase('archive'):
+            create_backup_archive(temp_db, manifest_data, partial_archive, plan_media(archive_files))
+            os.replace(partial_archive, output_path)
+        conn.send(('progress', 100))
+        conn.send(('log', "✓ Архив создан"))
+        
+        conn.send(('done', total))
+    except Exception as e:
+        conn.send(('error', str(e)))
+    finally:
+        if profiler is not None and profiler.phases:
+            profiler.save()
+        for path in (temp_db, partial_archive):
+            if path.exists():
+                path.unlink()
+        conn.close()
+
 
 class BackupMergerGUI:
     """Графический интерфейс для слияния бэкапов JW Library"""
@@ -36,21 +185,34 @@ class BackupMergerGUI:
         self.output_file = tk.StringVar(value="combined_backup.jwlibrary")
         self.archive_files = []
         self.is_processing = False
+        self.merge_process = None
+        self.cancel_requested = False
+        
+        # Фоновый просмотр папки: номер текущего просмотра и кэш сведений
+        # об архивах {путь: ((размер, mtime_ns), ArchiveInfo)}
+        self.scan_generation = 0
+        self.scan_cache = {}
+        
+        # Очередь событий от рабочих потоков; виджеты меняются только
+        # в потоке Tk, в drain_ui_queue
+        self.ui_queue = queue.Queue()
         
         # Настройка логирования
         self.setup_logging()
         
         # Создание интерфейса
         self.setup_ui()
+        self.root.after(UI_POLL_MS, self.drain_ui_queue)
         
     def setup_logging(self):
         """Настройка логирования в GUI"""
-        self.log_messages = []
+        self.log_messages = deque(maxlen=LOG_MAX_LINES)
         logging.basicConfig(
             level=logging.INFO,
             format='%(levelname)s: %(message)s'
         )
         self.logger = logging.getLogger(__name__)
+        logging.getLogger('jwl_backup_merger').addHandler(QueueLogHandler(self))
         
     def setup_ui(self):
         """Создание элементов интерфейса"""
@@ -124,23 +286,48 @@ class BackupMergerGUI:
         )
         self.browse_output_btn.grid(row=0, column=1)
         
-        # Опция открытия папки
+        # Опции: открытие папки и профилирование
+        options_frame = ttk.Frame(main_frame)
+        options_frame.grid(row=4, column=0, sticky=tk.W, pady=5)
+        
         self.open_folder_var = tk.BooleanVar(value=True)
         open_folder_check = ttk.Checkbutton(
-            main_frame,
+            options_frame,
             text="Открыть папку после завершения",
             variable=self.open_folder_var
         )
-        open_folder_check.grid(row=4, column=0, sticky=tk.W, pady=5)
+        open_folder_check.grid(row=0, column=0, sticky=tk.W)
+        
+        ttk.Label(options_frame, text="Профилирование:").grid(row=0, column=1, padx=(20, 5))
+        self.profile_var = tk.StringVar(value="нет")
+        profile_combo = ttk.Combobox(
+            options_frame,
+            textvariable=self.profile_var,
+            values=["нет", *PROFILE_MODES],
+            state='readonly',
+            width=8
+        )
+        profile_combo.grid(row=0, column=2)
+        
+        # Кнопки "Объединить" и "Отмена"
+        button_frame = ttk.Frame(main_frame)
+        button_frame.grid(row=5, column=0, pady=20)
         
-        # Кнопка "Объединить"
         self.merge_btn = ttk.Button(
-            main_frame,
+            button_frame,
             text="⚡ Объединить",
             command=self.start_merge,
             style='Accent.TButton'
         )
-        self.merge_btn.grid(row=5, column=0, pady=20)
+        self.merge_btn.grid(row=0, column=0, padx=5)
+        
+        self.cancel_btn = ttk.Button(
+            button_frame,
+            text="Отмена",
+            command=self.cancel_merge,
+            state='disabled'
+        )
+        self.cancel_btn.grid(row=0, column=1, padx=5)
         
         # Прогресс-бар
         self.progress_var = tk.DoubleVar()
@@ -194,46 +381,164 @@ class BackupMergerGUI:
             self.output_file.set(file)
     
     def update_archive_list(self):
-        """Обновление списка найденных архивов"""
+        """Запуск фонового просмотра папки с архивами"""
         self.archive_listbox.delete(0, tk.END)
         self.archive_files = []
+        self.scan_generation += 1
         
         input_path = Path(self.input_dir.get())
         if not input_path.exists():
             self.status_var.set("❌ Папка не существует")
             return
         
-        # Поиск архивов
-        archive_files = list(input_path.glob('*.jwlibrary'))
+        self.merge_btn.configure(state='disabled')
+        self.status_var.set("⏳ Поиск архивов...")
+        thread = threading.Thread(
+            target=self.scan_worker,
+            args=(input_path, self.scan_generation),
+            daemon=True
+        )
+        thread.start()
+    
+    def scan_worker(self, input_path, generation):
+        """Фоновый поток: поиск архивов и чтение их манифестов
         
-        if not archive_files:
+        Записи добавляются в список по одной по мере готовности. Если
+        пользователь выбрал другую папку, устаревший просмотр прекращается.
+        """
+        try:
+            archive_files = sorted(input_path.glob('*.jwlibrary'))
+        except OSError as e:
+            self.set_status(f"❌ Ошибка чтения папки: {e}")
+            return
+        
+        for archive in archive_files:
+            if generation != self.scan_generation:
+                return
+            info = self.get_archive_info(archive)
+            self.call_in_ui(self.add_archive_entry, generation, info)
+        
+        self.call_in_ui(self.finish_scan, generation)
+    
+    def get_archive_info(self, archive):
+        """Сведения об архиве из кэша, если файл не менялся, иначе из самого архива"""
+        try:
+            stat = archive.stat()
+        except OSError as e:
+            return ArchiveInfo(path=archive, size=0, error=str(e))
+        
+        key = (stat.st_size, stat.st_mtime_ns)
+        cached = self.scan_cache.get(archive)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        
+        info = peek_archive(archive)
+        self.scan_cache[archive] = (key, info)
+        return info
+    
+    def add_archive_entry(self, generation, info):
+        """Добавление архива в список (в потоке Tk)"""
+        if generation != self.scan_generation:
+            return
+        
+        name = info.path.name[:40]
+        if info.error:
+            self.archive_listbox.insert(tk.END, f"⚠️ {name} (ошибка: {info.error})")
+            self.log(f"Архив пропущен: {info.path.name}: {info.error}")
+            return
+        
+        details = [f"{info.size // 1024} KB"]
+        if info.db_size is not None:
+            details.append(f"БД {info.db_size // 1024} KB")
+        if info.created:
+            details.append(info.created[:10])
+        if info.user_mark_count is not None:
+            details.append(f"выделений: {info.user_mark_count}")
+        
+        self.archive_files.append(info.path)
+        self.archive_listbox.insert(tk.END, f"📄 {name} ({', '.join(details)})")
+    
+    def finish_scan(self, generation):
+        """Завершение просмотра папки (в потоке Tk)"""
+        if generation != self.scan_generation:
+            return
+        
+        if not self.archive_files:
             self.archive_listbox.insert(tk.END, "❌ Не найдено файлов .jwlibrary")
             self.status_var.set("❌ Не найдено файлов .jwlibrary")
             self.merge_btn.configure(state='disabled')
             return
         
-        self.archive_files = archive_files
-        
-        # Отображение
-        for archive in archive_files:
-            size_kb = archive.stat().st_size // 1024
-            self.archive_listbox.insert(
-                tk.END,
-                f"📄 {archive.name[:50]} ({size_kb} KB)"
-            )
-        
-        count = len(archive_files)
+        count = len(self.archive_files)
         self.status_var.set(f"✅ Найдено архивов: {count}")
         self.merge_btn.configure(state='normal')
         self.log(f"Найдено {count} архивов для объединения")
     
     def log(self, message):
-        """Запись в лог GUI"""
+        """Запись в лог GUI (из любого потока)"""
         timestamp = datetime.now().strftime('%H:%M:%S')
-        log_entry = f"[{timestamp}] {message}"
-        self.log_messages.append(log_entry)
-        self.log_text.insert(tk.END, log_entry + "\n")
-        self.log_text.see(tk.END)
+        self.ui_queue.put(('log', f"[{timestamp}] {message}"))
+    
+    def set_status(self, text):
+        """Обновление строки состояния (из любого потока)"""
+        self.ui_queue.put(('status', text))
+    
+    def set_progress(self, value):
+        """Обновление прогресс-бара (из любого потока)"""
+        self.ui_queue.put(('progress', value))
+    
+    def call_in_ui(self, func, *args, **kwargs):
+        """Вызов func(*args, **kwargs) в потоке Tk (из любого потока)"""
+        self.ui_queue.put(('call', (func, args, kwargs)))
+    
+    def drain_ui_queue(self):
+        """Применение накопившихся событий пачкой, по таймеру в потоке Tk
+        
+        Строки лога вставляются одной операцией, из статусов и значений
+        прогресса применяется только последнее, поэтому стоимость одного
+        тика не зависит от того, как часто рабочий поток шлёт события.
+        За тик применяется не больше UI_MAX_EVENTS событий; остаток - на
+        следующем тике, без паузы. Ошибка в вызове из очереди пишется в лог
+        и не останавливает опрос.
+        """
+        delay = UI_POLL_MS
+        try:
+            log_lines = []
+            status = progress = None
+            calls = []
+            try:
+                for _ in range(UI_MAX_EVENTS):
+                    kind, value = self.ui_queue.get_nowait()
+                    if kind == 'log':
+                        log_lines.append(value)
+                    elif kind == 'status':
+                        status = value
+                    elif kind == 'progress':
+                        progress = value
+                    else:
+                        calls.append(value)
+                delay = 1
+            except queue.Empty:
+                pass
+            
+            if log_lines:
+                self.log_messages.extend(log_lines)
+                self.log_text.insert(tk.END, "\n".join(log_lines[-LOG_MAX_LINES:]) + "\n")
+                excess = int(self.log_text.index('end-1c').split('.')[0]) - 1 - LOG_MAX_LINES
+                if excess > 0:
+                    self.log_text.delete('1.0', f'{excess + 1}.0')
+                self.log_text.see(tk.END)
+            if status is not None:
+                self.status_var.set(status)
+            if progress is not None:
+                self.progress_var.set(progress)
+            for func, args, kwargs in calls:
+                try:
+                    func(*args, **kwargs)
+                except Exception:
+                    self.logger.exception(f"Ошибка в вызове {getattr(func, '__name__', func)} из очереди событий")
+        finally:
+            self.root.after(delay, self.drain_ui_queue)
     
     def start_merge(self):
         """Запуск процесса слияния"""
@@ -245,96 +550,120 @@ class BackupMergerGUI:
             return
         
         self.is_processing = True
+        self.cancel_requested = False
         self.merge_btn.configure(state='disabled', text="⏳ Обработка...")
+        self.cancel_btn.configure(state='normal')
         self.progress_var.set(0)
         self.log("=" * 60)
         self.log("Начало слияния...")
         
-        # Запуск в отдельном потоке
-        thread = threading.Thread(target=self.merge_worker, daemon=True)
+        # Слияние в дочернем процессе, события приходят по каналу;
+        # значения виджетов читаются здесь, в потоке Tk
+        output_path = Path(self.output_file.get())
+        profile_mode = self.profile_var.get() if self.profile_var.get() in PROFILE_MODES else None
+        temp_root = Path(tempfile.mkdtemp(prefix='jwl-merge-'))
+        parent_conn, child_conn = MERGE_CONTEXT.Pipe(duplex=False)
+        self.merge_process = MERGE_CONTEXT.Process(
+            target=merge_process,
+            args=(list(self.archive_files), output_path, child_conn, temp_root, profile_mode),
+            daemon=True
+        )
+        self.merge_process.start()
+        # Закрываем свою копию передающего конца, чтобы получить EOF при выходе процесса
+        child_conn.close()
+        
+        thread = threading.Thread(
+            target=self.merge_monitor,
+            args=(self.merge_process, parent_conn, output_path, temp_root, self.open_folder_var.get()),
+            daemon=True
+        )
         thread.start()
     
-    def merge_worker(self):
-        """Рабочий поток для слияния (выполняется в фоне)"""
+    def cancel_merge(self):
+        """Отмена слияния: дочерний процесс завершается, промежуточные файлы
+        и его временный каталог удаляет merge_monitor"""
+        if not self.is_processing or self.merge_process is None:
+            return
+        self.cancel_requested = True
+        self.cancel_btn.configure(state='disabled')
+        self.set_status("⏳ Отмена...")
+        self.merge_process.terminate()
+    
+    def merge_monitor(self, process, conn, output_path, temp_root, open_folder):
+        """Рабочий поток: приём событий дочернего процесса и итог слияния
+        
+        Виджеты не трогаются напрямую: лог, статус, прогресс и диалоги
+        передаются в поток Tk через очередь событий. Если процесс успел
+        прислать 'done' до отмены, слияние считается завершённым.
+        """
+        result = None
         try:
-            output_path = Path(self.output_file.get())
-            output_dir = output_path.parent
-            
-            self.log(f"Выходной файл: {output_path}")
-            self.root.after(0, lambda: self.status_var.set("⏳ Создание объединённой базы данных..."))
-            self.root.after(0, lambda: self.progress_var.set(10))
-            
-            # Шаг 1: Создание объединённой БД
-            temp_db = output_dir / 'merged_userData.db'
-            create_merged_db(
-                self.archive_files,
-                temp_db,
-                verbose=False
-            )
-            self.root.after(0, lambda: self.progress_var.set(40))
-            self.log("✓ База данных создана")
-            
-            # Шаг 2: Подсчёт результатов
-            self.root.after(0, lambda: self.status_var.set("⏳ Подсчёт результатов..."))
-            import sqlite3
-            conn = sqlite3.connect(str(temp_db))
-            cursor = conn.cursor()
-            
-            tables = ['Note', 'UserMark', 'Location', 'Tag', 'TagMap', 'Bookmark', 'BlockRange']
-            results = {}
-            total = 0
-            for table in tables:
+            while True:
                 try:
-                    cursor.execute(f'SELECT COUNT(*) FROM "{table}"')
-                    count = cursor.fetchone()[0]
-                    results[table] = count
-                    total += count
-                    self.log(f"  {table}: {count} записей")
-                except sqlite3.OperationalError:
-                    results[table] = 0
-            
+                    kind, value = conn.recv()
+                except EOFError:
+                    break
+                if kind == 'log':
+                    self.log(value)
+                elif kind == 'status':
+                    self.set_status(value)
+                elif kind == 'progress':
+                    self.set_progress(value)
+                elif kind == 'merge_progress':
+                    self.show_merge_progress(value)
+                else:
+                    result = (kind, value)
+        finally:
             conn.close()
-            self.root.after(0, lambda: self.progress_var.set(60))
-            self.log(f"✓ Всего записей: {total:,}")
-            
-            # Шаг 3: Создание манифеста
-            self.root.after(0, lambda: self.status_var.set("⏳ Создание манифеста..."))
-            manifest_data = create_manifest_from_archives(self.archive_files, temp_db)
-            self.root.after(0, lambda: self.progress_var.set(80))
-            self.log("✓ Манифест создан")
-            
-            # Шаг 4: Создание финального архива
-            self.root.after(0, lambda: self.status_var.set("⏳ Создание финального архива..."))
-            create_backup_archive(temp_db, manifest_data, output_path)
-            self.root.after(0, lambda: self.progress_var.set(100))
-            self.log("✓ Архив создан")
-            
-            # Очистка временного файла
-            temp_db.unlink()
-            
-            # Успех
-            self.root.after(0, lambda: self.status_var.set(f"✅ Готово! {total:,} записей"))
-            self.root.after(0, lambda: self.log(f"Слияние завершено успешно!"))
-            
-            messagebox.showinfo(
+            process.join()
+        
+        if self.cancel_requested:
+            # После terminate дочерний процесс не успевает убрать за собой
+            for path in merge_temp_paths(output_path):
+                if path.exists():
+                    path.unlink()
+        shutil.rmtree(temp_root, ignore_errors=True)
+        
+        if result is not None and result[0] == 'done':
+            total = result[1]
+            self.set_status(f"✅ Готово! {total:,} записей")
+            self.log("Слияние завершено успешно!")
+            self.call_in_ui(
+                messagebox.showinfo,
                 "Готово!",
                 f"Объединённый бэкап создан:\n{output_path}\n\n"
                 f"Всего записей: {total:,}"
             )
             
             # Открытие папки
-            if self.open_folder_var.get():
-                self.open_folder(output_dir)
-            
-        except Exception as e:
-            error_msg = f"❌ Ошибка: {str(e)}"
+            if open_folder:
+                self.call_in_ui(self.open_folder, output_path.parent)
+        elif self.cancel_requested:
+            self.log("Слияние отменено")
+            self.set_status("⛔ Слияние отменено")
+            self.set_progress(0)
+        else:
+            message = result[1] if result is not None else f"процесс слияния завершился с кодом {process.exitcode}"
+            error_msg = f"❌ Ошибка: {message}"
             self.log(error_msg)
-            self.root.after(0, lambda: self.status_var.set(error_msg))
-            self.root.after(0, lambda: messagebox.showerror("Ошибка", str(e)))
+            self.set_status(error_msg)
+            self.call_in_ui(messagebox.showerror, "Ошибка", message)
         
-        finally:
-            self.is_processing = False
-            self.root.after(0, lambda: self.merge_btn.configure(state='normal', text="⚡ Объединить"))
+        self.is_processing = False
+        self.merge_process = None
+        self.call_in_ui(self.merge_btn.configure, state='normal', text="⚡ Объединить")
+        self.call_in_ui(self.cancel_btn.configure, state='disabled')
+    
+    def show_merge_progress(self, event):
+        """Прогресс шага слияния баз по событию JsonlProgress (диапазон 10-40%)"""
+        total = event['archives_total']
+        if not total:
+            return
+        self.set_progress(10 + 30 * event['archives_done'] / total)
+        status = f"⏳ Архив {min(event['archives_done'] + 1, total)}/{total}, записей: {event['rows']:,}"
+        if event['eta'] is not None:
+            status += f", осталось ~{int(event['eta'])} с"
+        self.set_status(status)
     
     def open_folder(self, path):
         """Открытие папки в файловом менеджере"""
@@ -367,4 +696,6 @@ def main():
 
 
 if __name__ == "__main__":
+    # Нужно для дочернего процесса слияния в сборке PyInstaller
+    multiprocessing.freeze_support()
     main()
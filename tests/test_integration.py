@@ -2,14 +2,20 @@
 Интеграционные тесты для слияния баз данных
 """
 import pytest
+import hashlib
+import io
+import logging
+import json
 import sqlite3
 import tempfile
 import shutil
+import zipfile
 from pathlib import Path
 import sys
 
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
+import jwl_backup_merger
 from jwl_backup_merger import (
     copy_unique_records,
     create_merged_db,
@@ -17,10 +23,145 @@ from jwl_backup_merger import (
     ALLOWED_TABLES,
     TABLE_ORDER,
     PRIMARY_KEYS,
-    validate_database_schema
+    validate_database_schema,
+    load_batch_jobs,
+    run_batch,
+    count_table_records,
+    Merger,
+    MergeStats,
+    diff_backups,
+    generate_record_hash,
+    read_archive,
+    main,
+    build_key_index,
+    open_key_index,
+    KeyIndex,
+    record_key_digest,
+    count_overlap,
+    iter_new_keys,
+    JsonlProgress,
+    peek_archive,
+    MergeResult,
+    RunProfiler,
+    ResultCache,
+    run_merge,
+    run_preflight,
+    MergeFilter,
+    plan_subsumed,
+    _iter_in_thread,
+    _compile_row_plan,
+    _iter_keyed_batches,
+    IdMap,
+    export_records,
+    tree_merge,
+    schema_registry,
+    plan_media
 )
 
 
+# Упрощённая схема userData.db JW Library для интеграционных тестов
+TEST_SCHEMA = """
+CREATE TABLE Location (
+    LocationId INTEGER PRIMARY KEY, BookNumber INTEGER, ChapterNumber INTEGER, DocumentId INTEGER,
+    Track INTEGER, IssueTagNumber INTEGER NOT NULL DEFAULT 0, KeySymbol TEXT, MepsLanguage INTEGER,
+    Type INTEGER NOT NULL DEFAULT 0, Title TEXT
+);
+CREATE TABLE UserMark (
+    UserMarkId INTEGER PRIMARY KEY, ColorIndex INTEGER NOT NULL, LocationId INTEGER NOT NULL,
+    StyleIndex INTEGER NOT NULL DEFAULT 0, UserMarkGuid TEXT NOT NULL, Version INTEGER NOT NULL DEFAULT 1,
+    FOREIGN KEY(LocationId) REFERENCES Location(LocationId)
+);
+CREATE TABLE Tag (
+    TagId INTEGER PRIMARY KEY, Type INTEGER NOT NULL, Name TEXT NOT NULL
+);
+CREATE TABLE Note (
+    NoteId INTEGER PRIMARY KEY, Guid TEXT NOT NULL, UserMarkId INTEGER, LocationId INTEGER,
+    Title TEXT, Content TEXT, LastModified TEXT NOT NULL DEFAULT '2026-01-01T00:00:00+00:00',
+    Created TEXT, BlockType INTEGER NOT NULL DEFAULT 0, BlockIdentifier INTEGER,
+    FOREIGN KEY(UserMarkId) REFERENCES UserMark(UserMarkId),
+    FOREIGN KEY(LocationId) REFERENCES Location(LocationId)
+);
+CREATE TABLE TagMap (
+    TagMapId INTEGER PRIMARY KEY, Type INTEGER NOT NULL, TypeId INTEGER NOT NULL,
+    TagId INTEGER NOT NULL, Position INTEGER NOT NULL,
+    FOREIGN KEY(TagId) REFERENCES Tag(TagId)
+);
+CREATE TABLE Bookmark (
+    BookmarkId INTEGER PRIMARY KEY, LocationId INTEGER NOT NULL, PublicationLocationId INTEGER NOT NULL,
+    Slot INTEGER NOT NULL, Title TEXT NOT NULL, Snippet TEXT,
+    BlockType INTEGER NOT NULL DEFAULT 0, BlockIdentifier INTEGER,
+    FOREIGN KEY(LocationId) REFERENCES Location(LocationId)
+);
+CREATE TABLE BlockRange (
+    BlockRangeId INTEGER PRIMARY KEY, BlockType INTEGER NOT NULL, Identifier INTEGER NOT NULL,
+    StartToken INTEGER, EndToken INTEGER, UserMarkId INTEGER NOT NULL,
+    FOREIGN KEY(UserMarkId) REFERENCES UserMark(UserMarkId)
+);
+CREATE TABLE LastModified (LastModified TEXT NOT NULL);
+INSERT INTO LastModified VALUES ('2026-01-01T00:00:00+00:00');
+"""
+
+
+def create_test_archive(archive_path, rows, creation_date='2026-01-01', extra_schema=''):
+    """Создаёт архив .jwlibrary с userData.db и manifest.json
+
+    Args:
+        archive_path: Путь к создаваемому архиву
+        rows: dict {table_name: [dict(column=value), ...]}
+        creation_date: Дата создания для манифеста
+        extra_schema: Дополнительные таблицы к TEST_SCHEMA
+    """
+    archive_path = Path(archive_path)
+    db_path = archive_path.with_suffix('.db')
+    conn = sqlite3.connect(db_path)
+    conn.executescript(TEST_SCHEMA + extra_schema)
+    for table, table_rows in rows.items():
+        for row in table_rows:
+            columns = ', '.join(f'"{c}"' for c in row)
+            placeholders = ', '.join('?' for _ in row)
+            conn.execute(f'INSERT INTO "{table}" ({columns}) VALUES ({placeholders})', tuple(row.values()))
+    conn.commit()
+    conn.close()
+
+    manifest = {
+        'name': archive_path.stem,
+        'creationDate': creation_date,
+        'version': 1,
+        'type': 0,
+        'userDataBackup': {
+            'lastModifiedDate': f'{creation_date}T00:00:00+00:00',
+            'deviceName': 'test',
+            'databaseName': 'userData.db',
+            'hash': '',
+            'schemaVersion': 14
+        }
+    }
+    with zipfile.ZipFile(archive_path, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        zf.write(db_path, 'userData.db')
+        zf.writestr('manifest.json', json.dumps(manifest))
+    db_path.unlink()
+    return archive_path
+
+
+def sample_rows(prefix='a', count=2):
+    """Набор связанных записей: Location → UserMark → BlockRange/Note, Tag → TagMap, Bookmark"""
+    rows = {'Location': [], 'UserMark': [], 'Tag': [], 'Note': [], 'TagMap': [], 'Bookmark': [], 'BlockRange': []}
+    for i in range(1, count + 1):
+        rows['Location'].append({'LocationId': i, 'BookNumber': i, 'ChapterNumber': i, 'KeySymbol': 'nwtsty',
+                                 'MepsLanguage': 0, 'Type': 0, 'Title': f'{prefix}-loc-{i}'})
+        rows['UserMark'].append({'UserMarkId': i, 'ColorIndex': 1, 'LocationId': i, 'StyleIndex': 0,
+                                 'UserMarkGuid': f'{prefix}-um-{i}', 'Version': 1})
+        rows['BlockRange'].append({'BlockRangeId': i, 'BlockType': 1, 'Identifier': i, 'StartToken': 0,
+                                   'EndToken': 5, 'UserMarkId': i})
+        rows['Note'].append({'NoteId': i, 'Guid': f'{prefix}-note-{i}', 'UserMarkId': i, 'LocationId': i,
+                             'Title': f'Title {i}', 'Content': f'{prefix} content {i}'})
+        rows['Tag'].append({'TagId': i, 'Type': 1, 'Name': f'{prefix}-tag-{i}'})
+        rows['TagMap'].append({'TagMapId': i, 'Type': 1, 'TypeId': i, 'TagId': i, 'Position': 0})
+        rows['Bookmark'].append({'BookmarkId': i, 'LocationId': i, 'PublicationLocationId': i, 'Slot': i,
+                                 'Title': f'{prefix}-bm-{i}', 'Snippet': ''})
+    return rows
+
+
 class TestAllowedTables:
     """Тесты для whitelist таблиц"""
 
@@ -154,6 +295,25 @@ class TestCopyUniqueRecords:
         src_conn.close()
         dst_conn.close()
 
+    def test_small_batch_size(self, temp_dbs):
+        """Чтение по одной записи даёт тот же результат"""
+        src_db, dst_db = temp_dbs
+
+        src_conn = sqlite3.connect(src_db)
+        dst_conn = sqlite3.connect(dst_db)
+
+        seen_hashes = {generate_record_hash('Tag', {'Name': 'Test1', 'Type': 1})}
+        id_mapping = {}
+
+        copy_unique_records(src_conn, dst_conn, 'Tag', seen_hashes, id_mapping, batch_size=1)
+
+        names = [row[0] for row in dst_conn.execute("SELECT Name FROM Tag ORDER BY TagId")]
+        assert names == ['Existing', 'Test2']
+        assert len(seen_hashes) == 2
+
+        src_conn.close()
+        dst_conn.close()
+
     def test_invalid_table_name_raises_error(self, temp_dbs):
         """Недопустимое имя таблицы должно вызывать ошибку"""
         src_db, dst_db = temp_dbs
@@ -167,6 +327,32 @@ class TestCopyUniqueRecords:
         src_conn.close()
         dst_conn.close()
 
+    def test_ignored_insert_maps_to_unique_row(self, tmp_path):
+        """Запись, отброшенная UNIQUE-индексом, сопоставляется с занявшей ключ строкой: сирот нет"""
+        unique_schema = (
+            "CREATE UNIQUE INDEX IX_Location_Key ON Location(BookNumber, ChapterNumber, KeySymbol, MepsLanguage, Type);"
+        )
+        rows = sample_rows('b', 2)
+        for row in rows['Location']:
+            row['LocationId'] += 10
+        for table in ('UserMark', 'Note', 'Bookmark'):
+            for row in rows[table]:
+                row['LocationId'] += 10
+        first = create_test_archive(tmp_path / 'a.jwlibrary', sample_rows('a', 2), extra_schema=unique_schema)
+        second = create_test_archive(tmp_path / 'b.jwlibrary', rows, extra_schema=unique_schema)
+
+        db_path = tmp_path / 'merged.db'
+        result = create_merged_db([first, second], db_path)
+
+        assert result.verify.orphans == {}
+        assert result.tables['Location'] == 2 and result.tables['UserMark'] == 4
+        conn = sqlite3.connect(db_path)
+        titles = conn.execute(
+            "SELECT u.UserMarkGuid, l.Title FROM UserMark u JOIN Location l USING (LocationId) ORDER BY 1"
+        ).fetchall()
+        conn.close()
+        assert titles == [('a-um-1', 'a-loc-1'), ('a-um-2', 'a-loc-2'), ('b-um-1', 'a-loc-1'), ('b-um-2', 'a-loc-2')]
+
 
 class TestTagMapIntegration:
     """Интеграционные тесты для Tag → TagMap"""
@@ -260,6 +446,468 @@ class TestTagMapIntegration:
         dst_conn.close()
 
 
+class TestGuidUpsert:
+    """Тесты объединения заметок по GUID с выбором более новой версии"""
+
+    @pytest.fixture
+    def archives(self, tmp_path):
+        old_rows = sample_rows('a', 2)
+        new_rows = sample_rows('a', 2)
+        new_rows['Note'][0].update(Content='edited content', LastModified='2026-03-01T00:00:00+00:00')
+        old = create_test_archive(tmp_path / 'old.jwlibrary', old_rows)
+        new = create_test_archive(tmp_path / 'new.jwlibrary', new_rows, creation_date='2026-03-01')
+        return old, new
+
+    @pytest.mark.parametrize('order', [(0, 1), (1, 0)])
+    def test_newest_version_wins(self, archives, tmp_path, order):
+        """Отредактированная заметка остаётся в одном экземпляре, в новой версии"""
+        db_path = tmp_path / 'merged.db'
+        create_merged_db([archives[i] for i in order], db_path)
+
+        conn = sqlite3.connect(db_path)
+        notes = dict(conn.execute("SELECT Guid, Content FROM Note"))
+        note_count = conn.execute("SELECT COUNT(*) FROM Note").fetchone()[0]
+        conn.close()
+
+        assert note_count == 2
+        assert notes['a-note-1'] == 'edited content'
+        assert notes['a-note-2'] == 'a content 2'
+
+    @pytest.mark.parametrize('order', [(0, 1), (1, 0)])
+    def test_usermark_newest_version_wins(self, tmp_path, order):
+        """Выделение с тем же GUID и большим Version заменяет старое независимо от порядка архивов"""
+        new_rows = sample_rows('a', 2)
+        new_rows['UserMark'][0].update(ColorIndex=4, Version=2)
+        archives = [
+            create_test_archive(tmp_path / 'old.jwlibrary', sample_rows('a', 2)),
+            create_test_archive(tmp_path / 'new.jwlibrary', new_rows, creation_date='2026-03-01'),
+        ]
+        db_path = tmp_path / 'merged.db'
+        result = create_merged_db([archives[i] for i in order], db_path)
+
+        conn = sqlite3.connect(db_path)
+        marks = {guid: (color, version) for guid, color, version in
+                 conn.execute("SELECT UserMarkGuid, ColorIndex, Version FROM UserMark")}
+        ranges = conn.execute("SELECT COUNT(*) FROM BlockRange").fetchone()[0]
+        conn.close()
+
+        assert marks == {'a-um-1': (4, 2), 'a-um-2': (1, 1)}
+        assert ranges == 2
+        assert result.table_stats['UserMark'].updated == (1 if order == (0, 1) else 0)
+
+
+class TestJsonlProgress:
+    """Тесты потока событий прогресса --progress=jsonl"""
+
+    @pytest.fixture
+    def archives(self, tmp_path):
+        first = create_test_archive(tmp_path / 'first.jwlibrary', sample_rows('a', 3))
+        second = create_test_archive(tmp_path / 'second.jwlibrary', sample_rows('b', 2))
+        return [first, second]
+
+    def merge_events(self, archives, tmp_path, min_interval):
+        stream = io.StringIO()
+        create_merged_db(archives, tmp_path / 'merged.db', progress=JsonlProgress(stream, min_interval))
+        return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+    def test_events(self, archives, tmp_path):
+        """События start, table, archive и done с итоговыми счётчиками"""
+        events = self.merge_events(archives, tmp_path, min_interval=0)
+
+        assert events[0]['event'] == 'start'
+        assert events[-1]['event'] == 'done'
+        assert [e['archive'] for e in events if e['event'] == 'archive'] == ['first.jwlibrary', 'second.jwlibrary']
+        assert len([e for e in events if e['event'] == 'table']) == 2 * len(TABLE_ORDER)
+        assert events[-1]['archives_done'] == events[-1]['archives_total'] == 2
+        assert events[-1]['rows'] > 0 and events[-1]['bytes'] > 0
+        assert events[-1]['eta'] == 0
+
+    def test_table_events_throttled(self, archives, tmp_path):
+        """Промежуточные события прореживаются, обязательные пишутся всегда"""
+        events = self.merge_events(archives, tmp_path, min_interval=3600)
+
+        assert [e['event'] for e in events] == ['start', 'archive', 'archive', 'done']
+
+    def test_rows_grow_on_duplicate_archive(self, archives, tmp_path):
+        """rows - прочитанные записи: архив из одних дубликатов тоже продвигает счётчик"""
+        copy = tmp_path / 'copy.jwlibrary'
+        shutil.copyfile(archives[0], copy)
+        events = self.merge_events([archives[0], copy], tmp_path, min_interval=0)
+
+        rows = [e['rows'] for e in events if e['event'] == 'archive']
+        assert rows[0] > 0 and rows[1] == 2 * rows[0]
+
+    def test_cli_requires_progress_fd(self, archives, tmp_path):
+        """--progress jsonl без --progress-fd - ошибка разбора аргументов"""
+        with pytest.raises(SystemExit) as exc:
+            main([str(tmp_path), '--progress', 'jsonl', '--log-file', str(tmp_path / 'log')])
+        assert exc.value.code == 2
+
+
+class TestPeekArchive:
+    """Тесты быстрого просмотра архива для списка в GUI"""
+
+    def test_manifest_fields(self, tmp_path):
+        """Дата, устройство и размер базы читаются без распаковки"""
+        archive = create_test_archive(tmp_path / 'phone.jwlibrary', sample_rows('a', 2), creation_date='2026-05-01')
+
+        info = peek_archive(archive)
+
+        assert info.error is None
+        assert info.size == archive.stat().st_size
+        assert info.db_size > 0
+        assert info.created.startswith('2026-05-01')
+        assert info.device == 'test'
+
+    def test_broken_archive(self, tmp_path):
+        """Повреждённый файл не выбрасывает исключение"""
+        broken = tmp_path / 'broken.jwlibrary'
+        broken.write_bytes(b'not a zip')
+
+        info = peek_archive(broken)
+
+        assert info.error
+        assert info.db_size is None
+
+
+class TestMergeResult:
+    """Тесты статистики, возвращаемой create_merged_db"""
+
+    def test_counts_match_output(self, tmp_path):
+        """Счётчики совпадают с фактическим содержимым базы, хэш - с файлом"""
+        first = create_test_archive(tmp_path / 'first.jwlibrary', sample_rows('a', 3))
+        second = create_test_archive(tmp_path / 'second.jwlibrary', sample_rows('b', 2))
+        db_path = tmp_path / 'merged.db'
+
+        result = create_merged_db([first, second], db_path)
+
+        assert isinstance(result, MergeResult)
+        assert result.path == db_path
+        assert result.tables == count_table_records(db_path)
+        assert result.tables['Note'] == 5
+        assert result.db_hash == hashlib.sha256(db_path.read_bytes()).hexdigest()
+        assert set(result.archive_timings) == {'first.jwlibrary', 'second.jwlibrary'}
+        assert set(result.timings) == {'copy', 'merge', 'verify', 'digest'}
+        assert result.verify.ok
+
+    def test_counts_cover_registry_tables(self, tmp_path):
+        """Подсчёт записей охватывает все таблицы реестра схемы, а не только основные"""
+        first = create_test_archive(tmp_path / 'first.jwlibrary', media_rows('a', ['a.jpg'], ['a.jpg']),
+                                    extra_schema=MEDIA_SCHEMA)
+        second = create_test_archive(tmp_path / 'second.jwlibrary', media_rows('b', ['b.jpg'], ['b.jpg']),
+                                     extra_schema=MEDIA_SCHEMA)
+        db_path = tmp_path / 'merged.db'
+
+        result = create_merged_db([first, second], db_path)
+
+        counts = count_table_records(db_path)
+        assert counts == result.tables
+        assert counts['IndependentMedia'] == 2
+        assert 'PlaylistItemIndependentMediaMap' in counts
+
+    def test_duplicates_counted(self, tmp_path):
+        """Повторный архив не добавляет записей, только дубликаты"""
+        first = create_test_archive(tmp_path / 'first.jwlibrary', sample_rows('a', 3))
+        copy = tmp_path / 'copy.jwlibrary'
+        shutil.copyfile(first, copy)
+
+        result = create_merged_db([first, copy], tmp_path / 'merged.db')
+
+        assert result.table_stats['Note'].base == 3
+        assert result.inserted['Note'] == 0
+        assert result.duplicates['Note'] == 3
+
+
+class TestVerify:
+    """Тесты проверки объединённой базы после слияния"""
+
+    @pytest.fixture
+    def broken_archive(self, tmp_path):
+        """Архив с записями-сиротами: TagMap, Note и UserMark ссылаются на отсутствующие записи"""
+        rows = sample_rows('a', 2)
+        rows['TagMap'].append({'TagMapId': 3, 'Type': 1, 'TypeId': 3, 'TagId': 99, 'Position': 0})
+        rows['UserMark'].append({'UserMarkId': 3, 'ColorIndex': 1, 'LocationId': 99, 'StyleIndex': 0,
+                                 'UserMarkGuid': 'a-um-3', 'Version': 1})
+        rows['BlockRange'].append({'BlockRangeId': 3, 'BlockType': 1, 'Identifier': 3, 'StartToken': 0,
+                                   'EndToken': 5, 'UserMarkId': 3})
+        rows['Note'].append({'NoteId': 3, 'Guid': 'a-note-3', 'UserMarkId': 3, 'LocationId': 1,
+                             'Title': 'Title 3', 'Content': 'orphan'})
+        return create_test_archive(tmp_path / 'broken.jwlibrary', rows)
+
+    def test_orphans_reported(self, broken_archive, tmp_path):
+        """Без исправления сироты только попадают в отчёт, база не меняется"""
+        result = create_merged_db([broken_archive], tmp_path / 'merged.db')
+
+        assert result.verify.integrity == ['ok']
+        assert result.verify.orphans == {('TagMap', 'TagId'): 1, ('UserMark', 'LocationId'): 1}
+        assert not result.verify.ok
+        assert result.tables['TagMap'] == 3
+
+    def test_repair_orphans(self, broken_archive, tmp_path):
+        """Исправление удаляет сирот каскадом, обнуляет необязательные ссылки и обновляет счётчики"""
+        db_path = tmp_path / 'merged.db'
+        second = create_test_archive(tmp_path / 'second.jwlibrary', sample_rows('b', 1))
+
+        result = create_merged_db([broken_archive, second], db_path, repair_orphans=True)
+
+        assert result.verify.ok
+        assert result.verify.repaired[('BlockRange', 'UserMarkId')] == 1
+        assert result.verify.repaired[('Note', 'UserMarkId')] == 1
+        conn = sqlite3.connect(db_path)
+        assert conn.execute("PRAGMA foreign_key_check").fetchall() == []
+        assert conn.execute("SELECT UserMarkId FROM Note WHERE Guid = 'a-note-3'").fetchone() == (None,)
+        conn.close()
+        assert result.tables == count_table_records(db_path)
+        assert result.table_stats['UserMark'].removed == 1
+        assert result.db_hash == hashlib.sha256(db_path.read_bytes()).hexdigest()
+
+
+class TestMergeFilter:
+    """Тесты фильтрации слияния по таблицам и датам"""
+
+    def merged_counts(self, db_path):
+        conn = sqlite3.connect(db_path)
+        try:
+            counts = {table: conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0] for table in TABLE_ORDER}
+            assert conn.execute("PRAGMA foreign_key_check").fetchall() == []
+        finally:
+            conn.close()
+        return counts
+
+    def test_parent_tables_pulled_in(self):
+        """Родительские таблицы добавляются к запрошенным"""
+        assert MergeFilter(tables={'Note', 'Tag'}).selected_tables() == ['Location', 'UserMark', 'Tag', 'Note']
+        with pytest.raises(ValueError):
+            MergeFilter(tables={'Playlist'})
+
+    def test_table_filter(self, tmp_path):
+        """Копируются только запрошенные таблицы и нужные им родительские записи"""
+        rows = sample_rows('a', 3)
+        rows['Location'].append({'LocationId': 9, 'BookNumber': 9, 'ChapterNumber': 9, 'KeySymbol': 'nwtsty',
+                                 'MepsLanguage': 0, 'Type': 0, 'Title': 'unused'})
+        first = create_test_archive(tmp_path / 'a.jwlibrary', rows)
+        second = create_test_archive(tmp_path / 'b.jwlibrary', sample_rows('b', 2))
+
+        result = create_merged_db([first, second], tmp_path / 'out.db', merge_filter=MergeFilter(tables={'Note'}))
+
+        counts = self.merged_counts(tmp_path / 'out.db')
+        assert counts == {'Location': 5, 'UserMark': 5, 'Tag': 0, 'Note': 5, 'TagMap': 0,
+                          'Bookmark': 0, 'BlockRange': 0}
+        assert result.tables == counts
+
+    def test_registry_foreign_keys_pulled_in(self, tmp_path):
+        """Родители из внешних ключей схемы (TagMap.NoteId) тоже попадают в выборку"""
+        note_fk = "ALTER TABLE TagMap ADD COLUMN NoteId INTEGER REFERENCES Note(NoteId);"
+        archives = []
+        for prefix in 'ab':
+            rows = sample_rows(prefix, 2)
+            for i, tag_map in enumerate(rows['TagMap'], 1):
+                tag_map['NoteId'] = i
+            archives.append(create_test_archive(tmp_path / f'{prefix}.jwlibrary', rows, extra_schema=note_fk))
+
+        result = create_merged_db(archives, tmp_path / 'out.db', merge_filter=MergeFilter(tables={'TagMap'}))
+
+        counts = self.merged_counts(tmp_path / 'out.db')
+        assert result.verify.orphans == {}
+        assert (counts['TagMap'], counts['Tag'], counts['Note'], counts['UserMark'], counts['Bookmark']) == (4, 4, 4, 4, 0)
+
+    def test_date_filter_and_archive_skip(self, tmp_path):
+        """Фильтр дат переносится в выборку, старые по манифесту архивы пропускаются"""
+        rows = sample_rows('a', 4)
+        for i, note in enumerate(rows['Note']):
+            note['LastModified'] = f'2026-0{i + 2}-15T10:00:00+00:00'
+        recent = create_test_archive(tmp_path / 'recent.jwlibrary', rows, creation_date='2026-06-01')
+        old = create_test_archive(tmp_path / 'old.jwlibrary', sample_rows('b', 2), creation_date='2026-01-01')
+        merge_filter = MergeFilter(tables={'Note'}, since='2026-03-01', until='2026-04-15')
+
+        result = create_merged_db([recent, old], tmp_path / 'out.db', merge_filter=merge_filter)
+
+        counts = self.merged_counts(tmp_path / 'out.db')
+        assert result.archives == 1
+        assert (counts['Note'], counts['UserMark'], counts['Location'], counts['BlockRange']) == (2, 2, 2, 0)
+
+
+class TestRunProfiler:
+    """Тесты профилирования этапов слияния"""
+
+    @pytest.fixture
+    def merger(self, tmp_path):
+        merger = Merger()
+        merger.add(create_test_archive(tmp_path / 'first.jwlibrary', sample_rows('a', 3)))
+        merger.add(create_test_archive(tmp_path / 'second.jwlibrary', sample_rows('b', 2)))
+        return merger
+
+    def test_memory_report(self, merger, tmp_path):
+        """Отчёт memory: пик и места выделения по каждому этапу"""
+        report_path = tmp_path / 'memory.json'
+        merger.profiler = RunProfiler('memory', report_path)
+        merger.merge(io.BytesIO())
+        merger.profiler.save()
+
+        report = json.loads(report_path.read_text())
+        assert set(report['phases']) == {'merge', 'manifest', 'archive'}
+        assert report['phases']['merge']['peak_bytes'] > 0
+        assert isinstance(report['phases']['merge']['top_sites'], list)
+
+    def test_cpu_report(self, merger, tmp_path):
+        """Отчёт cpu читается pstats"""
+        import pstats
+        report_path = tmp_path / 'cpu.prof'
+        merger.profiler = RunProfiler('cpu', report_path)
+        merger.merge(io.BytesIO())
+        merger.profiler.save()
+
+        stats = pstats.Stats(str(report_path))
+        assert any(func[2] == 'merge_db' for func in stats.stats)
+
+    def test_cpu_report_sees_hot_path(self, tmp_path):
+        """В режиме cpu маппинг и хэширование записей run_merge идут в профилируемом потоке"""
+        import pstats
+        archives = [create_test_archive(tmp_path / f'{prefix}.jwlibrary', sample_rows(prefix, 3)) for prefix in 'ab']
+        profiler = RunProfiler('cpu', tmp_path / 'cpu.prof')
+        run_merge(archives, tmp_path / 'out.jwlibrary', profiler=profiler)
+        profiler.save()
+
+        functions = {func[2] for func in pstats.Stats(str(tmp_path / 'cpu.prof')).stats}
+        assert {'_iter_keyed_batches', '_remap_rows', 'copy_unique_records'} <= functions
+
+    def test_unknown_mode(self, tmp_path):
+        """Неизвестный режим - ошибка"""
+        with pytest.raises(ValueError):
+            RunProfiler('disk', tmp_path / 'x')
+
+
+class TestResultCache:
+    """Тесты кэша результатов по отпечатку набора архивов"""
+
+    @pytest.fixture
+    def archives(self, tmp_path):
+        first = create_test_archive(tmp_path / 'first.jwlibrary', sample_rows('a', 3))
+        second = create_test_archive(tmp_path / 'second.jwlibrary', sample_rows('b', 2))
+        return [first, second]
+
+    def test_hit_on_unchanged_inputs(self, archives, tmp_path):
+        """Повторный запуск на тех же архивах берёт результат из кэша"""
+        cache = ResultCache(tmp_path / 'cache')
+        first_output = tmp_path / 'out1.jwlibrary'
+        second_output = tmp_path / 'out2.jwlibrary'
+
+        first_tables = run_merge(archives, first_output, cache=cache)
+        stream = io.StringIO()
+        second_tables = run_merge(list(reversed(archives)), second_output, cache=cache,
+                                  progress=JsonlProgress(stream))
+
+        assert (cache.hits, cache.misses) == (1, 1)
+        assert second_tables == first_tables
+        assert second_output.read_bytes() == first_output.read_bytes()
+        events = [json.loads(line) for line in stream.getvalue().splitlines()]
+        assert events == [dict(events[0], event='cache', hit=True)]
+
+    def test_miss_after_change(self, archives, tmp_path):
+        """Изменённый архив даёт новый отпечаток и новое слияние"""
+        cache = ResultCache(tmp_path / 'cache')
+        run_merge(archives, tmp_path / 'out1.jwlibrary', cache=cache)
+        create_test_archive(archives[1], sample_rows('c', 4))
+
+        tables = run_merge(archives, tmp_path / 'out2.jwlibrary', cache=cache)
+
+        assert (cache.hits, cache.misses) == (0, 2)
+        assert tables['Note'] == 7
+
+    def test_cli_hit_skips_preflight(self, tmp_path, monkeypatch):
+        """Из командной строки попадание в кэш не распаковывает и не проверяет архивы"""
+        input_dir = tmp_path / 'in'
+        input_dir.mkdir()
+        create_test_archive(input_dir / 'a.jwlibrary', sample_rows('a', 3))
+        calls = []
+
+        def counting_preflight(files):
+            calls.append(files)
+            return run_preflight(files)
+
+        monkeypatch.setattr(jwl_backup_merger, 'run_preflight', counting_preflight)
+        args = [str(input_dir), '--output-dir', str(tmp_path), '--log-file', str(tmp_path / 'log'),
+                '--cache-dir', str(tmp_path / 'cache')]
+
+        main(args)
+        main(args)
+
+        assert len(calls) == 1
+        assert zipfile.is_zipfile(tmp_path / 'combined_backup.jwlibrary')
+
+    def test_repair_orphans_is_miss(self, tmp_path):
+        """Запуск с repair_orphans после обычного не берёт неисправленный результат из кэша"""
+        rows = sample_rows('a', 2)
+        rows['BlockRange'].append({'BlockRangeId': 3, 'BlockType': 1, 'Identifier': 3, 'StartToken': 0,
+                                   'EndToken': 5, 'UserMarkId': 99})
+        archive = create_test_archive(tmp_path / 'orphans.jwlibrary', rows)
+        cache = ResultCache(tmp_path / 'cache')
+        run_merge([archive], tmp_path / 'out1.jwlibrary', cache=cache)
+
+        tables = run_merge([archive], tmp_path / 'out2.jwlibrary', cache=cache, repair_orphans=True)
+
+        assert (cache.hits, cache.misses) == (0, 2)
+        assert tables['BlockRange'] == 2
+
+    def test_corrupt_entry_is_miss(self, archives, tmp_path):
+        """Повреждённый файл в кэше не выдаётся как результат"""
+        cache = ResultCache(tmp_path / 'cache')
+        run_merge(archives, tmp_path / 'out1.jwlibrary', cache=cache)
+        for result in (tmp_path / 'cache').glob('*/result.jwlibrary'):
+            result.write_bytes(b'corrupt')
+
+        run_merge(archives, tmp_path / 'out2.jwlibrary', cache=cache)
+
+        assert cache.hits == 0
+        assert zipfile.is_zipfile(tmp_path / 'out2.jwlibrary')
+
+
+class TestPreflight:
+    """Тесты предварительной проверки архивов"""
+
+    def test_detects_bad_archives(self, tmp_path):
+        """Повреждённый zip и архив без таблиц отклоняются, хорошие проходят"""
+        good = create_test_archive(tmp_path / 'good.jwlibrary', sample_rows('a', 3))
+        broken = create_test_archive(tmp_path / 'broken.jwlibrary', sample_rows('b', 3))
+        with zipfile.ZipFile(broken) as zf:
+            info = zf.getinfo('userData.db')
+        data = bytearray(broken.read_bytes())
+        offset = info.header_offset + 30 + len(info.filename) + len(info.extra) + info.compress_size // 2
+        data[offset] ^= 0xFF
+        broken.write_bytes(bytes(data))
+        partial = tmp_path / 'partial.jwlibrary'
+        db_path = tmp_path / 'partial.db'
+        conn = sqlite3.connect(db_path)
+        conn.execute("CREATE TABLE Location (LocationId INTEGER PRIMARY KEY)")
+        conn.commit()
+        conn.close()
+        with zipfile.ZipFile(partial, 'w') as zf:
+            zf.write(db_path, 'userData.db')
+            zf.writestr('manifest.json', '{not json')
+
+        reports = run_preflight([good, broken, partial])
+
+        assert [r.path for r in reports] == [good, broken, partial]
+        assert [r.ok for r in reports] == [True, False, False]
+        assert any('manifest.json' in error for error in reports[2].errors)
+        assert any('Tag' in error for error in reports[2].errors)
+        assert 'схема отличается' in ' '.join(reports[2].warnings)
+
+    def test_drop_bad_continues(self, tmp_path):
+        """С --drop-bad плохой архив исключается, слияние продолжается"""
+        input_dir = tmp_path / 'in'
+        input_dir.mkdir()
+        create_test_archive(input_dir / 'a.jwlibrary', sample_rows('a', 3))
+        (input_dir / 'b.jwlibrary').write_bytes(b'not a zip')
+
+        with pytest.raises(SystemExit):
+            main([str(input_dir), '--output-dir', str(tmp_path), '--log-file', str(tmp_path / 'log')])
+        assert not (tmp_path / 'combined_backup.jwlibrary').exists()
+
+        main([str(input_dir), '--output-dir', str(tmp_path), '--log-file', str(tmp_path / 'log'), '--drop-bad'])
+        assert zipfile.is_zipfile(tmp_path / 'combined_backup.jwlibrary')
+
+
 class TestValidateDatabaseSchema:
     """Тесты для валидации схемы БД"""
 
@@ -302,3 +950,917 @@ class TestValidateDatabaseSchema:
 
         db_path.unlink()
         Path(temp_dir).rmdir()
+
+
+class TestBatch:
+    """Тесты для batch-режима"""
+
+    @pytest.fixture
+    def batch_dir(self, tmp_path):
+        """Две директории с архивами разного размера"""
+        small = tmp_path / 'small'
+        large = tmp_path / 'large'
+        small.mkdir()
+        large.mkdir()
+        create_test_archive(small / 'one.jwlibrary', sample_rows('s', 1))
+        create_test_archive(large / 'one.jwlibrary', sample_rows('l', 50))
+        create_test_archive(large / 'two.jwlibrary', sample_rows('m', 50))
+        return tmp_path
+
+    def test_load_csv_largest_first(self, batch_dir):
+        """Задания из CSV сортируются от больших к маленьким"""
+        jobs_file = batch_dir / 'jobs.csv'
+        jobs_file.write_text('input_dir,output\nsmall,out/small.jwlibrary\nlarge,out/large.jwlibrary\n')
+
+        jobs = load_batch_jobs(jobs_file)
+
+        assert [job.input_dir.name for job in jobs] == ['large', 'small']
+        assert len(jobs[0].archives) == 2
+        assert jobs[0].output == batch_dir / 'out' / 'large.jwlibrary'
+
+    def test_load_json_mapping(self, batch_dir):
+        """JSON в виде словаря input_dir → output"""
+        jobs_file = batch_dir / 'jobs.json'
+        jobs_file.write_text(json.dumps({'small': 'small.jwlibrary'}))
+
+        jobs = load_batch_jobs(jobs_file)
+
+        assert len(jobs) == 1
+        assert jobs[0].db_bytes > 0
+
+    def test_run_batch_writes_result_per_job(self, batch_dir):
+        """По одной записи результата на задание, ошибка одного не мешает другим"""
+        jobs_file = batch_dir / 'jobs.json'
+        jobs_file.write_text(json.dumps([
+            {'input_dir': 'large', 'output': 'out/large.jwlibrary'},
+            {'input_dir': 'missing', 'output': 'out/missing.jwlibrary'},
+        ]))
+        results_path = batch_dir / 'results.jsonl'
+
+        records = run_batch(load_batch_jobs(jobs_file), results_path, workers=2, max_memory=1)
+
+        lines = [json.loads(line) for line in results_path.read_text().splitlines()]
+        assert len(lines) == len(records) == 2
+        by_dir = {Path(r['input_dir']).name: r for r in lines}
+        assert by_dir['large']['status'] == 'ok'
+        assert by_dir['large']['tables']['Note'] == 100
+        assert by_dir['missing']['status'] == 'error'
+        assert (batch_dir / 'out' / 'large.jwlibrary').exists()
+
+    def test_jobs_log_separately(self, batch_dir, tmp_path):
+        """Воркеры не пишут в общий лог родителя: у каждого задания свой лог"""
+        jobs_file = batch_dir / 'jobs.json'
+        jobs_file.write_text(json.dumps([
+            {'input_dir': 'large', 'output': 'out/large.jwlibrary'},
+            {'input_dir': 'small', 'output': 'out/small.jwlibrary'},
+        ]))
+        shared_log = tmp_path / 'shared.log'
+        shared_handler = logging.FileHandler(shared_log, mode='w', encoding='utf-8')
+        merger_logger = logging.getLogger('jwl_backup_merger')
+        merger_logger.addHandler(shared_handler)
+        try:
+            records = run_batch(load_batch_jobs(jobs_file), batch_dir / 'results.jsonl', workers=2)
+        finally:
+            merger_logger.removeHandler(shared_handler)
+            shared_handler.close()
+
+        assert 'Шаг 1/4' not in shared_log.read_text(encoding='utf-8')
+        logs = {Path(r['input_dir']).name: Path(r['log']).read_text(encoding='utf-8') for r in records}
+        assert 'Шаг 1/4' in logs['large']
+        assert 'large.jwlibrary' in logs['large']
+        assert 'large.jwlibrary' not in logs['small']
+
+
+class TestMerger:
+    """Тесты для библиотечного API Merger"""
+
+    @pytest.fixture
+    def archives(self, tmp_path):
+        first = create_test_archive(tmp_path / 'first.jwlibrary', sample_rows('a', 3))
+        second = create_test_archive(tmp_path / 'second.jwlibrary', sample_rows('b', 2))
+        return first, second
+
+    def test_merge_bytes_to_stream(self, archives, capsys):
+        """Входы из памяти, выход в поток, без print"""
+        first, second = archives
+        merger = Merger()
+        merger.add(first.read_bytes(), name='first.jwlibrary')
+        merger.add(io.BytesIO(second.read_bytes()))
+        output = io.BytesIO()
+
+        stats = merger.merge(output)
+
+        assert isinstance(stats, MergeStats)
+        assert stats.archives == 2
+        assert capsys.readouterr().out == ''
+        with zipfile.ZipFile(io.BytesIO(output.getvalue())) as zf:
+            db_data = zf.read('userData.db')
+            manifest = json.loads(zf.read('manifest.json'))
+        assert manifest['userDataBackup']['hash'] == hashlib.sha256(db_data).hexdigest() == stats.db_hash
+        assert manifest['userDataBackup']['userMarkCount'] == stats.tables['UserMark']
+
+    def test_same_result_as_create_merged_db(self, archives, tmp_path):
+        """Слияние в памяти даёт те же количества записей, что и слияние на диске"""
+        db_path = tmp_path / 'merged.db'
+        create_merged_db(list(archives), db_path)
+
+        merger = Merger()
+        for archive in archives:
+            merger.add(archive)
+        _, stats = merger.merge_db()
+
+        assert stats.tables == count_table_records(db_path)
+
+    def test_spool_dir(self, archives, tmp_path):
+        """С spool_dir временные файлы создаются там и удаляются"""
+        spool = tmp_path / 'spool'
+        spool.mkdir()
+        merger = Merger(spool_dir=spool)
+        for archive in archives:
+            merger.add(archive)
+
+        stats = merger.merge(io.BytesIO())
+
+        assert stats.total_records > 0
+        assert list(spool.iterdir()) == []
+
+    def test_no_sources_raises(self):
+        """Слияние без входных архивов - ошибка"""
+        with pytest.raises(ValueError):
+            Merger().merge(io.BytesIO())
+
+
+def archive_keys(archive_path, table):
+    """Множество хэшей generate_record_hash для таблицы архива"""
+    db_data, _ = read_archive(archive_path)
+    conn = sqlite3.connect(':memory:')
+    conn.deserialize(db_data)
+    cursor = conn.execute(f'SELECT * FROM "{table}"')
+    columns = [d[0] for d in cursor.description]
+    keys = {generate_record_hash(table, dict(zip(columns, row))) for row in cursor}
+    conn.close()
+    return keys
+
+
+class TestDiff:
+    """Тесты для сравнения бэкапов и архива-дельты"""
+
+    @pytest.fixture
+    def backups(self, tmp_path):
+        old_rows = sample_rows('a', 5)
+        new_rows = sample_rows('a', 5)
+        # Новый бэкап: без первых двух записей, плюс новая заметка к существующей пометке
+        for table in new_rows:
+            new_rows[table] = new_rows[table][2:]
+        new_rows['Note'].append({'NoteId': 100, 'Guid': 'new-note', 'UserMarkId': 5, 'LocationId': 5,
+                                 'Title': 'New', 'Content': 'new content'})
+        old = create_test_archive(tmp_path / 'old.jwlibrary', old_rows)
+        new = create_test_archive(tmp_path / 'new.jwlibrary', new_rows)
+        return old, new
+
+    def test_counts_match_record_hashes(self, backups):
+        """Добавленные и удалённые записи совпадают с разностью множеств хэшей"""
+        old, new = backups
+        result = diff_backups(old, new)
+
+        for table in TABLE_ORDER:
+            old_keys, new_keys = archive_keys(old, table), archive_keys(new, table)
+            assert result.added[table] == len(new_keys - old_keys), table
+            assert result.removed[table] == len(old_keys - new_keys), table
+        assert result.added['Note'] == 1
+        assert result.removed['Tag'] == 2
+
+    def test_null_and_empty_are_same_key(self, tmp_path):
+        """NULL, 0 и пустая строка дают одинаковый ключ, как в generate_record_hash"""
+        old = create_test_archive(tmp_path / 'old.jwlibrary', {'Tag': [{'TagId': 1, 'Type': 0, 'Name': 'x'}],
+                                                               'Location': [{'LocationId': 1, 'Title': None}]})
+        new = create_test_archive(tmp_path / 'new.jwlibrary', {'Tag': [{'TagId': 7, 'Type': 0, 'Name': 'x'}],
+                                                               'Location': [{'LocationId': 1, 'Title': ''},
+                                                                            {'LocationId': 2, 'Title': None}]})
+        result = diff_backups(old, new)
+
+        assert result.added == {table: 0 for table in TABLE_ORDER}
+        assert result.removed == {table: 0 for table in TABLE_ORDER}
+
+    def test_delta_contains_new_records_with_parents(self, backups):
+        """Дельта содержит новые записи и их родителей, внешние ключи разрешаются"""
+        old, new = backups
+        output = io.BytesIO()
+        result = diff_backups(old, new, delta_output=output)
+
+        db_data, manifest = read_archive(output.getvalue())
+        assert manifest['userDataBackup']['hash'] == hashlib.sha256(db_data).hexdigest()
+        conn = sqlite3.connect(':memory:')
+        conn.deserialize(db_data)
+        assert conn.execute("SELECT Guid FROM Note").fetchall() == [('new-note',)]
+        assert conn.execute("SELECT COUNT(*) FROM UserMark").fetchone()[0] == 1
+        assert conn.execute("SELECT COUNT(*) FROM Location").fetchone()[0] == 1
+        assert conn.execute("SELECT COUNT(*) FROM Tag").fetchone()[0] == 0
+        assert conn.execute("PRAGMA foreign_key_check").fetchall() == []
+        assert result.delta_records == 3
+        conn.close()
+
+    def test_delta_registry_tables(self, tmp_path):
+        """Таблицы реестра сравниваются: в дельте только новые записи и их родители"""
+        old = create_test_archive(tmp_path / 'old.jwlibrary', media_rows('a', ['a.jpg'], ['a.jpg']),
+                                  extra_schema=MEDIA_SCHEMA)
+        new = create_test_archive(tmp_path / 'new.jwlibrary', media_rows('a', ['a.jpg', 'b.jpg'], ['a.jpg', 'b.jpg']),
+                                  extra_schema=MEDIA_SCHEMA)
+        output = io.BytesIO()
+        result = diff_backups(old, new, delta_output=output)
+
+        db_data, _ = read_archive(output.getvalue())
+        conn = sqlite3.connect(':memory:')
+        conn.deserialize(db_data)
+        assert conn.execute("PRAGMA foreign_key_check").fetchall() == []
+        assert conn.execute("SELECT FilePath FROM IndependentMedia").fetchall() == [('b.jpg',)]
+        assert conn.execute("SELECT COUNT(*) FROM PlaylistItem").fetchone()[0] == 1
+        assert conn.execute("SELECT COUNT(*) FROM InputField").fetchone()[0] == 0
+        assert conn.execute("SELECT COUNT(*) FROM Location").fetchone()[0] == 0
+        conn.close()
+        assert result.added['IndependentMedia'] == 1 and result.added['PlaylistItemIndependentMediaMap'] == 1
+        assert result.added['InputField'] == 0
+        assert result.delta_records == 3
+
+    def test_cli_json(self, backups, tmp_path, monkeypatch, capsys):
+        """Подкоманда diff с выводом в JSON"""
+        old, new = backups
+        monkeypatch.chdir(tmp_path)
+        main(['diff', str(old), str(new), '--json', '-o', 'delta.jwlibrary'])
+
+        output = json.loads(capsys.readouterr().out)
+        assert output['added']['Note'] == 1
+        assert (tmp_path / 'delta.jwlibrary').exists()
+
+
+class TestKeyIndex:
+    """Тесты для файлов индекса ключей"""
+
+    @pytest.fixture
+    def archives(self, tmp_path):
+        first = create_test_archive(tmp_path / 'a.jwlibrary', sample_rows('a', 4))
+        rows = sample_rows('a', 4)
+        rows['Tag'].append({'TagId': 10, 'Type': 1, 'Name': 'only-in-b'})
+        second = create_test_archive(tmp_path / 'b.jwlibrary', rows)
+        return first, second
+
+    def test_membership_and_rowid(self, archives):
+        """Ключ записи находится двоичным поиском, rowid сохраняется"""
+        first, _ = archives
+        with KeyIndex(build_key_index(first)) as index:
+            tags = index['Tag']
+            key = record_key_digest('Tag', {'Name': 'a-tag-3', 'Type': 1})
+            assert len(tags) == 4
+            assert key in tags
+            assert tags.rowid(key) == 3
+            assert record_key_digest('Tag', {'Name': 'missing', 'Type': 1}) not in tags
+            assert list(tags) == sorted(tags)
+
+    def test_digest_is_hash_prefix(self):
+        """Бинарный ключ - префикс generate_record_hash"""
+        data = {'Name': 'x', 'Type': 1}
+        assert record_key_digest('Tag', data).hex() == generate_record_hash('Tag', data)[:32]
+
+    def test_overlap_and_new_keys(self, archives):
+        """Пересечение и новые ключи считаются без загрузки в память"""
+        first, second = archives
+        with open_key_index(first) as a, open_key_index(second) as b:
+            assert count_overlap(a['Tag'], b['Tag']) == 4
+            new = list(iter_new_keys(b['Tag'], [a['Tag']]))
+            assert new == [(record_key_digest('Tag', {'Name': 'only-in-b', 'Type': 1}), 10)]
+            assert list(iter_new_keys(a['Note'], [b['Note']])) == []
+
+    def test_stale_index_rebuilt(self, archives, tmp_path):
+        """Индекс перестраивается после изменения архива"""
+        first, _ = archives
+        open_key_index(first).close()
+        create_test_archive(first, sample_rows('z', 1))
+
+        with open_key_index(first) as index:
+            assert index.is_fresh(first)
+            assert len(index['Tag']) == 1
+
+
+class TestSkipSubsumed:
+    """Тесты пропуска архивов и таблиц без новых записей"""
+
+    def test_older_subset_archive_skipped(self, tmp_path):
+        """Архив-подмножество более нового пропускается, результат не меняется"""
+        old = create_test_archive(tmp_path / '1-old.jwlibrary', sample_rows('a', 3))
+        new = create_test_archive(tmp_path / '2-new.jwlibrary', sample_rows('a', 5))
+        other = create_test_archive(tmp_path / '3-other.jwlibrary', sample_rows('b', 2))
+        archives = [old, new, other]
+
+        plan = plan_subsumed(archives, tmp_path / 'idx')
+        full = create_merged_db(archives, tmp_path / 'full.db')
+        skipped = create_merged_db(archives, tmp_path / 'skip.db', skip_subsumed=True, index_dir=tmp_path / 'idx')
+
+        assert plan[old] == frozenset(TABLE_ORDER)
+        assert plan[new] == frozenset() and plan[other] == frozenset()
+        assert skipped.archives == 2
+        assert skipped.tables == full.tables
+
+    def test_parent_kept_for_new_children(self, tmp_path):
+        """Покрытая родительская таблица не пропускается, если в дочерней есть новое"""
+        rows = sample_rows('a', 2)
+        rows['Note'][0]['Content'] = 'edited'
+        first = create_test_archive(tmp_path / 'a.jwlibrary', rows)
+        second = create_test_archive(tmp_path / 'b.jwlibrary', sample_rows('a', 2))
+
+        plan = plan_subsumed([first, second])
+
+        assert 'Note' not in plan[first]
+        assert 'Location' not in plan[first] and 'UserMark' not in plan[first]
+        assert {'Tag', 'TagMap', 'Bookmark', 'BlockRange'} <= plan[first]
+
+    def test_renumbered_parents_not_subsumed(self, tmp_path):
+        """Дочерняя запись с тем же ID родителя, но другим родителем, не считается покрытой"""
+        first = create_test_archive(tmp_path / 'a.jwlibrary', {
+            'Tag': [{'TagId': 1, 'Type': 1, 'Name': 'fav'}],
+            'TagMap': [{'TagMapId': 1, 'Type': 1, 'TypeId': 7, 'TagId': 1, 'Position': 0}],
+        })
+        second = create_test_archive(tmp_path / 'b.jwlibrary', {
+            'Tag': [{'TagId': 1, 'Type': 1, 'Name': 'todo'}, {'TagId': 2, 'Type': 1, 'Name': 'fav'}],
+            'TagMap': [{'TagMapId': 1, 'Type': 1, 'TypeId': 7, 'TagId': 1, 'Position': 0}],
+        })
+
+        plan = plan_subsumed([first, second], tmp_path / 'idx')
+        full = create_merged_db([first, second], tmp_path / 'full.db')
+        skipped = create_merged_db(
+            [first, second], tmp_path / 'skip.db', skip_subsumed=True, index_dir=tmp_path / 'idx'
+        )
+
+        assert 'TagMap' not in plan[first] and 'Tag' not in plan[first]
+        assert skipped.tables == full.tables
+        conn = sqlite3.connect(tmp_path / 'skip.db')
+        names = conn.execute("SELECT Name FROM TagMap JOIN Tag USING (TagId) ORDER BY Name").fetchall()
+        conn.close()
+        assert names == [('fav',), ('todo',)]
+
+    def test_registry_tables_keep_archive(self, tmp_path):
+        """Архив с покрытыми основными таблицами не пропускается, если в таблицах реестра есть новое"""
+        rows = sample_rows('a', 2)
+        rows['InputField'] = [{'LocationId': 2, 'TextTag': 'tt1', 'Value': 'only-in-a'}]
+        first = create_test_archive(tmp_path / 'a.jwlibrary', rows, extra_schema=MEDIA_SCHEMA)
+        second = create_test_archive(tmp_path / 'b.jwlibrary', sample_rows('a', 3), extra_schema=MEDIA_SCHEMA)
+
+        plan = plan_subsumed([first, second], tmp_path / 'idx')
+        result = create_merged_db(
+            [first, second], tmp_path / 'skip.db', skip_subsumed=True, index_dir=tmp_path / 'idx'
+        )
+
+        assert not plan.drops(first) and plan.drops(second) is False
+        assert 'InputField' not in plan[first] and 'Location' not in plan[first]
+        assert {'Tag', 'TagMap', 'IndependentMedia'} <= plan[first]
+        assert result.archives == 2
+        conn = sqlite3.connect(tmp_path / 'skip.db')
+        assert conn.execute("SELECT Value FROM InputField").fetchall() == [('only-in-a',)]
+        conn.close()
+
+    def test_newer_version_in_earlier_archive_kept(self, tmp_path):
+        """Более новая версия выделения в первом архиве не пропускается: результат как у полного слияния"""
+        rows = sample_rows('a', 2)
+        rows['UserMark'][0]['Version'] = 2
+        archives = [
+            create_test_archive(tmp_path / 'a.jwlibrary', rows),
+            create_test_archive(tmp_path / 'b.jwlibrary', sample_rows('a', 2)),
+        ]
+
+        plan = plan_subsumed(archives, tmp_path / 'idx')
+        create_merged_db(archives, tmp_path / 'skip.db', skip_subsumed=True, index_dir=tmp_path / 'idx')
+
+        assert 'UserMark' not in plan[archives[0]]
+        conn = sqlite3.connect(tmp_path / 'skip.db')
+        versions = dict(conn.execute("SELECT UserMarkGuid, Version FROM UserMark"))
+        conn.close()
+        assert versions == {'a-um-1': 2, 'a-um-2': 1}
+
+    def test_filter_warns(self, tmp_path, caplog):
+        """skip_subsumed с фильтром не применяется, и об этом выводится предупреждение"""
+        archives = [create_test_archive(tmp_path / f'{prefix}.jwlibrary', sample_rows(prefix, 1)) for prefix in 'ab']
+        with caplog.at_level(logging.WARNING, logger='jwl_backup_merger'):
+            create_merged_db(archives, tmp_path / 'out.db', skip_subsumed=True, merge_filter=MergeFilter(tables={'Tag'}))
+        assert any('--skip-subsumed' in message for message in caplog.messages)
+
+    def test_tree_merge_uses_plan(self, tmp_path):
+        """С workers > 1 покрытые таблицы пропускаются и в группах дерева"""
+        edited = sample_rows('a', 2)
+        edited['Note'][0]['Content'] = 'edited'
+        archives = [
+            create_test_archive(tmp_path / '0.jwlibrary', sample_rows('z', 1)),
+            create_test_archive(tmp_path / '1.jwlibrary', edited),
+            create_test_archive(tmp_path / '2.jwlibrary', sample_rows('a', 2)),
+            create_test_archive(tmp_path / '3.jwlibrary', sample_rows('y', 1)),
+        ]
+
+        plan = plan_subsumed(archives, tmp_path / 'idx')
+        serial = create_merged_db(archives, tmp_path / 'serial.db', skip_subsumed=True, index_dir=tmp_path / 'idx')
+        tree = create_merged_db(
+            archives, tmp_path / 'tree.db', skip_subsumed=True, index_dir=tmp_path / 'idx', workers=2
+        )
+
+        assert 'Tag' in plan[archives[1]]
+        assert tree.tables == serial.tables
+        # Без плана теги архива 1 вставлялись бы в группе и считались дубликатами при слиянии групп
+        assert tree.table_stats['Tag'].duplicates == serial.table_stats['Tag'].duplicates == 0
+
+
+class TestPipeline:
+    """Тесты конвейера распаковки, хэширования и вставки"""
+
+    def test_same_result_as_sequential(self, tmp_path):
+        """Конвейер с маленькими порциями даёт ту же базу, что и последовательная обработка"""
+        archives = [create_test_archive(tmp_path / f'{p}.jwlibrary', sample_rows(p, 6)) for p in 'abc']
+
+        sequential = create_merged_db(archives, tmp_path / 'seq.db', batch_size=2, pipeline_depth=0)
+        pipelined = create_merged_db(archives, tmp_path / 'pipe.db', batch_size=2, pipeline_depth=1)
+
+        assert pipelined.tables == sequential.tables
+        rows = {}
+        for name in ('seq', 'pipe'):
+            conn = sqlite3.connect(tmp_path / f'{name}.db')
+            rows[name] = {table: conn.execute(f'SELECT * FROM "{table}" ORDER BY 1').fetchall() for table in TABLE_ORDER}
+            conn.close()
+        assert rows['pipe'] == rows['seq']
+
+    def test_producer_error_and_early_close(self):
+        """Ошибка производителя доходит до потребителя, досрочное закрытие останавливает поток"""
+        def failing():
+            yield 1
+            raise RuntimeError('boom')
+
+        with pytest.raises(RuntimeError, match='boom'):
+            list(_iter_in_thread(failing(), 1))
+
+        produced = []
+
+        def endless():
+            i = 0
+            while True:
+                produced.append(i)
+                yield i
+                i += 1
+
+        items = _iter_in_thread(endless(), 2)
+        assert next(items) == 0
+        items.close()
+        assert len(produced) <= 4
+
+
+class TestExport:
+    """Тесты экспорта записей в NDJSON/CSV"""
+
+    def test_records_joined_with_location(self, tmp_path):
+        """Записи всех видов с полями Location, из нескольких архивов"""
+        first = create_test_archive(tmp_path / 'a.jwlibrary', sample_rows('a', 3))
+        second = create_test_archive(tmp_path / 'b.jwlibrary', sample_rows('b', 2))
+
+        records = list(export_records([first, second], batch_size=1))
+
+        kinds = [(r['source'], r['kind']) for r in records]
+        assert kinds.count(('a.jwlibrary', 'note')) == 3 and kinds.count(('b.jwlibrary', 'highlight')) == 2
+        note = next(r for r in records if r['kind'] == 'note' and r['source'] == 'b.jwlibrary')
+        assert (note['Content'], note['Location.Title']) == ('b content 1', 'b-loc-1')
+        highlight = next(r for r in records if r['kind'] == 'highlight')
+        assert highlight['BlockRange.EndToken'] == 5
+        tag = next(r for r in records if r['kind'] == 'tag')
+        assert tag['Tag.Name'] == 'a-tag-1'
+
+    def test_cli_ndjson_and_csv(self, tmp_path):
+        """Подкоманда export пишет NDJSON и CSV"""
+        archive = create_test_archive(tmp_path / 'a.jwlibrary', sample_rows('a', 3))
+        log_file = str(tmp_path / 'log')
+
+        main(['export', str(archive), '-o', str(tmp_path / 'out.ndjson'), '--log-file', log_file])
+        main(['export', str(archive), '--kind', 'bookmark', '--format', 'csv',
+              '-o', str(tmp_path / 'out.csv'), '--log-file', log_file])
+
+        lines = (tmp_path / 'out.ndjson').read_text(encoding='utf-8').splitlines()
+        assert len(lines) == 12
+        assert {json.loads(line)['kind'] for line in lines} == {'note', 'highlight', 'bookmark', 'tag'}
+        rows = (tmp_path / 'out.csv').read_text(encoding='utf-8').splitlines()
+        assert rows[0].startswith('kind,source,BookmarkId') and len(rows) == 4
+        with pytest.raises(SystemExit):
+            main(['export', str(archive), '--format', 'csv', '--log-file', log_file])
+
+
+class TestTreeMerge:
+    """Тесты слияния деревом в нескольких процессах"""
+
+    def table_contents(self, db_path):
+        """Содержимое таблиц без зависимости от нумерации ID"""
+        conn = sqlite3.connect(db_path)
+        try:
+            assert conn.execute("PRAGMA foreign_key_check").fetchall() == []
+            return {
+                'Location': sorted(conn.execute("SELECT Title FROM Location").fetchall()),
+                'Tag': sorted(conn.execute("SELECT Name FROM Tag").fetchall()),
+                'Note': sorted(conn.execute(
+                    "SELECT n.Guid, n.Content, l.Title, u.UserMarkGuid FROM Note n "
+                    "JOIN Location l ON l.LocationId = n.LocationId JOIN UserMark u ON u.UserMarkId = n.UserMarkId"
+                ).fetchall()),
+                'BlockRange': sorted(conn.execute(
+                    "SELECT u.UserMarkGuid, b.Identifier FROM BlockRange b JOIN UserMark u USING (UserMarkId)"
+                ).fetchall()),
+                'Bookmark': sorted(conn.execute(
+                    "SELECT b.Title, l.Title FROM Bookmark b JOIN Location l USING (LocationId)"
+                ).fetchall()),
+            }
+        finally:
+            conn.close()
+
+    def test_same_as_serial(self, tmp_path):
+        """Результат дерева совпадает с последовательным слиянием"""
+        archives = []
+        for i, prefix in enumerate('abcde'):
+            rows = sample_rows('shared', 2)
+            extra = sample_rows(prefix, 3 + i)
+            for table, table_rows in extra.items():
+                for row in table_rows[2:]:
+                    rows[table].append(row)
+            archives.append(create_test_archive(tmp_path / f'{i}-{prefix}.jwlibrary', rows))
+
+        serial = create_merged_db(archives, tmp_path / 'serial.db')
+        tree = tree_merge(archives, tmp_path / 'tree.db', workers=3)
+
+        assert tree.archives == 5
+        assert tree.tables == serial.tables
+        assert self.table_contents(tmp_path / 'tree.db') == self.table_contents(tmp_path / 'serial.db')
+        assert list(tmp_path.glob('.tree-merge-*')) == []
+
+
+class TestRowPlan:
+    """Тесты скомпилированных планов обработки записей"""
+
+    @pytest.mark.parametrize('table', ['Note', 'UserMark', 'Tag', 'BlockRange'])
+    def test_key_matches_record_hash(self, table):
+        """Ключ по позициям совпадает с generate_record_hash, в том числе без части столбцов"""
+        rows = sample_rows('a', 1)[table] + [{'UserMarkGuid': '', 'LocationId': 3, 'ColorIndex': 0,
+                                              'Guid': 'g', 'Name': 'x', 'UserMarkId': None}]
+        for row in rows:
+            columns = tuple(row)
+            plan = _compile_row_plan(table, columns)
+            assert plan.key_hash(tuple(row.values())) == generate_record_hash(table, row)
+            assert _compile_row_plan(table, columns) is plan
+
+    def test_remap_and_pk_removal(self):
+        """Внешние ключи из FOREIGN_KEYS заменяются по маппингу, первичный ключ убирается по позиции"""
+        conn = sqlite3.connect(':memory:')
+        conn.executescript(TEST_SCHEMA)
+        row = sample_rows('a', 1)['Bookmark'][0]
+        conn.execute(f"INSERT INTO Bookmark ({', '.join(row)}) VALUES ({', '.join('?' for _ in row)})",
+                     tuple(row.values()))
+
+        cursor = conn.execute("SELECT * FROM Bookmark")
+        plan = _compile_row_plan('Bookmark', tuple(d[0] for d in cursor.description))
+        (source, remapped, record_hash), = next(
+            _iter_keyed_batches(cursor, plan, {'Location': {1: 10}, 'Tag': {1: 20}})
+        )
+        assert source[1:3] == (1, 1)
+        assert remapped[1:3] == (10, 10)
+        assert record_hash == plan.key_hash(remapped)
+        assert plan.without_pk(remapped) == remapped[1:]
+
+        (source, remapped, _), = next(_iter_keyed_batches(conn.execute("SELECT * FROM Bookmark"), plan, {}))
+        assert remapped is source
+        conn.close()
+
+
+
+class TestIdMap:
+    """Тесты маппинга ID на массиве с запасным dict"""
+
+    def test_dense_and_sparse(self):
+        """Плотные ID хранятся в массиве, далёкие и нецелые - в dict, поведение как у dict"""
+        mapping = IdMap({1: 10, 2: 20, 10 ** 12: 30, 'x': 40})
+        assert len(mapping) == 4
+        assert mapping[1] == 10 and mapping[10 ** 12] == 30 and mapping['x'] == 40
+        assert 3 not in mapping and mapping.get(3) is None
+        mapping[2] = 21
+        assert len(mapping) == 4 and mapping[2] == 21
+        assert dict(mapping.items()) == {1: 10, 2: 21, 10 ** 12: 30, 'x': 40}
+        with pytest.raises(KeyError):
+            mapping[5]
+
+    def test_remap_column(self):
+        """Столбец заменяется целиком: пустые и неизвестные значения не меняются"""
+        mapping = IdMap({1: 10, 10 ** 12: 30})
+        assert mapping.remap_column([None, 0, 1, 2, 10 ** 12]) == [None, 0, 10, 2, 30]
+        assert IdMap({1: 10}).remap_column((1, 5, None)) == [10, 5, None]
+
+    def test_copy_builds_id_map(self):
+        """copy_unique_records сохраняет маппинг таблицы в IdMap"""
+        src = sqlite3.connect(':memory:')
+        dst = sqlite3.connect(':memory:')
+        for conn in (src, dst):
+            conn.executescript(TEST_SCHEMA)
+        dst.execute("INSERT INTO Tag VALUES (1, 1, 'existing')")
+        src.executemany("INSERT INTO Tag VALUES (?, 1, ?)", [(1, 'a'), (2, 'b')])
+        id_mapping = {}
+        copy_unique_records(src, dst, 'Tag', set(), id_mapping)
+        assert isinstance(id_mapping['Tag'], IdMap)
+        assert dict(id_mapping['Tag'].items()) == {1: 2, 2: 3}
+
+
+# Таблицы JW Library вне TABLE_ORDER: медиа, плейлисты и поля ввода
+MEDIA_SCHEMA = """
+CREATE TABLE IndependentMedia (
+    IndependentMediaId INTEGER PRIMARY KEY, OriginalFilename TEXT NOT NULL, FilePath TEXT NOT NULL UNIQUE,
+    MimeType TEXT NOT NULL, Hash TEXT NOT NULL
+);
+CREATE TABLE PlaylistItem (PlaylistItemId INTEGER PRIMARY KEY, Label TEXT NOT NULL);
+CREATE TABLE PlaylistItemIndependentMediaMap (
+    PlaylistItemId INTEGER NOT NULL, IndependentMediaId INTEGER NOT NULL, DurationTicks INTEGER NOT NULL,
+    PRIMARY KEY (PlaylistItemId, IndependentMediaId),
+    FOREIGN KEY (PlaylistItemId) REFERENCES PlaylistItem(PlaylistItemId),
+    FOREIGN KEY (IndependentMediaId) REFERENCES IndependentMedia(IndependentMediaId)
+);
+CREATE TABLE InputField (
+    LocationId INTEGER NOT NULL, TextTag TEXT NOT NULL, Value TEXT NOT NULL,
+    PRIMARY KEY (LocationId, TextTag), FOREIGN KEY (LocationId) REFERENCES Location(LocationId)
+);
+"""
+
+
+def media_rows(prefix, files, item_files):
+    """Записи sample_rows плюс медиафайлы files и элемент плейлиста со ссылками на item_files"""
+    rows = sample_rows(prefix, 2)
+    rows['IndependentMedia'] = [
+        {'IndependentMediaId': i, 'OriginalFilename': name, 'FilePath': name, 'MimeType': 'image/jpeg', 'Hash': name}
+        for i, name in enumerate(files, 1)
+    ]
+    rows['PlaylistItem'] = [{'PlaylistItemId': 1, 'Label': f'{prefix}-playlist'}]
+    rows['PlaylistItemIndependentMediaMap'] = [
+        {'PlaylistItemId': 1, 'IndependentMediaId': files.index(name) + 1, 'DurationTicks': 10} for name in item_files
+    ]
+    rows['InputField'] = [{'LocationId': 2, 'TextTag': 'tt1', 'Value': f'{prefix}-value'}]
+    return rows
+
+
+class TestSchemaRegistry:
+    """Тесты слияния таблиц, найденных по схеме базы"""
+
+    def test_filtered_merge_clears_registry_tables(self, tmp_path):
+        """С фильтром таблицы реестра первого архива очищаются: внешние ключи не висят"""
+        archives = [
+            create_test_archive(tmp_path / f'{p}.jwlibrary', media_rows(p, [f'{p}.jpg'], [f'{p}.jpg']),
+                                extra_schema=MEDIA_SCHEMA)
+            for p in 'ab'
+        ]
+        result = create_merged_db(archives, tmp_path / 'out.db', merge_filter=MergeFilter(tables={'Tag'}))
+
+        assert result.verify.ok
+        conn = sqlite3.connect(tmp_path / 'out.db')
+        for table in ('InputField', 'PlaylistItem', 'IndependentMedia', 'PlaylistItemIndependentMediaMap',
+                      'Location', 'Note'):
+            assert conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0] == 0, table
+        assert conn.execute("SELECT COUNT(*) FROM Tag").fetchone()[0] == 4
+        assert conn.execute("PRAGMA foreign_key_check").fetchall() == []
+        conn.close()
+
+    def test_registry_order_and_keys(self, tmp_path):
+        """Родительские таблицы раньше дочерних, естественный ключ - из UNIQUE-индекса или первичного ключа"""
+        archive = create_test_archive(tmp_path / 'a.jwlibrary', media_rows('a', ['a.jpg'], ['a.jpg']),
+                                      extra_schema=MEDIA_SCHEMA)
+        db_path, _ = extract_from_archive(archive, tmp_path / 'a')
+        conn = sqlite3.connect(db_path)
+        registry = schema_registry(conn)
+        assert schema_registry(conn) is registry
+        conn.close()
+
+        order = registry.order
+        assert order[:len(TABLE_ORDER)] == tuple(TABLE_ORDER)
+        assert order.index('PlaylistItemIndependentMediaMap') > order.index('IndependentMedia')
+        assert registry.tables['IndependentMedia'].natural_key == ('FilePath',)
+        assert registry.tables['InputField'].natural_key == ('LocationId', 'TextTag')
+        assert registry.tables['InputField'].foreign_keys == (('LocationId', 'Location'),)
+        assert 'LastModified' not in registry.tables
+
+    def test_extra_tables_merged_with_remap(self, tmp_path):
+        """Медиа и плейлисты второго архива добавляются с новыми ID, общий файл не дублируется"""
+        first = create_test_archive(tmp_path / 'a.jwlibrary', media_rows('a', ['a.jpg', 'b.jpg'], ['b.jpg']),
+                                    extra_schema=MEDIA_SCHEMA)
+        second = create_test_archive(tmp_path / 'b.jwlibrary', media_rows('b', ['b.jpg', 'c.jpg'], ['b.jpg', 'c.jpg']),
+                                     extra_schema=MEDIA_SCHEMA)
+        db_path = tmp_path / 'merged.db'
+
+        result = create_merged_db([first, second], db_path)
+
+        assert result.verify.ok
+        assert result.tables['IndependentMedia'] == 3
+        assert result.duplicates['IndependentMedia'] == 1
+        conn = sqlite3.connect(db_path)
+        playlist = conn.execute(
+            "SELECT m.FilePath FROM PlaylistItemIndependentMediaMap pm "
+            "JOIN PlaylistItem p USING (PlaylistItemId) JOIN IndependentMedia m USING (IndependentMediaId) "
+            "WHERE p.Label = 'b-playlist' ORDER BY m.FilePath"
+        ).fetchall()
+        input_value = conn.execute(
+            "SELECT l.Title FROM InputField f JOIN Location l USING (LocationId) WHERE f.Value = 'b-value'"
+        ).fetchone()
+        conn.close()
+        assert playlist == [('b.jpg',), ('c.jpg',)]
+        assert input_value == ('b-loc-2',)
+
+
+class TestMedia:
+    """Тесты переноса медиафайлов в выходной архив"""
+
+    @pytest.fixture
+    def archives(self, tmp_path):
+        """Общий файл (сжатый по-разному), файл только во втором архиве и конфликт имён"""
+        first = create_test_archive(tmp_path / 'a.jwlibrary', sample_rows('a', 1))
+        second = create_test_archive(tmp_path / 'b.jwlibrary', sample_rows('b', 1))
+        shared = bytes(range(256)) * 400
+        with zipfile.ZipFile(first, 'a') as zf:
+            zf.writestr('shared.jpg', shared, compress_type=zipfile.ZIP_STORED)
+            zf.writestr('same-name.png', b'first')
+        with zipfile.ZipFile(second, 'a') as zf:
+            zf.writestr('shared.jpg', shared, compress_type=zipfile.ZIP_DEFLATED)
+            zf.writestr('same-name.png', b'second')
+            zf.writestr('only-b.mp4', b'video' * 1000, compress_type=zipfile.ZIP_DEFLATED)
+        return [first, second], shared
+
+    def test_plan_dedups_by_content(self, archives):
+        """Одинаковое содержимое с одним именем берётся один раз, при конфликте - из первого архива"""
+        paths, _ = archives
+        media = {member.info.filename: member.archive.name for member in plan_media(paths)}
+        assert media == {'shared.jpg': 'a.jwlibrary', 'same-name.png': 'a.jwlibrary', 'only-b.mp4': 'b.jwlibrary'}
+
+    def test_manifest_last_with_db_hash(self, archives, tmp_path):
+        """Хэш в манифесте посчитан при упаковке базы, манифест - последний член архива"""
+        paths, _ = archives
+        output = tmp_path / 'out.jwlibrary'
+        run_merge(paths, output)
+
+        with zipfile.ZipFile(output) as zf:
+            assert zf.namelist()[0] == 'userData.db'
+            assert zf.namelist()[-1] == 'manifest.json'
+            manifest = json.loads(zf.read('manifest.json'))
+            assert manifest['userDataBackup']['hash'] == hashlib.sha256(zf.read('userData.db')).hexdigest()
+
+    def test_output_contains_media(self, archives, tmp_path):
+        """Медиафайлы скопированы без перепаковки и читаются с проверкой CRC"""
+        paths, shared = archives
+        output = tmp_path / 'out.jwlibrary'
+        run_merge(paths, output)
+
+        with zipfile.ZipFile(output) as zf:
+            assert zf.testzip() is None
+            assert set(zf.namelist()) == {'userData.db', 'manifest.json', 'shared.jpg', 'same-name.png', 'only-b.mp4'}
+            assert zf.read('shared.jpg') == shared
+            assert zf.read('same-name.png') == b'first'
+            assert zf.getinfo('only-b.mp4').compress_type == zipfile.ZIP_DEFLATED
+            assert zf.getinfo('shared.jpg').compress_type == zipfile.ZIP_STORED
+
+    def test_merge_extracts_only_db(self, archives, tmp_path, monkeypatch):
+        """При слиянии на диск распаковываются только база и манифест, медиафайлы - нет"""
+        paths, _ = archives
+        extracted = []
+        original_extract = zipfile.ZipFile.extract
+
+        def spy_extract(zf, member, *args, **kwargs):
+            extracted.append(member)
+            return original_extract(zf, member, *args, **kwargs)
+
+        monkeypatch.setattr(zipfile.ZipFile, 'extract', spy_extract)
+        monkeypatch.setattr(zipfile.ZipFile, 'extractall', None)
+        run_merge(paths, tmp_path / 'out.jwlibrary')
+
+        assert extracted and set(extracted) <= {'userData.db', 'manifest.json'}
+
+    def test_merger_warns_about_media(self, archives, caplog):
+        """Merger пишет только базу и манифест и предупреждает о непереносимых медиафайлах"""
+        paths, _ = archives
+        merger = Merger()
+        for path in paths:
+            merger.add(path)
+        output = io.BytesIO()
+        with caplog.at_level(logging.WARNING, logger='jwl_backup_merger'):
+            merger.merge(output)
+
+        with zipfile.ZipFile(io.BytesIO(output.getvalue())) as zf:
+            assert set(zf.namelist()) == {'userData.db', 'manifest.json'}
+        assert any('Медиафайлы входных архивов (5)' in message for message in caplog.messages)
+
+    def test_fallback_without_zip_internals(self, archives, tmp_path, monkeypatch):
+        """В непроверенной версии Python медиафайлы копируются через ZipFile.open с тем же методом сжатия"""
+        paths, shared = archives
+        monkeypatch.setattr(jwl_backup_merger, '_ZIP_RAW_COPY_VERSIONS', ((0, 0), (0, 0)))
+        output = tmp_path / 'out.jwlibrary'
+        run_merge(paths, output)
+
+        with zipfile.ZipFile(output) as zf:
+            assert zf.testzip() is None
+            assert zf.namelist()[-1] == 'manifest.json'
+            assert zf.read('shared.jpg') == shared
+            assert zf.read('only-b.mp4') == b'video' * 1000
+            assert zf.getinfo('only-b.mp4').compress_type == zipfile.ZIP_DEFLATED
+            assert zf.getinfo('shared.jpg').compress_type == zipfile.ZIP_STORED
+
+
+class FakeTkVar:
+    """Замена tk.StringVar/DoubleVar для тестов без Tk"""
+
+    def __init__(self):
+        self.value = None
+
+    def set(self, value):
+        self.value = value
+
+
+class TestGuiBridge:
+    """Тесты очереди событий GUI и итога дочернего процесса слияния (без окна Tk)"""
+
+    @pytest.fixture
+    def app(self):
+        gui = pytest.importorskip('jwl_backup_merger_gui')
+        app = gui.BackupMergerGUI.__new__(gui.BackupMergerGUI)
+        app.ui_queue = gui.queue.Queue()
+        app.log_messages = gui.deque(maxlen=gui.LOG_MAX_LINES)
+        app.logger = logging.getLogger('test_gui')
+        app.scheduled = []
+        app.root = type('Root', (), {'after': lambda root, delay, callback: app.scheduled.append(delay)})()
+        app.status_var, app.progress_var = FakeTkVar(), FakeTkVar()
+        button = type('Button', (), {'configure': lambda button, **kwargs: None})()
+        app.merge_btn = app.cancel_btn = button
+        app.cancel_requested = False
+        app.is_processing = True
+        app.merge_process = None
+        return gui, app
+
+    def queued(self, app, kind):
+        """Значения событий kind, оставшихся в очереди"""
+        return [value for event, value in list(app.ui_queue.queue) if event == kind]
+
+    def test_failing_call_keeps_polling(self, app):
+        """Исключение в вызове из очереди не останавливает опрос и следующие вызовы"""
+        _, app = app
+        called = []
+
+        def broken():
+            raise RuntimeError("boom")
+
+        app.call_in_ui(broken)
+        app.call_in_ui(called.append, 'next')
+        app.drain_ui_queue()
+
+        assert called == ['next']
+        assert len(app.scheduled) == 1
+
+    def test_events_capped_per_tick(self, app):
+        """За тик применяется не больше UI_MAX_EVENTS событий, остаток - на следующем тике без паузы"""
+        gui, app = app
+        for i in range(gui.UI_MAX_EVENTS + 10):
+            app.set_status(f"status {i}")
+        app.drain_ui_queue()
+
+        assert app.ui_queue.qsize() == 10
+        assert app.status_var.value == f"status {gui.UI_MAX_EVENTS - 1}"
+        assert app.scheduled == [1]
+        app.drain_ui_queue()
+        assert app.ui_queue.empty() and app.scheduled == [1, gui.UI_POLL_MS]
+
+    def monitor(self, app, tmp_path, messages):
+        """merge_monitor с каналом, отдающим messages, и завершённым процессом"""
+        class Conn:
+            def __init__(self):
+                self.pending = list(messages)
+
+            def recv(self):
+                if not self.pending:
+                    raise EOFError
+                return self.pending.pop(0)
+
+            def close(self):
+                pass
+
+        process = type('Process', (), {'join': lambda process: None, 'exitcode': -15})()
+        temp_root = tmp_path / 'jwl-merge-test'
+        (temp_root / 'extract').mkdir(parents=True)
+        output_path = tmp_path / 'out.jwlibrary'
+        app.merge_monitor(process, Conn(), output_path, temp_root, open_folder=False)
+        return temp_root, output_path
+
+    def test_cancel_after_done_keeps_result(self, app, tmp_path):
+        """Отмена после ('done', ...) не отбрасывает готовый результат"""
+        _, app = app
+        app.cancel_requested = True
+        temp_root, _ = self.monitor(app, tmp_path, [('done', 5)])
+
+        assert any(status.startswith("✅") for status in self.queued(app, 'status'))
+        assert not temp_root.exists()
+
+    def test_cancel_removes_temp_files(self, app, tmp_path):
+        """Отмена удаляет промежуточные файлы и временный каталог дочернего процесса"""
+        gui, app = app
+        app.cancel_requested = True
+        output_path = tmp_path / 'out.jwlibrary'
+        for path in gui.merge_temp_paths(output_path):
+            path.write_bytes(b'partial')
+        temp_root, _ = self.monitor(app, tmp_path, [('log', "Выходной файл")])
+
+        assert self.queued(app, 'status')[-1] == "⛔ Слияние отменено"
+        assert not temp_root.exists()
+        assert not any(path.exists() for path in gui.merge_temp_paths(output_path))
+        assert not app.is_processing